@@ -0,0 +1,229 @@
+#!/bin/env python
+"""
+Iteration throughput, exchange overhead and memory of the TicaSimulator
+loop for 2 to 64 replicas and every exchange mode, on the alanine dipeptide
+in tests/test_data/starting_coordinates and the CPU platform.
+
+PLUMED is replaced by MockPlumedForce, a torsion bias on phi whose minimum
+moves with the replica, so that every replica sees a different bias and
+the swaps are accepted now and then like in a real run. The ranks are
+emulated by threads talking through the thread comms (the
+replicas_per_rank launch with all replicas in one process), so no mpirun
+is needed. Every case runs in a fresh process so that its peak memory is
+its own.
+
+    python benchmarks/benchmark_exchange.py -n 2 4 8 16 32 64 \
+        --modes memory pairwise gibbs --save benchmarks/baseline.json
+    python benchmarks/benchmark_exchange.py --compare benchmarks/baseline.json
+
+--save writes the results as json, --compare reruns the cases of a saved
+file and exits with 1 if the throughput of any case dropped, or its
+exchange overhead or peak memory grew, by more than --tolerance.
+"""
+import os
+import sys
+import time
+import json
+import types
+import shutil
+import socket
+import subprocess
+import argparse
+import tempfile
+import threading
+import platform as _platform
+import numpy as np
+
+starting_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests",
+                            "test_data", "starting_coordinates")
+
+
+def MockPlumedForce(script):
+    # "MOCK_BIAS <k> <phi0>": k*(1-cos(phi-phi0)) in kJ/mol on the phi
+    # torsion of the alanine dipeptide (atoms of tests/test_data)
+    from simtk.openmm import CustomTorsionForce
+    k, phi0 = [float(v) for v in script.split()[1:3]]
+    force = CustomTorsionForce("k_bias*(1-cos(theta-phi0))")
+    force.addGlobalParameter("k_bias", k)
+    force.addGlobalParameter("phi0", phi0)
+    force.addTorsion(4, 6, 8, 14, [])
+    return force
+
+
+def install_mock_bias():
+    # create_simulation imports PlumedForce from openmmplumed
+    module = types.ModuleType("openmmplumed")
+    module.PlumedForce = MockPlumedForce
+    sys.modules["openmmplumed"] = module
+    return
+
+
+def setup_project(base_dir, n_replicas, exchange_mode, n_iterations, swap_rate):
+    from msmbuilder.utils import dump
+    from tica_metadynamics.setup_sim import TicaMetadSim
+    cwd = os.getcwd()
+    phi0 = np.linspace(-np.pi, np.pi, n_replicas, endpoint=False)
+    dump({i: "MOCK_BIAS 5.0 %f\n"%phi0[i] for i in range(n_replicas)},
+         os.path.join(base_dir, "plumed_dict.pkl"))
+    TicaMetadSim(base_dir=base_dir, starting_coordinates_folder=os.path.abspath(starting_dir),
+                 tica_mdl=None, tica_data=None, data_frame=None,
+                 plumed_dict=os.path.join(base_dir, "plumed_dict.pkl"), platform="CPU",
+                 n_iterations=n_iterations, swap_rate=swap_rate,
+                 sim_save_rate=n_iterations*swap_rate, exchange_mode=exchange_mode,
+                 exchange_scheme="neighbour", checkpoint_interval=n_iterations,
+                 profile_timings=True)
+    os.chdir(cwd)
+    return os.path.join(base_dir, "metad_sim.pkl")
+
+
+def run_replicas(file_loc, n_replicas):
+    # host_replicas with every replica in this process, but timing the
+    # loop apart from the startup
+    from tica_metadynamics.simulate import TicaSimulator, get_cpu_slices, _run_replica
+    from tica_metadynamics.communicator import create_thread_comms
+    cwd = os.getcwd()
+    comms = create_thread_comms(n_replicas, n_replicas)
+    cpu_slices = get_cpu_slices(n_replicas)
+    start = time.time()
+    sims = [TicaSimulator(file_loc, comm=comm, gpu_index=0,
+                          cpu_threads=len(s) if s is not None else 1)
+            for comm, s in zip(comms, cpu_slices)]
+    startup = time.time() - start
+    threads = [threading.Thread(target=_run_replica, args=(sim, None)) for sim in sims]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    os.chdir(cwd)
+    return sims, startup, elapsed
+
+
+def benchmark(n_replicas, exchange_mode, n_iterations, swap_rate, out_dir=None):
+    """
+    Runs one case in this process, see run_case.
+
+    :return: dictionary of the measurements of one case
+    """
+    from tica_metadynamics.profiler import get_peak_rss_mb
+    base_dir = tempfile.mkdtemp(prefix="bench_%s_%d_"%(exchange_mode, n_replicas),
+                                dir=out_dir)
+    try:
+        file_loc = setup_project(base_dir, n_replicas, exchange_mode, n_iterations,
+                                 swap_rate)
+        sims, startup, elapsed = run_replicas(file_loc, n_replicas)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    totals = [sim.timer.summary() for sim in sims]
+    md = np.array([t["md"] for t in totals])
+    overhead = np.array([sum(v for p, v in t.items() if p in sim.timer.phases and p != "md")
+                         for t, sim in zip(totals, sims)])
+    n_logged = sims[0]._n_logged
+    return {"n_replicas": n_replicas, "exchange_mode": exchange_mode,
+            "n_iterations": n_iterations, "swap_rate": swap_rate,
+            "iterations_per_s": n_iterations/elapsed,
+            "exchange_overhead": float(overhead.sum()/max(md.sum(), 1e-9)),
+            "md_imbalance": float(md.max()/max(md.mean(), 1e-9)),
+            "startup_s": startup, "peak_rss_mb": get_peak_rss_mb(),
+            "swap_records": n_logged}
+
+
+def run_case(n_replicas, exchange_mode, n_iterations, swap_rate, out_dir=None):
+    # benchmark in a fresh python, the measurements are its last line
+    command = [sys.executable, os.path.abspath(__file__), "--case", exchange_mode,
+               str(n_replicas), "-i", str(n_iterations), "-r", str(swap_rate)]
+    if out_dir is not None:
+        command += ["-o", out_dir]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    # worse by more than tolerance (relative) in throughput, overhead or memory
+    old = dict(((r["exchange_mode"], r["n_replicas"]), r) for r in baseline["results"])
+    regressions = []
+    for r in results:
+        b = old.get((r["exchange_mode"], r["n_replicas"]))
+        if b is None:
+            continue
+        if r["iterations_per_s"] < (1 - tolerance)*b["iterations_per_s"]:
+            regressions.append("%s/%d: %.2f iterations/s, baseline %.2f"
+                               %(r["exchange_mode"], r["n_replicas"],
+                                 r["iterations_per_s"], b["iterations_per_s"]))
+        if r["exchange_overhead"] > (1 + tolerance)*b["exchange_overhead"] + 0.01:
+            regressions.append("%s/%d: exchange overhead %.3f, baseline %.3f"
+                               %(r["exchange_mode"], r["n_replicas"],
+                                 r["exchange_overhead"], b["exchange_overhead"]))
+        if "peak_rss_mb" in b and r["peak_rss_mb"] > (1 + tolerance)*b["peak_rss_mb"]:
+            regressions.append("%s/%d: peak memory %.0f MB, baseline %.0f MB"
+                               %(r["exchange_mode"], r["n_replicas"],
+                                 r["peak_rss_mb"], b["peak_rss_mb"]))
+    return regressions
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n','--n_replicas', dest='n', type=int, nargs='+',
+                        default=[2, 4, 8, 16, 32, 64])
+    parser.add_argument('-m','--modes', dest='modes', nargs='+',
+                        default=['checkpoint', 'memory', 'pairwise', 'gibbs'],
+                        choices=['checkpoint', 'memory', 'pairwise', 'gibbs'])
+    parser.add_argument('-i','--n_iterations', dest='i', type=int, default=20)
+    parser.add_argument('-r','--swap_rate', dest='r', type=int, default=50,
+                        help='md steps per iteration, small so the exchange shows')
+    parser.add_argument('-o','--out_dir', dest='o', default=None,
+                        help='where the projects are set up, defaults to a temporary folder')
+    parser.add_argument('--save', dest='save', default=None,
+                        help='write the results to this json file')
+    parser.add_argument('--compare', dest='compare', default=None,
+                        help='rerun the cases of this json file and compare')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2)
+    parser.add_argument('--case', dest='case', nargs=2, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_commandline()
+    if args.case is not None:
+        # one case for run_case
+        install_mock_bias()
+        r = benchmark(int(args.case[1]), args.case[0], args.i, args.r, args.o)
+        print(json.dumps(r), flush=True)
+        return
+    baseline = None
+    cases = [(mode, n) for mode in args.modes for n in args.n]
+    n_iterations, swap_rate = args.i, args.r
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        cases = [(r["exchange_mode"], r["n_replicas"]) for r in baseline["results"]]
+        n_iterations, swap_rate = baseline["n_iterations"], baseline["swap_rate"]
+    print("#mode\tn_replicas\titerations_per_s\texchange_overhead\tmd_imbalance\t"
+          "startup_s\tpeak_rss_mb")
+    results = []
+    for mode, n in cases:
+        r = run_case(n, mode, n_iterations, swap_rate, args.o)
+        results.append(r)
+        print("%s\t%d\t%.2f\t%.3f\t%.3f\t%.2f\t%.1f"
+              %(mode, n, r["iterations_per_s"], r["exchange_overhead"],
+                r["md_imbalance"], r["startup_s"], r["peak_rss_mb"]), flush=True)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({"host": socket.gethostname(), "machine": _platform.machine(),
+                       "n_cpus": os.cpu_count(), "n_iterations": n_iterations,
+                       "swap_rate": swap_rate, "results": results}, f, indent=1)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print("Regression %s"%line, flush=True)
+        if len(regressions) > 0:
+            sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main()
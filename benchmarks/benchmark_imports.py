@@ -0,0 +1,89 @@
+#!/bin/env python
+"""
+Cold start latency of the console entry points. Every module is imported
+in a fresh interpreter, a few times, and the heavy dependencies it pulled
+in are listed. Run it before and after touching module level imports.
+
+    python benchmarks/benchmark_imports.py -n 5 --top 10
+"""
+import sys
+import time
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# console_scripts in setup.py
+entry_points = {"setup_tica_meta_sim": "tica_metadynamics.setup_file",
+                "run_tica_meta_sim": "tica_metadynamics.simulate",
+                "process_tica_meta_sim": "tica_metadynamics.post_process"}
+
+heavy_modules = ["mdtraj", "msmbuilder", "pyemma", "simtk", "openmm", "openmmplumed",
+                 "jinja2", "mpi4py", "pandas", "sklearn"]
+
+_probe = """
+import sys, time, json
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps({"import_s": elapsed,
+                  "heavy": sorted(m for m in %r if m in sys.modules)}))
+"""
+
+
+def time_import(module, n_repeats=5):
+    """
+    :return: median wall time of the whole interpreter, median time of the
+    import statement alone, and the heavy modules that were loaded
+    """
+    wall, imports = [], []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        out = subprocess.check_output([sys.executable, "-c", _probe%(module, heavy_modules)])
+        wall.append(time.perf_counter() - start)
+        res = json.loads(out.decode().strip().splitlines()[-1])
+        imports.append(res["import_s"])
+    return np.median(wall), np.median(imports), res["heavy"]
+
+
+def import_profile(module, top=10):
+    # most expensive modules by cumulative time from python -X importtime
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s"%module],
+                          stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    rows = []
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.strip()))
+    # only top level packages, their submodules are part of the cumulative time
+    rows = [r for r in rows if "." not in r[1]]
+    return sorted(rows, reverse=True)[:top]
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n_repeats', dest='n', type=int, default=5,
+                        help='fresh interpreters per entry point')
+    parser.add_argument('--top', dest='top', type=int, default=0,
+                        help='also list the N most expensive top level imports')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_commandline()
+    interpreter, _, _ = time_import("sys", args.n)
+    print("#interpreter startup %.3f s"%interpreter)
+    print("#entry_point\tmodule\twall_s\timport_s\theavy_modules")
+    for name, module in entry_points.items():
+        wall, import_s, heavy = time_import(module, args.n)
+        print("%s\t%s\t%.3f\t%.3f\t%s"%(name, module, wall, import_s,
+                                       ",".join(heavy) or "-"), flush=True)
+        for cumulative, package in import_profile(module, args.top):
+            print("\t%s\t%.3f"%(package, cumulative/1e6))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/bin/env python
+"""
+Throughput and energy drift of the tICA bias evaluated on every step versus
+on an outer multiple time step, using the same starting_coordinates folder
+and plumed script a tica_metadynamics run would use.
+
+    python benchmarks/benchmark_mts.py -s ./starting_coordinates \
+        -p tic_0/plumed_script.dat --ratios 1 2 4 --platform CUDA
+"""
+import re
+import time
+import argparse
+import numpy as np
+from simtk.openmm import app, VerletIntegrator
+from simtk.unit import *
+from openmmplumed import PlumedForce
+from tica_metadynamics.load_sim import load_sim_files, get_platform, \
+    get_mts_integrator
+
+force_group = 30
+
+
+def build_simulation(starting_dir, plumed_script, ratio, platform, gpu_index, nve=False):
+    state, system, integrator, pdb = load_sim_files(starting_dir)
+    bias = PlumedForce(str(plumed_script))
+    bias.setForceGroup(force_group)
+    system.addForce(bias)
+    if nve:
+        # drift is only meaningful without a thermostat
+        nve_integrator = VerletIntegrator(integrator.getStepSize())
+        nve_integrator.setConstraintTolerance(integrator.getConstraintTolerance())
+        integrator = nve_integrator
+    if ratio > 1:
+        integrator = get_mts_integrator(integrator, system, force_group, ratio)
+    platform, properties = get_platform(platform, gpu_index)
+    simulation = app.Simulation(pdb.topology, system, integrator, platform, properties)
+    simulation.context.setState(state)
+    return simulation
+
+
+def time_steps(simulation, n_inner_steps, ratio):
+    n_steps = max(1, n_inner_steps//ratio)
+    # first steps include kernel compilation
+    simulation.step(min(n_steps, 10))
+    simulation.context.getState(getEnergy=True)
+    start = time.time()
+    simulation.step(n_steps)
+    simulation.context.getState(getEnergy=True)
+    elapsed = time.time() - start
+    sim_time = n_steps*simulation.integrator.getStepSize()
+    return sim_time.value_in_unit(nanosecond)/elapsed*86400.
+
+
+def static_bias(plumed_script):
+    # no hills are deposited after the first step, otherwise the growing
+    # bias shows up as drift
+    return re.sub(r"PACE=\d+", "PACE=%d"%10**9, plumed_script)
+
+
+def energy_drift(simulation, n_inner_steps, ratio, n_samples=50):
+    # slope of the total energy in kJ/mol/ns per degree of freedom
+    n_steps = max(1, n_inner_steps//ratio//n_samples)
+    system = simulation.system
+    n_dof = 3*system.getNumParticles() - system.getNumConstraints()
+    times, energies = [], []
+    for _ in range(n_samples):
+        simulation.step(n_steps)
+        state = simulation.context.getState(getEnergy=True)
+        times.append(state.getTime().value_in_unit(nanosecond))
+        energies.append((state.getPotentialEnergy() + state.getKineticEnergy()).
+                        value_in_unit(kilojoule_per_mole))
+    return np.polyfit(times, energies, 1)[0]/n_dof
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s','--starting_dir', dest='s',
+                        default='./starting_coordinates',
+                        help='folder with state0.xml, system.xml, integrator.xml and 0.pdb')
+    parser.add_argument('-p','--plumed', dest='p', required=True,
+                        help='plumed script for the bias force')
+    parser.add_argument('-n','--n_steps', dest='n', type=int, default=10000,
+                        help='inner steps per measurement')
+    parser.add_argument('-r','--ratios', dest='r', type=int, nargs='+',
+                        default=[1, 2, 4], help='inner steps per bias evaluation, '
+                        'the speedup is relative to 1 which is always run')
+    parser.add_argument('--platform', dest='platform', default='CUDA')
+    parser.add_argument('--gpu', dest='gpu', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_commandline()
+    with open(args.p) as f:
+        plumed_script = f.read()
+    print("#ratio\tns_per_day\tspeedup\tdrift_kj_mol_ns_dof")
+    baseline = None
+    for ratio in [1] + [r for r in args.r if r != 1]:
+        sim = build_simulation(args.s, plumed_script, ratio, args.platform, args.gpu)
+        speed = time_steps(sim, args.n, ratio)
+        if ratio == 1:
+            baseline = speed
+        sim = build_simulation(args.s, static_bias(plumed_script), ratio, args.platform,
+                               args.gpu, nve=True)
+        drift = energy_drift(sim, args.n, ratio)
+        print("%d\t%.2f\t%.2f\t%.3e"%(ratio, speed, speed/baseline, drift), flush=True)
+    return
+
+
+if __name__ == "__main__":
+    main()
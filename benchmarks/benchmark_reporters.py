@@ -0,0 +1,121 @@
+#!/bin/env python
+"""
+Step throughput with the trajectory and speed reporters writing on the md
+thread versus through the AsyncReporter background writer, using the same
+starting_coordinates folder a tica_metadynamics run would use. Point -o at
+the filesystem the replicas write to; --delay adds a fixed latency to every
+report to mimic a slow or busy shared filesystem.
+
+    python benchmarks/benchmark_reporters.py -s ./starting_coordinates \
+        -o /scratch/bench --interval 100 --platform CUDA
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from simtk.openmm import app
+from simtk.unit import nanosecond
+from tica_metadynamics.load_sim import load_sim_files, get_platform
+from tica_metadynamics.reporters import AsyncReporter, SubsetTrajectoryReporter, \
+    get_atom_subset
+
+
+class SlowReporter(object):
+    # adds delay seconds of "filesystem latency" to every report
+    def __init__(self, reporter, delay):
+        self.reporter = reporter
+        self.delay = delay
+
+    def describeNextReport(self, simulation):
+        return self.reporter.describeNextReport(simulation)
+
+    def report(self, simulation, state):
+        time.sleep(self.delay)
+        self.reporter.report(simulation, state)
+
+
+def build_reporters(simulation, out_dir, traj_format, interval, delay, async_reporters):
+    if traj_format == "dcd":
+        traj = app.DCDReporter(os.path.join(out_dir, "trajectory.dcd"), interval)
+    else:
+        import mdtraj as md
+        atoms = get_atom_subset(md.Topology.from_openmm(simulation.topology), "solute")
+        traj = SubsetTrajectoryReporter(os.path.join(out_dir, "trajectory.%s"%traj_format),
+                                        interval, simulation.topology, atoms,
+                                        chunk_size=100)
+    speed = app.StateDataReporter(os.path.join(out_dir, "speed_report.txt"), interval,
+                                  step=True, potentialEnergy=True, temperature=True,
+                                  speed=True, separator='\t')
+    reporters = [traj, speed]
+    if delay > 0:
+        reporters = [SlowReporter(r, delay) for r in reporters]
+    if async_reporters:
+        n_atoms = simulation.system.getNumParticles()
+        reporters = [AsyncReporter(r, n_atoms) for r in reporters]
+    return reporters
+
+
+def time_steps(starting_dir, out_dir, n_steps, interval, traj_format, delay,
+               async_reporters, platform, gpu_index):
+    state, system, integrator, pdb = load_sim_files(starting_dir)
+    platform, properties = get_platform(platform, gpu_index)
+    simulation = app.Simulation(pdb.topology, system, integrator, platform, properties)
+    simulation.context.setState(state)
+    # first steps include kernel compilation
+    simulation.step(10)
+    simulation.reporters.extend(build_reporters(simulation, out_dir, traj_format,
+                                                interval, delay, async_reporters))
+    start = time.time()
+    simulation.step(n_steps)
+    simulation.context.getState(getEnergy=True)
+    elapsed = time.time() - start
+    # what a checkpoint would wait for
+    start = time.time()
+    for reporter in simulation.reporters:
+        if hasattr(reporter, "close"):
+            reporter.close()
+    drain = time.time() - start
+    sim_time = n_steps*simulation.integrator.getStepSize()
+    return sim_time.value_in_unit(nanosecond)/elapsed*86400., drain
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s','--starting_dir', dest='s',
+                        default='./starting_coordinates',
+                        help='folder with state0.xml, system.xml, integrator.xml and 0.pdb')
+    parser.add_argument('-o','--out_dir', dest='o', default=None,
+                        help='where the reporters write, defaults to a temporary folder')
+    parser.add_argument('-n','--n_steps', dest='n', type=int, default=5000)
+    parser.add_argument('--interval', dest='interval', type=int, default=100,
+                        help='steps between reports')
+    parser.add_argument('--format', dest='format', default='dcd',
+                        choices=['dcd', 'xtc', 'h5'])
+    parser.add_argument('--delay', dest='delay', type=float, default=0.,
+                        help='extra seconds per report')
+    parser.add_argument('--platform', dest='platform', default='CUDA')
+    parser.add_argument('--gpu', dest='gpu', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_commandline()
+    print("#writer\tns_per_day\tspeedup\tfinal_drain_s")
+    baseline = None
+    for async_reporters in [False, True]:
+        out_dir = tempfile.mkdtemp(dir=args.o)
+        try:
+            speed, drain = time_steps(args.s, out_dir, args.n, args.interval, args.format,
+                                      args.delay, async_reporters, args.platform, args.gpu)
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+        baseline = baseline or speed
+        print("%s\t%.2f\t%.2f\t%.3f"%("async" if async_reporters else "sync", speed,
+                                      speed/baseline, drain), flush=True)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,8 @@ setup(
     entry_points = {
        'console_scripts': ['setup_tica_meta_sim=tica_metadynamics.setup_file:main',
                            'run_tica_meta_sim=tica_metadynamics.simulate:main',
+                           'run_tica_meta_batch=tica_metadynamics.batch:main',
+                           'pack_tica_meta_msm_states=tica_metadynamics.msm_library:main',
                            'process_tica_meta_sim=tica_metadynamics.post_process:main'],
 
     }
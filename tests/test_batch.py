@@ -0,0 +1,22 @@
+#!/bin/env python
+from tica_metadynamics.batch import pack_projects, get_project_layout
+
+
+def test_pack_projects():
+    # enough ranks for every replica
+    assert pack_projects([3, 2, 4], 9) == (1, [3, 2, 4])
+    # two replicas per rank fit the 9 replicas on 5 ranks
+    assert pack_projects([3, 2, 4], 5) == (2, [2, 1, 2])
+    assert pack_projects([3, 2, 4], 3) == (4, [1, 1, 1])
+    try:
+        pack_projects([3, 2, 4], 2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("three projects can't share two ranks")
+
+
+def test_project_layout():
+    projects, replicas_per_rank = get_project_layout([2, 1], 4)
+    assert projects == [0, 0, 1, None]
+    assert replicas_per_rank == 1
@@ -0,0 +1,42 @@
+#!/bin/env python
+import os
+from mdtraj.utils import enter_temp_directory
+from tica_metadynamics.checkpoint import get_snapshot_dir, write_replica_snapshot, \
+    load_replica_snapshot, write_manifest, find_latest_snapshot, prune_snapshots, \
+    truncate_file, truncate_swap_log
+
+
+def test_snapshot_ring():
+    with enter_temp_directory():
+        base_dir = os.path.abspath(".")
+        assert find_latest_snapshot(base_dir) == (None, None)
+        for iteration in [10, 20, 30]:
+            snapshot_dir = get_snapshot_dir(base_dir, iteration)
+            for r in range(2):
+                write_replica_snapshot(snapshot_dir, r, b"chk%d"%r,
+                                       {"iteration": iteration, "configuration": 1-r})
+            write_manifest(snapshot_dir, {"iteration": iteration})
+        # replica 1 never finished the last one
+        write_replica_snapshot(get_snapshot_dir(base_dir, 40), 0, b"chk0", {})
+        snapshot_dir, manifest = find_latest_snapshot(base_dir)
+        assert manifest["iteration"] == 30
+        checkpoint, metadata = load_replica_snapshot(snapshot_dir, 1)
+        assert checkpoint == b"chk1" and metadata["configuration"] == 0
+        assert load_replica_snapshot(snapshot_dir, 2) is None
+        prune_snapshots(base_dir, 2)
+        assert sorted(os.listdir("checkpoints")) == ["iteration_000020", "iteration_000030",
+                                                     "iteration_000040"]
+
+
+def test_truncate():
+    with enter_temp_directory():
+        with open("HILLS", 'w') as f:
+            f.writelines(["#! FIELDS time tic0\n", "1 0.5\n", "2 0.7\n"])
+        truncate_file("HILLS", len("#! FIELDS time tic0\n1 0.5\n"))
+        assert open("HILLS").read() == "#! FIELDS time tic0\n1 0.5\n"
+        truncate_file("HILLS", 0)
+        assert not os.path.isfile("HILLS")
+        with open("swap_log.txt", 'w') as f:
+            f.writelines(["#Iteration\tS_i\n", "0\t0\n", "1\t1\n", "#Iteration\tS_i\n", "2\t0\n"])
+        truncate_swap_log("swap_log.txt", 1)
+        assert open("swap_log.txt").read() == "#Iteration\tS_i\n0\t0\n#Iteration\tS_i\n"
@@ -0,0 +1,71 @@
+#!/bin/env python
+import threading
+import multiprocessing
+from tica_metadynamics.communicator import create_thread_comms, Status, ANY_SOURCE, \
+    QueueTransport
+
+
+def _run_all(comms, func):
+    results = [None]*len(comms)
+
+    def target(k):
+        results[k] = func(comms[k])
+    threads = [threading.Thread(target=target, args=(k,)) for k in range(len(comms))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_collectives():
+    comms = create_thread_comms(4, 4)
+    assert [c.Get_rank() for c in comms] == [0, 1, 2, 3]
+
+    def func(comm):
+        gathered = comm.gather(comm.rank**2, root=0)
+        comm.barrier()
+        mine = comm.scatter([10*r for r in range(comm.size)] if comm.rank == 0 else None, root=0)
+        return gathered, mine, comm.bcast("hi" if comm.rank == 0 else None), \
+            comm.allgather(comm.rank)
+    results = _run_all(comms, func)
+    assert results[0][0] == [0, 1, 4, 9]
+    assert [r[1] for r in results] == [0, 10, 20, 30]
+    assert all(r[2] == "hi" for r in results)
+    assert all(r[3] == [0, 1, 2, 3] for r in results)
+
+
+def test_point_to_point():
+    comms = create_thread_comms(2, 2)
+    comms[1].isend("a", dest=0, tag=5)
+    comms[1].isend("b", dest=0, tag=6)
+    status = Status()
+    assert comms[0].iprobe(source=ANY_SOURCE, tag=6, status=status)
+    assert status.Get_source() == 1
+    assert not comms[0].iprobe(source=1, tag=7)
+    assert comms[0].recv(source=1, tag=6) == "b"
+    assert comms[0].recv(source=ANY_SOURCE, tag=5) == "a"
+    req = comms[1].Ibarrier()
+    assert not req.Test()
+    assert comms[0].Ibarrier().Test()
+    assert req.Test()
+
+
+def _process_target(rank, queues, results):
+    comm = create_thread_comms(4, 2, QueueTransport(rank, queues))
+    results.put(_run_all(comm, lambda c: (c.Get_rank(), c.allgather(c.rank*10))))
+
+
+def test_queue_transport():
+    # two processes with two replicas each, no mpi involved
+    queues = [multiprocessing.Queue() for _ in range(2)]
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_process_target,
+                                         args=(k, queues, results)) for k in range(2)]
+    for process in processes:
+        process.start()
+    gathered = results.get(timeout=30) + results.get(timeout=30)
+    for process in processes:
+        process.join()
+    assert sorted(r for r, _ in gathered) == [0, 1, 2, 3]
+    assert all(g == [0, 10, 20, 30] for _, g in gathered)
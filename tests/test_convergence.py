@@ -0,0 +1,61 @@
+#!/bin/env python
+import os
+import numpy as np
+from mdtraj.utils import enter_temp_directory
+from tica_metadynamics.convergence import HillsReader, FreeEnergyProfile, \
+    ConvergenceMonitor
+
+
+def _write_hills(hills_file, hills, header=True, partial=False):
+    with open(hills_file, 'a') as f:
+        if header:
+            f.write("#! FIELDS time tic0 sigma_tic0 height biasf\n")
+            f.write("#! SET multivariate false\n")
+        for t, center, height in hills:
+            f.write("%d %f 0.2 %f 10\n"%(t, center, height))
+        if partial:
+            f.write("3 0.1")
+
+
+def test_hills_reader():
+    with enter_temp_directory():
+        reader = HillsReader("HILLS")
+        # nothing deposited yet
+        assert len(reader.read()[0]) == 0
+        _write_hills("HILLS", [(1, 0.5, 1.), (2, -0.5, 0.5)], partial=True)
+        centers, sigmas, heights = reader.read()
+        assert list(centers) == [0.5, -0.5] and list(heights) == [1., 0.5]
+        assert list(sigmas) == [0.2, 0.2]
+        # the line plumed was writing is picked up once it is complete
+        with open("HILLS", 'a') as f:
+            f.write(" 0.2 2.0 10\n")
+        centers, sigmas, heights = reader.read()
+        assert list(heights) == [2.]
+
+
+def test_convergence_monitor():
+    with enter_temp_directory():
+        os.mkdir("tic_0")
+        monitor = ConvergenceMonitor(["tic_0/HILLS"], tol=0.5, patience=2,
+                                     min_acceptance=0.2, log_file="convergence.txt")
+        hills = [(t, c, 1.) for t, c in enumerate(np.linspace(-1, 1, 21))]
+        _write_hills("tic_0/HILLS", hills)
+        # nothing to compare to yet
+        assert not monitor.check(10, 10, 5)
+        # a second full layer moves the profile by about 1 kJ/mol
+        _write_hills("tic_0/HILLS", hills, header=False)
+        assert not monitor.check(20, 20, 10)
+        # small hills, but no exchanges were accepted
+        _write_hills("tic_0/HILLS", [(t, c, 0.01) for t, c, h in hills], header=False)
+        assert not monitor.check(30, 30, 10)
+        _write_hills("tic_0/HILLS", [(t, c, 0.01) for t, c, h in hills], header=False)
+        assert not monitor.check(40, 40, 20)
+        _write_hills("tic_0/HILLS", [(t, c, 0.01) for t, c, h in hills], header=False)
+        assert monitor.check(50, 50, 30)
+        log = np.loadtxt("convergence.txt")
+        assert list(log[:, -1]) == [0, 0, 0, 1, 2]
+
+        profile = FreeEnergyProfile("tic_0/HILLS")
+        profile.update()
+        fe = profile.free_energy(np.linspace(-3, 3, 61))
+        assert fe.min() == 0 and fe[0] > fe[30]
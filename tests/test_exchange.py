@@ -0,0 +1,105 @@
+#!/bin/env python
+import numpy as np
+from tica_metadynamics.exchange import ExchangeScheduler, sample_permutation, \
+    AdaptiveSwapRate
+
+
+def _check_disjoint(pairs, n_replicas):
+    flat = [k for pair in pairs for k in pair]
+    assert len(flat) == len(set(flat))
+    assert all([0 <= k < n_replicas for k in flat])
+    assert all([i < j for i, j in pairs])
+
+
+def test_single_scheduler():
+    scheduler = ExchangeScheduler(5, "single", seed=42)
+    for step in range(10):
+        pairs, rnds = scheduler.get_pairs(step)
+        assert len(pairs) == 1
+        assert len(rnds) == 1
+        _check_disjoint(pairs, 5)
+
+
+def test_neighbour_scheduler():
+    scheduler = ExchangeScheduler(5, "neighbour", seed=42)
+    pairs, _ = scheduler.get_pairs(0)
+    assert pairs == [(0, 1), (2, 3)]
+    pairs, _ = scheduler.get_pairs(1)
+    assert pairs == [(1, 2), (3, 4)]
+
+
+def test_matching_scheduler():
+    scheduler = ExchangeScheduler(6, "matching", seed=42)
+    for step in range(10):
+        pairs, rnds = scheduler.get_pairs(step)
+        assert len(pairs) == 3
+        _check_disjoint(pairs, 6)
+
+
+def test_scheduler_is_reproducible():
+    s1 = ExchangeScheduler(7, "matching", seed=3)
+    s2 = ExchangeScheduler(7, "matching", seed=3)
+    for step in range(5):
+        p1, r1 = s1.get_pairs(step)
+        p2, r2 = s2.get_pairs(step)
+        assert p1 == p2
+        assert np.allclose(r1, r2)
+
+
+def test_scheduler_stream_ignores_pool():
+    # a rank that still has the old pool draws what the others draw
+    s1 = ExchangeScheduler(6, "matching", seed=3)
+    s2 = ExchangeScheduler(6, "matching", seed=3)
+    for step in range(5):
+        p1, r1 = s1.get_pairs(step)
+        p2, r2 = s2.get_pairs(step, alive=[0, 1, 3, 5] if step < 3 else None)
+        if step < 3:
+            assert not any(2 in p or 4 in p for p in p2)
+        else:
+            assert p1 == p2
+            assert np.allclose(r1, r2)
+
+
+def test_sample_permutation_is_permutation():
+    rng = np.random.RandomState(0)
+    u = rng.random_sample((9, 9))
+    for max_exact in [0, 9]:
+        perm = sample_permutation(u, max_exact=max_exact, random_state=rng)
+        assert sorted(perm) == list(range(9))
+
+
+def test_sample_permutation_follows_energies():
+    # configuration k is only favourable for replica n-1-k
+    n = 8
+    u = np.ones((n, n))*50
+    u[np.arange(n), np.arange(n)[::-1]] = 0
+    rng = np.random.RandomState(0)
+    for max_exact in [0, n]:
+        perm = sample_permutation(u, max_exact=max_exact, random_state=rng)
+        assert list(perm) == list(np.arange(n)[::-1])
+
+
+def test_sample_permutation_two_replicas():
+    # swap weight is exp(-1) relative to the identity
+    u = np.array([[0., 0.5], [0.5, 0.]])
+    rng = np.random.RandomState(0)
+    swapped = np.mean([sample_permutation(u, random_state=rng)[0] == 1
+                       for _ in range(4000)])
+    expected = np.exp(-1)/(1+np.exp(-1))
+    assert abs(swapped - expected) < 0.03
+
+
+def test_adaptive_swap_rate_balances_ranks():
+    scheduler = AdaptiveSwapRate(1000, target_acceptance=(0.2, 0.5))
+    # rank 1 is twice as fast, so it should run twice as many steps
+    steps = scheduler.update([100., 200., 100.], acceptance=0.3)
+    assert list(steps) == [1000, 2000, 1000]
+
+
+def test_adaptive_swap_rate_follows_acceptance():
+    scheduler = AdaptiveSwapRate(1000, min_swap_rate=500, max_swap_rate=1500,
+                                 target_acceptance=(0.2, 0.5), scale=2)
+    assert scheduler.update([1., 1.], acceptance=0.1)[0] == 1500
+    assert scheduler.update([1., 1.], acceptance=0.9)[0] == 750
+    assert scheduler.update([1., 1.], acceptance=0.9)[0] == 500
+    assert scheduler.update([1., 1.])[0] == 500
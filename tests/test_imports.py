@@ -0,0 +1,16 @@
+#!/bin/env python
+import sys
+import subprocess
+
+heavy_modules = ["mdtraj", "msmbuilder", "pyemma", "simtk", "openmm", "jinja2", "mpi4py"]
+
+
+def test_entry_points_import_lazily():
+    # the entry points should start without loading any of the heavy
+    # dependencies, see benchmarks/benchmark_imports.py
+    for module in ["tica_metadynamics.setup_file", "tica_metadynamics.simulate",
+                   "tica_metadynamics.post_process"]:
+        out = subprocess.check_output([sys.executable, "-c",
+                                       "import sys, %s; print([m for m in %r if m in "
+                                       "sys.modules])"%(module, heavy_modules)])
+        assert out.decode().strip() == "[]", (module, out)
@@ -0,0 +1,83 @@
+#!/bin/env python
+import os
+import shutil
+import numpy as np
+from mdtraj.utils import enter_temp_directory
+from simtk.openmm import XmlSerializer
+from simtk.unit import nanometer
+from tica_metadynamics.msm_library import write_msm_library, MSMStateLibrary, \
+    is_library_current, MSM_LIBRARY_FILE
+
+state_xml = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data",
+                         "starting_coordinates", "state0.xml")
+
+
+class _Model(object):
+    # featurizer, tica and kmeans in one: the x coordinate of atom 0,
+    # cluster 0 below 2 nm and 1 above
+    def __init__(self, step):
+        self.step = step
+        self.n_clusters = 2
+
+    def transform(self, data):
+        if self.step == "featurize":
+            return [traj.xyz[:, 0, :1] for traj in data]
+        if self.step == "tica":
+            return data
+        return [(np.asarray(x)[:, 0] > 2).astype(int) for x in data]
+
+
+class _Top(object):
+    xyz = None
+
+
+def test_msm_library():
+    with enter_temp_directory():
+        os.mkdir("msm_states")
+        with open(state_xml) as f:
+            xml = f.read()
+        shutil.copy(state_xml, "msm_states/state0.xml")
+        # a second state with atom 0 moved
+        state = XmlSerializer.deserialize(xml)
+        positions = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+        positions[0, 0] = 2.5
+        moved = state.getPositions(asNumpy=True)
+        moved[0] = positions[0]*nanometer
+        from simtk.openmm import Context, System, VerletIntegrator
+        system = System()
+        for _ in range(len(positions)):
+            system.addParticle(1.0)
+        context = Context(system, VerletIntegrator(0.001))
+        context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+        context.setPositions(moved)
+        with open("msm_states/state10.xml", 'w') as f:
+            f.write(XmlSerializer.serialize(context.getState(getPositions=True,
+                                                             getVelocities=True)))
+        shutil.copy(state_xml, "msm_states/state2.xml")
+
+        library_file = os.path.join("msm_states", MSM_LIBRARY_FILE)
+        assert not is_library_current(library_file, "msm_states")
+        write_msm_library(library_file, "msm_states", _Model("featurize"), _Model("tica"),
+                          _Model("kmeans"), top=_Top())
+        library = MSMStateLibrary(library_file)
+        assert library.names == ["state0.xml", "state2.xml", "state10.xml"]
+        assert library.positions.shape == (3, len(positions), 3)
+        assert isinstance(library.positions, np.memmap)
+        assert np.allclose(library.positions[2, 0, 0], 2.5)
+        original = XmlSerializer.deserialize(xml).getPositions(asNumpy=True)
+        assert np.allclose(library.positions[0], original.value_in_unit(nanometer),
+                           atol=1e-5)
+        assert list(library.assignments) == [0, 0, 1]
+        assert list(library.states_in_cluster(0)) == [0, 1]
+        assert list(library.states_in_cluster(1)) == [2]
+        assert len(library.states_in_cluster(5)) == 0
+        assert is_library_current(library_file, "msm_states", need_assignments=True)
+        # a state rewritten, same number of states
+        shutil.copy("msm_states/state10.xml", "msm_states/state2.xml")
+        os.utime("msm_states/state2.xml", ns=(0, 10**9))
+        assert not is_library_current(library_file, "msm_states")
+        write_msm_library(library_file, "msm_states")
+        assert np.allclose(MSMStateLibrary(library_file).positions[1, 0, 0], 2.5)
+        # a state was added
+        shutil.copy(state_xml, "msm_states/state3.xml")
+        assert not is_library_current(library_file, "msm_states")
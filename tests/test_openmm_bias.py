@@ -0,0 +1,93 @@
+#!/bin/env python
+import os
+import numpy as np
+import mdtraj as md
+from simtk.openmm import System, VerletIntegrator, Context, Platform
+from simtk.unit import nanometer
+from mdtraj.utils import enter_temp_directory
+from tica_metadynamics.plumed_writer import create_torsion_label, \
+    create_distance_label, create_angle_label, create_min_dist_label, \
+    create_mean_free_label, plumed_combine_template, render_metad_code, \
+    render_tic_wall, render_metad_bias_print
+from tica_metadynamics.openmm_bias import TicaMetadBias
+
+if os.path.isdir("tests"):
+    base_dir = os.path.abspath(os.path.join("./tests/test_data"))
+else:
+    base_dir = os.path.abspath(os.path.join("./test_data"))
+
+
+def _get_script():
+    # 0 indexed atoms, the templates take plumed's 1 indexed ones
+    output = ["RESTART\n",
+              create_torsion_label(np.array([4, 6, 8, 14])+1, "phi_1"),
+              create_torsion_label(np.array([6, 8, 14, 16])+1, "psi_1"),
+              create_distance_label(np.array([1, 18])+1, "dist_0_2"),
+              create_angle_label(np.array([4, 6, 8])+1, "angle_1"),
+              create_min_dist_label(np.array([0, 1])+1, np.array([17, 18])+1, 50, "contact_0_2"),
+              create_mean_free_label("phi_1", -1.2, "sin") + "\n",
+              create_mean_free_label("psi_1", 0.3, "cos") + "\n",
+              create_mean_free_label("dist_0_2", 0.5, None) + "\n",
+              create_mean_free_label("angle_1", 2.0, None, 1.9, 0.5) + "\n",
+              create_mean_free_label("contact_0_2.min", 0.4, "min") + "\n",
+              plumed_combine_template.render(label="tic0", periodic="NO",
+                                             arg="meanfree_sin_phi_1,meanfree_cos_psi_1,"
+                                                 "meanfree_None_dist_0_2,meanfree_None_angle_1,"
+                                                 "meanfree_min_contact_0_2",
+                                             coefficients="0.5,-0.3,1.2,0.7,-0.4") + "\n",
+              render_tic_wall("tic0", [-10, 10]),
+              render_metad_code(arg="tic0", sigma=0.2, height=2.0, biasfactor=10,
+                                pace=5, grid=[-3, 3]),
+              render_metad_bias_print(arg="tic0", stride=5)]
+    return ''.join(output)
+
+
+def _get_tic(traj):
+    phi = md.compute_dihedrals(traj, [[4, 6, 8, 14]])[0, 0]
+    psi = md.compute_dihedrals(traj, [[6, 8, 14, 16]])[0, 0]
+    dist = md.compute_distances(traj, [[1, 18]])[0, 0]
+    angle = md.compute_angles(traj, [[4, 6, 8]])[0, 0]
+    pair_dist = md.compute_distances(traj, [[0, 17], [0, 18], [1, 17], [1, 18]])[0]
+    mind = 50/np.log(np.exp(50/pair_dist).sum())
+    return 0.5*(np.sin(phi)+1.2) - 0.3*(np.cos(psi)-0.3) + 1.2*(dist-0.5) + \
+        0.7*((angle-1.9)/0.5-2.0) - 0.4*(mind-0.4)
+
+
+def _get_context(bias, traj):
+    system = System()
+    for _ in range(traj.n_atoms):
+        system.addParticle(1.0)
+    system.setDefaultPeriodicBoxVectors(*traj.unitcell_vectors[0])
+    system.addForce(bias.force)
+    context = Context(system, VerletIntegrator(0.001),
+                      Platform.getPlatformByName("Reference"))
+    context.setPositions(traj.xyz[0]*nanometer)
+    return context
+
+
+def test_tic_matches_mdtraj():
+    traj = md.load(os.path.join(base_dir, "starting_coordinates/0.pdb"))
+    traj = traj.atom_slice(range(22))
+    with enter_temp_directory():
+        bias = TicaMetadBias(_get_script())
+        context = _get_context(bias, traj)
+        assert np.allclose(bias.get_cv(context)[0], _get_tic(traj), atol=1e-4)
+
+
+def test_deposit_and_restart():
+    traj = md.load(os.path.join(base_dir, "starting_coordinates/0.pdb"))
+    traj = traj.atom_slice(range(22))
+    with enter_temp_directory():
+        bias = TicaMetadBias(_get_script())
+        context = _get_context(bias, traj)
+        assert context.getState(getEnergy=True).getPotentialEnergy()._value == 0
+        _, height = bias.deposit(context)
+        assert height == 2.0
+        energy = context.getState(getEnergy=True).getPotentialEnergy()._value
+        assert abs(energy - 2.0) < 0.05
+        _, height = bias.deposit(context)
+        assert height < 2.0
+        # plumed style hills file is replayed on restart
+        restarted = TicaMetadBias(_get_script())
+        assert len(restarted.hill_heights) == 2
+        assert np.allclose(restarted.hill_heights, bias.hill_heights, atol=1e-5)
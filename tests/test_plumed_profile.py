@@ -0,0 +1,25 @@
+#!/bin/env python
+from mdtraj.utils import enter_temp_directory
+from tica_metadynamics.plumed_profile import parse_plumed_timings
+
+_LOG = """PLUMED:                                               Cycles        Total      Average      Minumum      Maximum
+PLUMED:                                                    1     0.288312     0.288312     0.288312     0.288312
+PLUMED: 4 Calculating (forward loop)                    1001     0.156066     0.000156     0.000130     0.001082
+PLUMED: 4A  0 @0                                        1001     0.000450     0.000000     0.000000     0.000048
+PLUMED: 4A  1 phi_1_2                                   1001     0.003450     0.000003     0.000003     0.000048
+PLUMED: 4A  2 CA_0_5                                    1001     0.013450     0.000013     0.000003     0.000048
+PLUMED: 5 Applying (backward loop)                      1001     0.020130     0.000020     0.000016     0.000227
+PLUMED: 5A  1 phi_1_2                                   1001     0.001000     0.000001     0.000001     0.000008
+"""
+
+
+def test_parse_plumed_timings():
+    with enter_temp_directory():
+        with open("plumed.log", 'w') as f:
+            f.writelines(_LOG)
+        timings = parse_plumed_timings("plumed.log")
+    assert list(timings.label) == ["CA_0_5", "phi_1_2", "@0"]
+    phi = timings[timings.label == "phi_1_2"].iloc[0]
+    assert abs(phi.total - 0.00445) < 1e-9
+    assert phi.cycles == 1001
+    assert phi.action_index == 1
@@ -0,0 +1,50 @@
+#!/bin/env python
+import os
+import time
+import numpy as np
+from mdtraj.utils import enter_temp_directory
+from tica_metadynamics.profiler import PhaseTimer, summarize_timings
+
+
+def test_nested_phases_are_exclusive():
+    timer = PhaseTimer()
+    with timer.phase("exchange"):
+        time.sleep(0.02)
+        with timer.phase("energy"):
+            time.sleep(0.05)
+    timer.end_iteration(0)
+    summary = timer.summary()
+    assert summary["n_iterations"] == 1
+    assert 0.04 < summary["energy"] < 0.2
+    assert 0.01 < summary["exchange"] < 0.045
+
+
+def test_timings_file_and_summary():
+    with enter_temp_directory():
+        timer = PhaseTimer("timings.csv", flush_every=2)
+        for i in range(5):
+            with timer.phase("md"):
+                pass
+            timer.end_iteration(i)
+        timer.flush()
+        data = np.loadtxt("timings.csv", delimiter=",", skiprows=1)
+        assert data.shape[0] == 5
+        assert os.path.isfile("timings.csv")
+        # a resumed segment keeps the rows of the previous one
+        timer = PhaseTimer("timings.csv")
+        timer.end_iteration(5)
+        timer.flush()
+        data = np.loadtxt("timings.csv", delimiter=",", skiprows=1)
+        assert data.shape[0] == 6
+        assert data[-1, 0] == 5
+    report = summarize_timings({0: timer.summary(), 1: timer.summary()})
+    assert "imbalance" in report
+
+
+def test_disabled_timer_is_noop():
+    timer = PhaseTimer("should_not_exist.csv", enabled=False)
+    with timer.phase("md"):
+        pass
+    timer.end_iteration(0)
+    assert timer.summary()["n_iterations"] == 0
+    assert not os.path.isfile("should_not_exist.csv")
@@ -0,0 +1,107 @@
+#!/bin/env python
+import os
+import numpy as np
+import mdtraj as md
+from mdtraj.utils import enter_temp_directory
+from tica_metadynamics.reporters import get_atom_subset
+
+test_pdb = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data",
+                        "starting_coordinates", "0.pdb")
+
+
+def test_atom_subset():
+    top = md.load(test_pdb).topology
+    assert get_atom_subset(top, None) is None
+    solute = get_atom_subset(top, "solute")
+    assert len(solute) == md.load(test_pdb).remove_solvent().n_atoms
+    assert np.all(get_atom_subset(top, "name CA") == top.select("name CA"))
+    assert list(get_atom_subset(top, [3, 1, 1])) == [1, 3]
+    for bad in ["name XYZ", [top.n_atoms]]:
+        try:
+            get_atom_subset(top, bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("%r should have been rejected"%(bad,))
+
+
+class _State(object):
+    def __init__(self, positions, t):
+        self.positions, self.t = positions, t
+
+    def getPositions(self, asNumpy=True):
+        from simtk.unit import nanometer
+        return self.positions*nanometer
+
+    def getPeriodicBoxVectors(self, asNumpy=True):
+        from simtk.unit import nanometer
+        return np.eye(3)*3*nanometer
+
+    def getTime(self):
+        from simtk.unit import picosecond
+        return self.t*picosecond
+
+
+class _Simulation(object):
+    currentStep = 0
+
+
+def test_xtc_appends():
+    from simtk.openmm import app
+    from tica_metadynamics.reporters import SubsetTrajectoryReporter
+
+    pdb = app.PDBFile(test_pdb)
+    traj = md.load(test_pdb)
+    solute = get_atom_subset(traj.topology, "solute")
+    with enter_temp_directory():
+        # two jobs writing the same file, the second in chunks of two
+        for chunk_size, n_frames in [(1, 3), (2, 3)]:
+            reporter = SubsetTrajectoryReporter("trajectory.xtc", 10, pdb.topology,
+                                                solute, chunk_size)
+            for k in range(n_frames):
+                reporter.report(_Simulation(), _State(traj.xyz[0], k))
+            reporter.close()
+        out = md.load("trajectory.xtc", top=traj.atom_slice(solute))
+        assert out.n_frames == 6
+        assert np.allclose(out.xyz[-1], traj.xyz[0][solute], atol=1e-3)
+
+
+def test_async_reporter():
+    import time
+    from tica_metadynamics.reporters import AsyncReporter
+
+    class _SlowReporter(object):
+        def __init__(self):
+            self.frames, self.steps = [], []
+
+        def describeNextReport(self, simulation):
+            return (10, True, False, False, False)
+
+        def report(self, simulation, state):
+            time.sleep(0.01)
+            if simulation.currentStep == 666:
+                raise IOError("disk full")
+            self.frames.append(np.array(state.getPositions()._value))
+            self.steps.append(simulation.currentStep)
+
+    inner = _SlowReporter()
+    reporter = AsyncReporter(inner, 5, max_pending=2)
+    simulation = _Simulation()
+    positions = np.zeros((5, 3))
+    for k in range(6):
+        simulation.currentStep = 10*k
+        positions[:] = k
+        reporter.report(simulation, _State(positions, k))
+    reporter.flush()
+    # every frame is the copy taken at its report, not the reused buffer
+    assert inner.steps == [0, 10, 20, 30, 40, 50]
+    assert [f[0, 0] for f in inner.frames] == list(range(6))
+
+    simulation.currentStep = 666
+    reporter.report(simulation, _State(positions, 0))
+    try:
+        reporter.flush()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("the writer's error should reach the md thread")
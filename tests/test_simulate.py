@@ -0,0 +1,50 @@
+#!/bin/env python
+from tica_metadynamics.simulate import get_replica_payloads, get_launch_options
+
+
+class _MetadSim(object):
+    def __init__(self, msm_swap_scheme='random'):
+        self.base_dir = "/sims/run"
+        self.n_tics = 2
+        self.neutral_replica = True
+        self.msm_swap_folder = "msm_states"
+        self.msm_swap_scheme = msm_swap_scheme
+        self.tica_mdl = "tica"
+        self.tica_data = "data"
+        self.featurizer = "feat"
+        self.kmeans_mdl = "kmeans"
+        self.nrm = self.wt_msm_mdl = None
+        self.data_frame = "df"
+        self.plumed_dict = None
+        self.plumed_scripts_dict = None
+
+
+def test_replica_payloads():
+    metad_sim = _MetadSim()
+    payloads = get_replica_payloads(metad_sim, {0: "script_0", 1: "script_1"}, 3)
+    assert [script for _, script in payloads] == ["script_0", "script_1", None]
+    assert all(m.tica_data is None and m.tica_mdl is None for m, _ in payloads)
+    assert payloads[0][0].msm_swap_folder == "msm_states"
+    # the original is left alone
+    assert metad_sim.tica_data == "data"
+
+    payloads = get_replica_payloads(_MetadSim('tabu_list'), {0: "a", 1: "b"}, 3)
+    assert payloads[1][0].kmeans_mdl == "kmeans"
+    assert payloads[1][0].tica_data is None
+    assert payloads[2][0].kmeans_mdl is None
+
+
+def test_walker_launch_options():
+    metad_sim = _MetadSim()
+    metad_sim.walker_n = 2
+    metad_sim.walker_comm = "split"
+    options = get_launch_options(metad_sim)
+    assert options["n_walkers"] == 2 and options["walker_comm"] == "split"
+    assert options["n_replicas"] == 3
+    # the pickle in walker_k only starts that walker
+    metad_sim.walker_id = 1
+    options = get_launch_options(metad_sim)
+    assert options["n_walkers"] == 1 and options["walker_comm"] == "separate"
+    # pickles from before walker_comm
+    options = get_launch_options(_MetadSim())
+    assert options["n_walkers"] == 1 and options["walker_comm"] == "separate"
@@ -0,0 +1,34 @@
+#!/bin/env python
+import os
+from mdtraj.utils import enter_temp_directory
+from tica_metadynamics.staging import OutputStager
+
+
+def test_output_stager():
+    with enter_temp_directory():
+        os.mkdir("tic_0")
+        stager = OutputStager(os.path.abspath("tic_0"), "scratch", sync_interval=1000,
+                              head_bytes=4)
+        assert stager.scratch_dir.startswith(os.path.abspath("scratch"))
+        with open(stager.path("trajectory.dcd"), 'wb') as traj:
+            traj.write(b"0000frame1")
+            traj.flush()
+            stager.sync()
+            # readers ask for the live file without losing what was synced
+            synced = stager._files["trajectory.dcd"]["synced"]
+            assert stager.path("trajectory.dcd") == traj.name
+            assert stager._files["trajectory.dcd"]["synced"] == synced
+            # header rewritten in place, then another frame appended
+            traj.seek(0)
+            traj.write(b"0002")
+            traj.seek(0, 2)
+            traj.write(b"frame2")
+        with open(stager.path("checkpt.chk", append=False), 'wb') as f:
+            f.write(b"state")
+        with open(stager.path("speed_report.txt"), 'w') as f:
+            pass
+        stager.close()
+        assert open("tic_0/trajectory.dcd", 'rb').read() == b"0002frame1frame2"
+        assert open("tic_0/checkpt.chk", 'rb').read() == b"state"
+        assert os.path.isfile("tic_0/speed_report.txt")
+        assert not os.path.isdir(stager.scratch_dir)
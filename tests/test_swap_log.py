@@ -0,0 +1,84 @@
+#!/bin/env python
+import os
+import numpy as np
+from mdtraj.utils import enter_temp_directory
+from tica_metadynamics.swap_log import SwapLog, SwapStatistics, read_swap_log, \
+    SWAP_RECORD_DTYPE
+
+
+def _records(rows):
+    # (iteration, s_i, s_j, accepted)
+    records = np.zeros(len(rows), dtype=SWAP_RECORD_DTYPE)
+    for k, (iteration, i, j, accepted) in enumerate(rows):
+        records[k]["iteration"], records[k]["s_i"], records[k]["s_j"] = iteration, i, j
+        records[k]["accepted"] = accepted
+    return records
+
+
+def test_round_trips():
+    stats = SwapStatistics(3)
+    # configuration 0 walks up the ladder and back down
+    stats.update(_records([(0, 0, 1, 1), (1, 1, 2, 1), (2, 0, 1, 0),
+                           (3, 1, 2, 1), (4, 0, 1, 1)]), complete=True)
+    assert list(stats.permutation) == [0, 1, 2]
+    assert stats.round_trips == [5]
+    assert stats.attempted[0, 1] == 3 and stats.accepted[0, 1] == 2
+    assert np.isnan(stats.get_acceptance()[1, 0])
+
+    # gibbs: replica m gets the configuration of replica S_j
+    stats = SwapStatistics(3, permutation_moves=True)
+    stats.update(_records([(0, 0, 2, 1), (0, 1, 1, 0)]))
+    # the iteration isn't applied until all of it is there
+    assert list(stats.permutation) == [0, 1, 2]
+    stats.update(_records([(0, 2, 0, 1)]), complete=True)
+    assert list(stats.permutation) == [2, 1, 0]
+
+
+def test_swap_log():
+    for swap_log_format in ["text", "binary"]:
+        with enter_temp_directory():
+            swap_log = SwapLog(".", 2, swap_log_format, buffer_size=3)
+            # the pairwise exchange delivers records out of order
+            for iteration in [1, 0, 2, 3]:
+                swap_log.record([iteration, 0, 1, 1., 2., 1.5, 1.5, 0., 300, 0.4, 1., 1])
+            swap_log.close()
+            records = read_swap_log(swap_log.log_file)
+            assert list(records["iteration"]) == [0, 1, 2, 3]
+            assert open("swap_summary.txt").read().splitlines()[2] == "0 1"
+
+            # resuming at iteration 2 drops the later records and replays
+            # the earlier ones
+            swap_log = SwapLog(".", 2, swap_log_format, start_iteration=2)
+            assert list(read_swap_log(swap_log.log_file)["iteration"]) == [0, 1]
+            assert list(swap_log.stats.permutation) == [0, 1]
+            assert swap_log.stats.n_records == 2
+            swap_log.close()
+
+
+def test_ordered_swap_log():
+    with enter_temp_directory():
+        swap_log = SwapLog(".", 4, "binary", buffer_size=1, ordered=True)
+        row = [1., 2., 1.5, 1.5, 0., 300, 0.4, 1., 1]
+        swap_log.expect(0, [(0, 1), (2, 3)])
+        swap_log.expect(1, [(1, 2)])
+        # iteration 1 is in before iteration 0 is complete
+        swap_log.record([0, 2, 3] + row)
+        swap_log.record([1, 1, 2] + row)
+        assert not os.path.isfile(swap_log.log_file)
+        assert list(swap_log.stats.permutation) == [0, 1, 2, 3]
+        swap_log.record([0, 0, 1] + row)
+        assert list(read_swap_log(swap_log.log_file)["iteration"]) == [0, 0, 1]
+        assert list(swap_log.stats.permutation) == [1, 3, 0, 2]
+        # a pair that timed out and one whose lower replica was dropped
+        swap_log.expect(2, [(0, 1), (2, 3)])
+        swap_log.expect(3, [(0, 1)])
+        swap_log.record([3, 0, 1] + row)
+        swap_log.skip(2, 0, 1)
+        assert len(read_swap_log(swap_log.log_file)) == 3
+        swap_log.abandon([2])
+        swap_log.flush()
+        assert list(read_swap_log(swap_log.log_file)["iteration"]) == [0, 0, 1, 3]
+        # too late, iteration 2 is written
+        swap_log.record([2, 2, 3] + row)
+        swap_log.close()
+        assert swap_log.stats.n_records == 4
@@ -0,0 +1,142 @@
+#!/bin/env python
+"""
+Runs several tica_metadynamics projects side by side in one mpi job, so
+that dozens of small systems can share an allocation instead of queueing
+as many jobs that each leave some of their gpus idle.
+
+    srun -n 8 run_tica_meta_batch -f prot_a/metad_sim.pkl prot_b/metad_sim.pkl ...
+
+COMM_WORLD is split into one communicator per project. Every rank runs
+replicas of a single project, several of them if there are more replicas
+than ranks (see pack_projects), each rank on its own device as usual.
+Walkers of a walker_comm='split' or 'shared' setup are listed by their
+walker_k/metad_sim.pkl.
+"""
+import os
+import argparse
+import socket
+import numpy as np
+from .utils import get_gpu_list
+
+
+def pack_projects(n_replicas, n_ranks):
+    """
+    Spreads the replicas of every project over the ranks so that the rank
+    with the most replicas has as few as possible. A rank only ever hosts
+    replicas of one project.
+
+    :param n_replicas: replicas of every project
+    :param n_ranks: ranks in the job
+    :return: replicas per rank and the ranks of every project, ranks that
+    aren't needed are left out
+    """
+    if n_ranks < len(n_replicas):
+        raise ValueError("%d projects need at least as many ranks, got %d"
+                         %(len(n_replicas), n_ranks))
+    for replicas_per_rank in range(1, max(n_replicas) + 1):
+        ranks = [-(-n//replicas_per_rank) for n in n_replicas]
+        if sum(ranks) <= n_ranks:
+            return replicas_per_rank, ranks
+
+
+def get_project_layout(n_replicas, n_ranks):
+    """
+    :return: for every rank its project (None if idle) and the replicas per
+    rank of that project, projects get consecutive ranks
+    """
+    replicas_per_rank, ranks = pack_projects(n_replicas, n_ranks)
+    projects = []
+    for project, n in enumerate(ranks):
+        projects.extend([project]*n)
+    projects.extend([None]*(n_ranks - len(projects)))
+    return projects, replicas_per_rank
+
+
+def get_core_slice(world):
+    # ranks that share a host but weren't bound to cores by the launcher
+    # split the host's cores, otherwise openmm's CPU platform runs as many
+    # threads as there are cores on every one of them
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cores = tuple(sorted(os.sched_getaffinity(0)))
+    everybody = world.allgather((socket.gethostname(), cores))
+    neighbours = [r for r, (host, c) in enumerate(everybody)
+                  if host == everybody[world.Get_rank()][0]]
+    if any(everybody[r][1] != cores for r in neighbours) or len(cores) < len(neighbours):
+        return None
+    local_index = get_gpu_list([host for host, _ in everybody])[world.Get_rank()]
+    return set(int(c) for c in np.array_split(cores, len(neighbours))[local_index])
+
+
+def run_batch(file_locs):
+    """
+    Runs the projects of file_locs (metad_sim.pkl files) concurrently, see
+    the module docstring.
+
+    :return: the TicaSimulators this rank ran, empty if it was idle
+    """
+    from mpi4py import MPI
+    from msmbuilder.utils import load
+    from .simulate import TicaSimulator, get_launch_options, host_replicas
+    from .communicator import MPIComm
+    from .msm_library import prepare_msm_library
+    from .utils import get_gpu_index
+    world = MPI.COMM_WORLD
+    # creating a simulation changes the cwd
+    file_locs = [os.path.abspath(f) for f in file_locs]
+    layout = None
+    if world.Get_rank() == 0:
+        n_replicas = []
+        for file_loc in file_locs:
+            metad_sim = load(file_loc)
+            options = get_launch_options(metad_sim)
+            if options["n_walkers"] > 1:
+                raise ValueError("%s starts %d walkers, list their walker_k/metad_sim.pkl "
+                                 "instead"%(file_loc, options["n_walkers"]))
+            n_replicas.append(options["n_replicas"])
+            # before any replica exists, see setup_msm_swap
+            prepare_msm_library(metad_sim)
+        projects, replicas_per_rank = get_project_layout(n_replicas, world.Get_size())
+        layout = (n_replicas, projects, replicas_per_rank)
+        print("Running %d projects on %d ranks with up to %d replicas per rank"
+              %(len(file_locs), world.Get_size(), replicas_per_rank), flush=True)
+        for project, file_loc in enumerate(file_locs):
+            print("%s: ranks %s"%(file_loc, [r for r, p in enumerate(projects)
+                                            if p == project]), flush=True)
+    n_replicas, projects, replicas_per_rank = world.bcast(layout, root=0)
+    # one gpu per rank and host across the whole job
+    gpu_index = get_gpu_index(world)
+    core_slice = get_core_slice(world)
+    project = projects[world.Get_rank()]
+    comm = world.Split(MPI.UNDEFINED if project is None else project, world.Get_rank())
+    if project is None:
+        print("Rank %d has nothing to run"%world.Get_rank(), flush=True)
+        return []
+    if core_slice is not None:
+        os.sched_setaffinity(0, core_slice)
+    file_loc = file_locs[project]
+    if replicas_per_rank == 1:
+        sim_obj = TicaSimulator(file_loc, comm=MPIComm(comm), gpu_index=gpu_index,
+                                cpu_threads=len(core_slice) if core_slice else None)
+        sim_obj.run()
+        return [sim_obj]
+    return host_replicas(file_loc, n_replicas[project], replicas_per_rank,
+                         comm if comm.Get_size() > 1 else None, gpu_index)
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f','--files', dest='f', nargs='+', required=True,
+              help='metad_sim.pkl of every project')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_commandline()
+    run_batch(args.f)
+    return
+
+
+if __name__ == "__main__":
+    main()
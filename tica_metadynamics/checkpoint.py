@@ -0,0 +1,124 @@
+#!/bin/env python
+import os
+import glob
+import shutil
+import pickle
+
+# Coordinated snapshots of all replicas, kept under base_dir/checkpoints:
+#
+#   checkpoints/iteration_000040/replica_0.chk   openmm context checkpoint
+#   checkpoints/iteration_000040/replica_0.pkl   iteration, configuration, rngs ...
+#   checkpoints/iteration_000040/manifest.pkl    written last by rank 0
+#
+# Every replica writes its own files at the end of the iteration and tells
+# rank 0, which writes the manifest once all of them did. Only snapshots
+# with a manifest are ever restarted from, so a job killed half way through
+# writing one falls back to the previous snapshot.
+
+_SNAPSHOT_FOLDER = "checkpoints"
+
+
+def get_snapshot_dir(base_dir, iteration):
+    return os.path.join(base_dir, _SNAPSHOT_FOLDER, "iteration_%06d"%iteration)
+
+
+def _atomic_write(file_name, data):
+    with open(file_name + ".tmp", 'wb') as f:
+        f.write(data)
+    os.replace(file_name + ".tmp", file_name)
+    return
+
+
+def write_replica_snapshot(snapshot_dir, replica_index, checkpoint, metadata):
+    """
+    :param snapshot_dir: from get_snapshot_dir
+    :param replica_index: replica (rank) index
+    :param checkpoint: bytes from context.createCheckpoint()
+    :param metadata: picklable dictionary with whatever else the replica
+    needs to resume
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    _atomic_write(os.path.join(snapshot_dir, "replica_%d.chk"%replica_index), checkpoint)
+    _atomic_write(os.path.join(snapshot_dir, "replica_%d.pkl"%replica_index),
+                  pickle.dumps(metadata))
+    return
+
+
+def load_replica_snapshot(snapshot_dir, replica_index):
+    """
+    :return: checkpoint bytes and metadata dictionary, or None if the
+    replica has no files in this snapshot (it was dropped)
+    """
+    chk_file = os.path.join(snapshot_dir, "replica_%d.chk"%replica_index)
+    if not os.path.isfile(chk_file):
+        return None
+    with open(chk_file, 'rb') as f:
+        checkpoint = f.read()
+    with open(os.path.join(snapshot_dir, "replica_%d.pkl"%replica_index), 'rb') as f:
+        metadata = pickle.load(f)
+    return checkpoint, metadata
+
+
+def write_manifest(snapshot_dir, manifest):
+    _atomic_write(os.path.join(snapshot_dir, "manifest.pkl"), pickle.dumps(manifest))
+    return
+
+
+def find_latest_snapshot(base_dir):
+    """
+    :return: directory and manifest of the newest complete snapshot, or
+    (None, None) if there is none
+    """
+    for snapshot_dir in sorted(glob.glob(os.path.join(base_dir, _SNAPSHOT_FOLDER,
+                                                      "iteration_*")), reverse=True):
+        manifest_file = os.path.join(snapshot_dir, "manifest.pkl")
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'rb') as f:
+                return snapshot_dir, pickle.load(f)
+    return None, None
+
+
+def prune_snapshots(base_dir, keep):
+    """
+    Keeps the newest keep complete snapshots and whatever is newer than
+    those (snapshots still being written).
+    """
+    snapshot_dirs = sorted(glob.glob(os.path.join(base_dir, _SNAPSHOT_FOLDER,
+                                                  "iteration_*")), reverse=True)
+    n_complete = 0
+    for snapshot_dir in snapshot_dirs:
+        if n_complete >= keep:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+        elif os.path.isfile(os.path.join(snapshot_dir, "manifest.pkl")):
+            n_complete += 1
+    return
+
+
+def truncate_file(file_name, size):
+    # drops whatever was appended after a snapshot, e.g. hills deposited
+    # between the snapshot and the end of the previous job
+    if size is None or not os.path.isfile(file_name) or \
+            os.path.getsize(file_name) <= size:
+        return
+    print("Truncating %s to %d bytes"%(file_name, size), flush=True)
+    if size == 0:
+        # the file didn't exist yet, let it be created with its header again
+        os.remove(file_name)
+        return
+    with open(file_name, 'r+b') as f:
+        f.truncate(size)
+    return
+
+
+def truncate_swap_log(log_file, iteration):
+    # keeps the headers and the records of iterations before the snapshot
+    if not os.path.isfile(log_file):
+        return
+    with open(log_file) as f:
+        lines = f.readlines()
+    kept = [l for l in lines if l.startswith("#") or len(l.split()) == 0
+            or int(l.split()[0]) < iteration]
+    if len(kept) < len(lines):
+        with open(log_file, 'w') as f:
+            f.writelines(kept)
+    return
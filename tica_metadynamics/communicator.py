@@ -0,0 +1,370 @@
+#!/bin/env python
+import os
+import threading
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+_COMM_BACKENDS = ["mpi", "multiprocessing"]
+# how the walkers of a multiple walker setup are launched: one job each,
+# one job split into a communicator per walker, or one job and one pool
+_WALKER_COMMS = ["separate", "split", "shared"]
+
+ANY_SOURCE = -1
+ANY_TAG = -1
+
+# tags of the collectives built on point to point messages, the exchange
+# tags in exchange.py are all positive
+_COLLECTIVE_TAG = -10
+_BARRIER_TAG = -11
+# single tag used to route replica messages between processes
+_ROUTE_TAG = 99
+
+
+class Status(object):
+    """
+    Filled in by iprobe and recv, mirrors mpi4py's Status.
+    """
+    def __init__(self):
+        self.source = ANY_SOURCE
+        self.tag = ANY_TAG
+
+    def Get_source(self):
+        return self.source
+
+    def Get_tag(self):
+        return self.tag
+
+
+class Request(object):
+    # messages are buffered on send, so every request is already complete
+    def test(self):
+        return True, None
+
+    def wait(self):
+        return None
+
+
+class MPIComm(object):
+    """
+    One replica per rank on top of an mpi4py communicator. Only the status
+    and wildcard handling is translated, everything else goes straight to
+    mpi4py.
+    """
+    def __init__(self, comm=None):
+        from mpi4py import MPI
+        self._MPI = MPI
+        self.comm = comm if comm is not None else MPI.COMM_WORLD
+
+    def Get_rank(self):
+        return self.comm.Get_rank()
+
+    def Get_size(self):
+        return self.comm.Get_size()
+
+    def _translate(self, source, tag):
+        return (self._MPI.ANY_SOURCE if source == ANY_SOURCE else source,
+                self._MPI.ANY_TAG if tag == ANY_TAG else tag)
+
+    def iprobe(self, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        source, tag = self._translate(source, tag)
+        mpi_status = self._MPI.Status()
+        flag = self.comm.iprobe(source=source, tag=tag, status=mpi_status)
+        if flag and status is not None:
+            status.source, status.tag = mpi_status.Get_source(), mpi_status.Get_tag()
+        return flag
+
+    def recv(self, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        source, tag = self._translate(source, tag)
+        mpi_status = self._MPI.Status()
+        obj = self.comm.recv(source=source, tag=tag, status=mpi_status)
+        if status is not None:
+            status.source, status.tag = mpi_status.Get_source(), mpi_status.Get_tag()
+        return obj
+
+    def __getattr__(self, name):
+        # isend, gather, scatter, bcast, allgather, sendrecv, barrier,
+        # Ibarrier and Abort
+        return getattr(self.comm, name)
+
+
+class ReplicaComm(object):
+    """
+    Messaging between replicas with the lower case mpi4py api TicaSimulator
+    uses, whether the other replica lives in this process or not.
+
+    Every replica has a mailbox. Transports only need to put messages into
+    the right mailbox (_deliver) and pull in messages that arrived from
+    elsewhere (_pump); matching and the collectives are built on top of
+    that here. Messages between replicas of the same process are passed by
+    reference, so objects must not be modified after they are sent.
+    """
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+        self._mailbox = []
+        self._cond = threading.Condition()
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def _deliver(self, dest, message):
+        raise NotImplementedError
+
+    def _pump(self):
+        return
+
+    def _post(self, message):
+        with self._cond:
+            self._mailbox.append(message)
+            self._cond.notify_all()
+        return
+
+    def _match(self, source, tag):
+        # messages from one source keep their order
+        for k, (msg_source, msg_tag, _) in enumerate(self._mailbox):
+            if source in [ANY_SOURCE, msg_source] and tag in [ANY_TAG, msg_tag]:
+                return k
+        return None
+
+    def isend(self, obj, dest, tag=0):
+        self._deliver(dest, (self.rank, tag, obj))
+        return Request()
+
+    def send(self, obj, dest, tag=0):
+        self.isend(obj, dest, tag)
+        return
+
+    def iprobe(self, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        self._pump()
+        with self._cond:
+            k = self._match(source, tag)
+            if k is not None and status is not None:
+                status.source, status.tag = self._mailbox[k][:2]
+        return k is not None
+
+    def recv(self, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        while True:
+            self._pump()
+            with self._cond:
+                k = self._match(source, tag)
+                if k is not None:
+                    msg_source, msg_tag, obj = self._mailbox.pop(k)
+                    if status is not None:
+                        status.source, status.tag = msg_source, msg_tag
+                    return obj
+                self._cond.wait(0.01)
+
+    def sendrecv(self, sendobj, dest, sendtag=0, source=ANY_SOURCE, recvtag=ANY_TAG):
+        self.isend(sendobj, dest, sendtag)
+        return self.recv(source=source, tag=recvtag)
+
+    def gather(self, obj, root=0):
+        if self.rank != root:
+            self.isend(obj, root, _COLLECTIVE_TAG)
+            return None
+        return [obj if r == root else self.recv(source=r, tag=_COLLECTIVE_TAG)
+                for r in range(self.size)]
+
+    def scatter(self, data, root=0):
+        if self.rank != root:
+            return self.recv(source=root, tag=_COLLECTIVE_TAG)
+        for r in range(self.size):
+            if r != root:
+                self.isend(data[r], r, _COLLECTIVE_TAG)
+        return data[root]
+
+    def bcast(self, obj, root=0):
+        if self.rank != root:
+            return self.recv(source=root, tag=_COLLECTIVE_TAG)
+        for r in range(self.size):
+            if r != root:
+                self.isend(obj, r, _COLLECTIVE_TAG)
+        return obj
+
+    def allgather(self, obj):
+        return self.bcast(self.gather(obj, root=0), root=0)
+
+    def barrier(self):
+        self.Ibarrier().wait()
+        return
+
+    def Ibarrier(self):
+        return _BarrierRequest(self)
+
+    def Abort(self, errorcode=0):
+        os._exit(errorcode)
+
+
+class _BarrierRequest(object):
+    # everybody reports to replica 0, which releases them once all arrived
+    def __init__(self, comm):
+        self.comm = comm
+        self.done = False
+        self._arrived = 1
+        if comm.rank != 0:
+            comm.isend(None, 0, _BARRIER_TAG)
+        elif comm.size == 1:
+            self.done = True
+
+    def Test(self):
+        comm = self.comm
+        if self.done:
+            return True
+        if comm.rank != 0:
+            if comm.iprobe(source=0, tag=_BARRIER_TAG):
+                comm.recv(source=0, tag=_BARRIER_TAG)
+                self.done = True
+            return self.done
+        # one arrival per replica since every replica waits for the release
+        # before it can enter the next barrier
+        while comm.iprobe(source=ANY_SOURCE, tag=_BARRIER_TAG):
+            comm.recv(source=ANY_SOURCE, tag=_BARRIER_TAG)
+            self._arrived += 1
+        if self._arrived == comm.size:
+            for r in range(1, comm.size):
+                comm.isend(None, r, _BARRIER_TAG)
+            self.done = True
+        return self.done
+
+    def test(self):
+        return self.Test(), None
+
+    def wait(self):
+        while not self.Test():
+            with self.comm._cond:
+                self.comm._cond.wait(0.01)
+        return None
+
+
+class ThreadComm(ReplicaComm):
+    """
+    Replica endpoint for one or several replicas per process, each driven
+    by its own thread. Replicas of other processes are reached through a
+    shared _Router that forwards messages over the process transport (an
+    mpi4py communicator or a QueueTransport).
+    """
+    def __init__(self, rank, size, router):
+        super(ThreadComm, self).__init__(rank, size)
+        self.router = router
+
+    def _deliver(self, dest, message):
+        self.router.deliver(dest, message)
+        return
+
+    def _pump(self):
+        self.router.pump()
+        return
+
+    def Abort(self, errorcode=0):
+        self.router.abort(errorcode)
+
+
+class QueueTransport(object):
+    """
+    The part of mpi4py's api the _Router needs, on top of one
+    multiprocessing queue per process. Lets a group of processes started
+    by multiprocessing exchange replicas without an mpi launcher.
+
+    :param rank: index of this process
+    :param queues: inbox of every process
+    :param abort_event: multiprocessing Event the launcher watches
+    """
+    def __init__(self, rank, queues, abort_event=None):
+        self.rank = rank
+        self.queues = queues
+        self.abort_event = abort_event
+        self._pending = []
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return len(self.queues)
+
+    def isend(self, obj, dest, tag=0):
+        self.queues[dest].put((self.rank, tag, obj))
+        return Request()
+
+    def iprobe(self, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        try:
+            while True:
+                self._pending.append(self.queues[self.rank].get_nowait())
+        except Empty:
+            pass
+        return any(source in [ANY_SOURCE, s] and tag in [ANY_TAG, t]
+                   for s, t, _ in self._pending)
+
+    def recv(self, source=ANY_SOURCE, tag=ANY_TAG, status=None):
+        while not self.iprobe(source, tag):
+            self._pending.append(self.queues[self.rank].get())
+        for k, (s, t, _) in enumerate(self._pending):
+            if source in [ANY_SOURCE, s] and tag in [ANY_TAG, t]:
+                return self._pending.pop(k)[2]
+
+    def Abort(self, errorcode=0):
+        # the launcher takes down the other processes
+        if self.abort_event is not None:
+            self.abort_event.set()
+        os._exit(errorcode)
+
+
+class _Router(object):
+    def __init__(self, replica_ranks, transport=None):
+        self.replica_ranks = replica_ranks
+        self.transport = transport
+        self.process_rank = transport.Get_rank() if transport is not None else 0
+        self.endpoints = {}
+        self._requests = []
+        # the transport is only ever called by one thread at a time
+        self._lock = threading.Lock()
+
+    def deliver(self, dest, message):
+        if dest in self.endpoints:
+            self.endpoints[dest]._post(message)
+            return
+        with self._lock:
+            self._requests.append(self.transport.isend((dest, message),
+                                                      dest=self.replica_ranks[dest],
+                                                      tag=_ROUTE_TAG))
+        return
+
+    def pump(self):
+        if self.transport is None or not self._lock.acquire(False):
+            return
+        try:
+            while self.transport.iprobe(tag=_ROUTE_TAG):
+                dest, message = self.transport.recv(tag=_ROUTE_TAG)
+                self.endpoints[dest]._post(message)
+            self._requests = [req for req in self._requests if not req.test()[0]]
+        finally:
+            self._lock.release()
+        return
+
+    def abort(self, errorcode):
+        if self.transport is not None:
+            self.transport.Abort(errorcode)
+        os._exit(errorcode)
+
+
+def create_thread_comms(n_replicas, replicas_per_process, transport=None):
+    """
+    Endpoints for the replicas owned by this process. Replica r lives on
+    process r//replicas_per_process.
+
+    :param n_replicas: total number of replicas
+    :param replicas_per_process: replicas hosted by every process
+    :param transport: mpi4py communicator or QueueTransport of the
+    processes, None if all replicas live in this process
+    :return: list of ThreadComm, one per local replica
+    """
+    replica_ranks = [r//replicas_per_process for r in range(n_replicas)]
+    router = _Router(replica_ranks, transport)
+    for r in range(n_replicas):
+        if replica_ranks[r] == router.process_rank:
+            router.endpoints[r] = ThreadComm(r, n_replicas, router)
+    return [router.endpoints[r] for r in sorted(router.endpoints.keys())]
@@ -0,0 +1,166 @@
+#!/bin/env python
+import os
+import glob
+import numpy as np
+
+# written by rank 0 once the run converged, later jobs of the same run
+# (sub.sh resubmits itself) stop right away
+CONVERGED_FILE = "converged.txt"
+
+
+class HillsReader(object):
+    """
+    Reads the hills appended to a plumed HILLS file since the last call,
+    whole lines only since plumed may be in the middle of writing one.
+    Only one dimensional hills (one tic per bias) are supported.
+    """
+    def __init__(self, hills_file):
+        self.hills_file = hills_file
+        self._offset = 0
+        self._columns = None
+
+    def _parse_fields(self, line):
+        fields = line.split()[2:]
+        sigmas = [k for k, f in enumerate(fields) if f.startswith("sigma_")]
+        if len(sigmas) != 1:
+            raise ValueError("%s has %d collective variables, only one dimensional "
+                             "hills can be monitored"%(self.hills_file, len(sigmas)))
+        self._columns = (sigmas[0] - 1, sigmas[0], fields.index("height"))
+        return
+
+    def read(self):
+        """
+        :return: arrays of the new centers, sigmas and heights
+        """
+        rows = []
+        if os.path.isfile(self.hills_file):
+            if os.path.getsize(self.hills_file) < self._offset:
+                # the file was truncated (resumed from a snapshot), start over
+                self._offset = 0
+            with open(self.hills_file, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            self._offset += end
+            for line in data[:end].decode().splitlines():
+                if line.startswith("#! FIELDS"):
+                    self._parse_fields(line)
+                elif line.startswith("#") or len(line.strip()) == 0:
+                    continue
+                elif self._columns is not None:
+                    values = line.split()
+                    rows.append([float(values[c]) for c in self._columns])
+        rows = np.array(rows, dtype=float).reshape(-1, 3)
+        return rows[:, 0], rows[:, 1], rows[:, 2]
+
+
+class FreeEnergyProfile(object):
+    """
+    Free energy along one tic from the hills of every file matching
+    hills_glob (one per walker). Plumed writes well tempered heights already
+    scaled by biasf/(biasf-1), so F(s) = -sum of the gaussians as written,
+    for well tempered and plain metadynamics alike.
+    """
+    def __init__(self, hills_glob):
+        self.hills_glob = hills_glob
+        self._readers = {}
+        self.centers = np.zeros(0)
+        self.sigmas = np.zeros(0)
+        self.heights = np.zeros(0)
+
+    def update(self):
+        for hills_file in glob.glob(self.hills_glob):
+            if hills_file not in self._readers:
+                self._readers[hills_file] = HillsReader(hills_file)
+            reader = self._readers[hills_file]
+            if reader._offset > 0 and os.path.isfile(hills_file) and \
+                    os.path.getsize(hills_file) < reader._offset:
+                # truncated on resume, the hills read so far can't be told
+                # apart so read everything again
+                self._readers, self.centers = {}, np.zeros(0)
+                self.sigmas, self.heights = np.zeros(0), np.zeros(0)
+                return self.update()
+            centers, sigmas, heights = reader.read()
+            self.centers = np.concatenate([self.centers, centers])
+            self.sigmas = np.concatenate([self.sigmas, sigmas])
+            self.heights = np.concatenate([self.heights, heights])
+        return len(self.heights)
+
+    def free_energy(self, grid, n_hills=None, chunk=4096):
+        # -sum_k h_k exp(-(s-s_k)^2/2sigma_k^2), shifted to a minimum of 0
+        n_hills = len(self.heights) if n_hills is None else n_hills
+        fe = np.zeros(len(grid))
+        for start in range(0, n_hills, chunk):
+            stop = min(n_hills, start + chunk)
+            d = (grid[:, np.newaxis] - self.centers[np.newaxis, start:stop]) / \
+                self.sigmas[np.newaxis, start:stop]
+            fe -= np.exp(-0.5*d**2).dot(self.heights[start:stop])
+        return fe - fe.min()
+
+
+class ConvergenceMonitor(object):
+    """
+    Rank 0's view of how far the run is from converged. At every check the
+    free energy profile of every tic is rebuilt from the hills and compared
+    to the one of the previous check, over the range the hills cover. The
+    run has converged once, for patience checks in a row, no profile moved
+    by more than tol (kJ/mol) and the exchange acceptance since the
+    previous check was at least min_acceptance.
+
+    :param hills_globs: one HILLS file (or glob over the walkers' files) per tic
+    :param tol: largest change of a profile between checks in kJ/mol
+    :param patience: checks in a row that have to pass
+    :param min_acceptance: lowest exchange acceptance between checks
+    :param log_file: every check is appended here
+    :param n_bins: grid points of the profiles
+    """
+    def __init__(self, hills_globs, tol, patience=3, min_acceptance=0., log_file=None,
+                 n_bins=100):
+        self.profiles = [FreeEnergyProfile(g) for g in hills_globs]
+        self.tol = tol
+        self.patience = patience
+        self.min_acceptance = min_acceptance
+        self.log_file = log_file
+        self.n_bins = n_bins
+        self._previous = [0]*len(self.profiles)
+        self._passed = 0
+        self._swaps = (0, 0)
+        if log_file is not None and not os.path.isfile(log_file):
+            with open(log_file, 'w') as f:
+                f.write("#iteration\tacceptance\t%s\tpassed\n"
+                        %"\t".join("max_dF_tic%d"%i for i in range(len(self.profiles))))
+
+    def get_change(self, profile):
+        # largest change of the profile since the previous check, inf if
+        # there is nothing to compare yet
+        n_previous = self._previous[self.profiles.index(profile)]
+        if n_previous == 0 or len(profile.heights) == n_previous:
+            return np.inf if n_previous == 0 else 0.
+        grid = np.linspace(profile.centers.min(), profile.centers.max(), self.n_bins)
+        return np.abs(profile.free_energy(grid) -
+                      profile.free_energy(grid, n_previous)).max()
+
+    def check(self, iteration, n_attempted=0, n_accepted=0):
+        """
+        :param iteration: iterations done
+        :param n_attempted: exchanges attempted so far in total
+        :param n_accepted: exchanges accepted so far in total
+        :return: True once the run has converged
+        """
+        changes = []
+        for k, profile in enumerate(self.profiles):
+            profile.update()
+            changes.append(self.get_change(profile))
+            self._previous[k] = len(profile.heights)
+        attempted, accepted = n_attempted - self._swaps[0], n_accepted - self._swaps[1]
+        self._swaps = (n_attempted, n_accepted)
+        acceptance = accepted/attempted if attempted > 0 else np.nan
+        passed = max(changes) <= self.tol and \
+            (self.min_acceptance <= 0 or acceptance >= self.min_acceptance)
+        self._passed = self._passed + 1 if passed else 0
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as f:
+                f.write("%d\t%.3f\t%s\t%d\n"%(iteration, acceptance,
+                                             "\t".join("%.3f"%c for c in changes),
+                                             self._passed))
+        return self._passed >= self.patience
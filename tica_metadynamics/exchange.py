@@ -0,0 +1,235 @@
+#!/bin/env python
+import itertools
+import numpy as np
+
+_EXCHANGE_MODES = ["checkpoint", "memory", "pairwise", "gibbs"]
+_EXCHANGE_SCHEMES = ["single", "neighbour", "matching"]
+
+# mpi tags for the point to point exchange
+STATE_TAG = 11
+ENERGY_TAG = 12
+SWAP_LOG_TAG = 13
+RATE_TAG = 14
+SEGMENT_TAG = 15
+HEARTBEAT_TAG = 16
+POOL_TAG = 17
+DONE_TAG = 18
+TIMING_TAG = 19
+STARTUP_TAG = 20
+SNAPSHOT_TAG = 21
+CONVERGENCE_TAG = 22
+
+
+def get_replica_state(sim_obj):
+    """
+    Pulls the dynamical state of a simulation into plain numpy buffers so
+    that it can be shipped over the communicator without touching the disk.
+
+    :param sim_obj: openmm simulation object
+    :return: dictionary with positions, velocities, box vectors (nm, nm/ps),
+    time (ps) and the current step
+    """
+    from simtk.unit import nanometer, picosecond
+    state = sim_obj.context.getState(getPositions=True, getVelocities=True)
+    return {"positions": np.asarray(state.getPositions(asNumpy=True).
+                                    value_in_unit(nanometer)),
+            "velocities": np.asarray(state.getVelocities(asNumpy=True).
+                                     value_in_unit(nanometer/picosecond)),
+            "box_vectors": np.asarray(state.getPeriodicBoxVectors(asNumpy=True).
+                                      value_in_unit(nanometer)),
+            "time": state.getTime().value_in_unit(picosecond),
+            "step": sim_obj.currentStep}
+
+
+def set_replica_state(sim_obj, replica_state):
+    """
+    Loads a state created by get_replica_state into the simulation's context.
+    The step counter is left alone so that reporters keep their cadence.
+
+    :param sim_obj: openmm simulation object
+    :param replica_state: dictionary from get_replica_state
+    """
+    from simtk.unit import nanometer, picosecond
+    context = sim_obj.context
+    set_replica_positions(sim_obj, replica_state)
+    context.setVelocities(replica_state["velocities"]*nanometer/picosecond)
+    context.setTime(replica_state["time"]*picosecond)
+    return
+
+
+def set_replica_positions(sim_obj, replica_state):
+    """
+    Only loads the box and positions, which is all that is needed to
+    evaluate an energy.
+    """
+    from simtk.openmm import Vec3
+    from simtk.unit import nanometer
+    context = sim_obj.context
+    context.setPeriodicBoxVectors(*[Vec3(*v)*nanometer
+                                    for v in replica_state["box_vectors"]])
+    context.setPositions(replica_state["positions"]*nanometer)
+    return
+
+
+def get_swap_probability(beta, e_i_i, e_j_j, e_i_j, e_j_i):
+    """
+    Metropolis probability for swapping the states of replica i and j.
+    e_i_j is the bias energy of replica i evaluated on the state of replica j.
+    """
+    #delta e is old_energy minus new energy
+    #if new energy is lower than older energy,
+    # delta_e is large-small > 0, i.e. accept
+    delta_e = e_i_i+e_j_j - e_i_j - e_j_i
+    probability = np.min((1, np.exp(beta*delta_e)))
+    return delta_e, probability
+
+
+class ExchangeScheduler(object):
+    """
+    Picks the replica pairs to attempt at each iteration.
+
+    single: one random pair per iteration (the original behaviour)
+    neighbour: alternating even/odd sweeps over neighbouring replicas
+    matching: a random perfect matching of all replicas
+
+    Every rank builds the scheduler with the same seed, so they all agree on
+    the pairs and on the acceptance random numbers without talking.
+    """
+    def __init__(self, n_replicas, scheme="single", seed=None):
+        if scheme not in _EXCHANGE_SCHEMES:
+            raise ValueError("exchange_scheme must be one of %s"%_EXCHANGE_SCHEMES)
+        self.n_replicas = n_replicas
+        self.scheme = scheme
+        self.rng = np.random.RandomState(seed)
+
+    def get_pairs(self, iteration, alive=None):
+        """
+        :param iteration: current iteration, sets the parity of neighbour sweeps
+        :param alive: replicas still in the exchange pool, defaults to all.
+        Pairs are drawn among these only.
+        :return: list of disjoint (i, j) pairs with i<j and one uniform random
+        number per pair for the acceptance test
+        """
+        if alive is None:
+            alive = range(self.n_replicas)
+        members = sorted(int(r) for r in alive)
+        # the same draws whatever the pool, so that a rank that applies a
+        # pool change late stays on the same random stream as the others
+        order = [int(r) for r in self.rng.permutation(self.n_replicas)
+                 if r in members]
+        rnds = self.rng.random_sample(self.n_replicas//2)
+        n_members = len(members)
+        if n_members < 2:
+            return [], np.zeros(0)
+        if self.scheme == "single":
+            pairs = [order[:2]]
+        elif self.scheme == "neighbour":
+            pairs = [members[i:i+2] for i in range(iteration % 2, n_members-1, 2)]
+        else:
+            pairs = [order[k:k+2] for k in range(0, n_members-1, 2)]
+        pairs = [tuple(sorted(p)) for p in pairs]
+        return pairs, rnds[:len(pairs)]
+
+
+def sample_permutation(reduced_energies, permutation=None, n_attempts=None,
+                       max_exact=7, random_state=None):
+    """
+    Draws a new assignment of configurations to replicas from the
+    Boltzmann distribution over permutations (Gibbs sampling / infinite
+    swapping, see Chodera and Shirts, JCP 135, 194110, 2011).
+
+    :param reduced_energies: n_replicas x n_replicas array, element [m, k] is
+    beta times the bias energy of replica m evaluated on configuration k
+    :param permutation: current assignment, permutation[m] is the
+    configuration held by replica m. Defaults to the identity
+    :param n_attempts: number of pair swap attempts when not sampling
+    exactly. Defaults to n_replicas**3
+    :param max_exact: enumerate all permutations up to this many replicas
+    :param random_state: numpy RandomState
+    :return: new permutation
+    """
+    u = np.asarray(reduced_energies, dtype=float)
+    n_replicas = u.shape[0]
+    rng = random_state if random_state is not None else np.random
+    if permutation is None:
+        permutation = np.arange(n_replicas)
+    permutation = np.array(permutation)
+
+    if n_replicas <= max_exact:
+        all_perms = np.array(list(itertools.permutations(range(n_replicas))))
+        log_weights = -u[np.arange(n_replicas), all_perms].sum(axis=1)
+        weights = np.exp(log_weights - log_weights.max())
+        return all_perms[rng.choice(len(all_perms), p=weights/weights.sum())]
+
+    if n_attempts is None:
+        n_attempts = n_replicas**3
+    pairs = rng.randint(n_replicas, size=(n_attempts, 2))
+    log_rnds = np.log(rng.random_sample(n_attempts))
+    for (i, j), log_rnd in zip(pairs, log_rnds):
+        if i == j:
+            continue
+        delta = u[i, permutation[j]] + u[j, permutation[i]] \
+                - u[i, permutation[i]] - u[j, permutation[j]]
+        if log_rnd <= -delta:
+            permutation[i], permutation[j] = permutation[j], permutation[i]
+    return permutation
+
+
+class AdaptiveSwapRate(object):
+    """
+    Adjusts the exchange interval during a run.
+
+    The nominal interval (in steps of a median speed rank) grows by `scale`
+    when the running acceptance drops below the target window, since
+    attempts are then mostly wasted, and shrinks when it rises above it so
+    that well mixing replicas exchange more often. Each rank then gets its
+    own segment length, proportional to its measured speed, so that all
+    ranks reach the exchange point at the same wall-clock time.
+
+    :param swap_rate: starting nominal interval in steps
+    :param min_swap_rate: lower bound for the nominal interval
+    :param max_swap_rate: upper bound for the nominal interval
+    :param target_acceptance: [low, high] acceptance window
+    :param scale: multiplicative step for the nominal interval
+    """
+    def __init__(self, swap_rate, min_swap_rate=None, max_swap_rate=None,
+                 target_acceptance=(0.2, 0.5), scale=1.25):
+        self.swap_rate = swap_rate
+        self.min_swap_rate = min_swap_rate or max(1, swap_rate//10)
+        self.max_swap_rate = max_swap_rate or swap_rate*10
+        self.target_acceptance = target_acceptance
+        self.scale = scale
+
+    def update(self, rates, acceptance=None):
+        """
+        :param rates: measured steps per second for every rank
+        :param acceptance: running acceptance rate, None if nothing was
+        attempted since the last update
+        :return: number of md steps each rank should run per segment
+        """
+        rates = np.asarray(rates, dtype=float)
+        if acceptance is not None:
+            if acceptance < self.target_acceptance[0]:
+                self.swap_rate *= self.scale
+            elif acceptance > self.target_acceptance[1]:
+                self.swap_rate /= self.scale
+            self.swap_rate = float(np.clip(self.swap_rate, self.min_swap_rate,
+                                           self.max_swap_rate))
+        segment_time = self.swap_rate/np.median(rates)
+        return np.maximum(1, np.round(rates*segment_time)).astype(int)
+
+
+def load_acceptance(swap_log, n_records=1000):
+    """
+    Running acceptance of the last n_records attempts in a swap_log.txt
+    or swap_log.bin file, so that a restarted run does not start adapting
+    from scratch. Returns None when there is nothing to read.
+    """
+    from .swap_log import read_swap_log
+    try:
+        accepted = np.atleast_1d(read_swap_log(swap_log)["accepted"])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    if len(accepted) == 0:
+        return None
+    return accepted[-n_records:].mean()
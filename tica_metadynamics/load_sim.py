@@ -1,10 +1,10 @@
 #!/bin/env python
 import os
+import shutil
 from simtk.openmm.app import *
 from simtk.openmm import *
 from simtk.unit import *
 from msmbuilder.io import backup
-from openmmplumed import PlumedForce
 
 
 def load_sim_files(starting_dir):
@@ -15,33 +15,146 @@ def load_sim_files(starting_dir):
 
     return state, system,integrator, pdb
 
-def get_platform(platform,gpu_index=0):
+def get_platform(platform,gpu_index=0,cpu_threads=None):
     if platform=='CPU':
         platform = Platform.getPlatformByName("CPU")
         properties =dict()
+        if cpu_threads is not None:
+            properties['Threads'] = str(cpu_threads)
     else:
         platform = Platform.getPlatformByName("CUDA")
         properties = {'CudaPrecision': 'mixed', 'CudaDeviceIndex': str(gpu_index)}
     return platform, properties
 
 
+# integrators whose dynamics MTSLangevinIntegrator reproduces
+_MTS_LANGEVIN = ["LangevinIntegrator", "LangevinMiddleIntegrator"]
+
+
+def get_mts_integrator(integrator, system, force_group, bias_mts_steps):
+    """
+    Builds a multiple time step version of a deserialized integrator where
+    the bias force group is only evaluated once per outer step while every
+    other force group runs bias_mts_steps inner steps of the original size.
+    The outer step is therefore bias_mts_steps times the original step, and
+    all step counts (swap_rate, sim_save_rate, plumed pace) are in outer steps.
+
+    LangevinIntegrator and LangevinMiddleIntegrator map to
+    MTSLangevinIntegrator (OpenMM 7.6+), integrators without a thermostat to
+    the velocity Verlet based MTSIntegrator. Other thermostatted integrators
+    (Brownian, Nose-Hoover, ...) raise a ValueError.
+
+    :param integrator: integrator deserialized from integrator.xml
+    :param system: system with all forces already added
+    :param force_group: the slow (bias) force group
+    :param bias_mts_steps: inner steps per bias evaluation
+    :return: new integrator
+    """
+    fast_groups = sorted(set(f.getForceGroup() for f in system.getForces())
+                         - set([force_group]))
+    groups = [(force_group, 1)] + [(g, bias_mts_steps) for g in fast_groups]
+    outer_dt = integrator.getStepSize()*bias_mts_steps
+    name = integrator.__class__.__name__
+    if name in _MTS_LANGEVIN:
+        try:
+            from simtk.openmm import MTSLangevinIntegrator
+        except ImportError:
+            raise ValueError("bias_mts_steps with a Langevin integrator needs "
+                             "MTSLangevinIntegrator (OpenMM 7.6 or newer)")
+        mts_integrator = MTSLangevinIntegrator(integrator.getTemperature(),
+                                               integrator.getFriction(),
+                                               outer_dt, groups)
+        mts_integrator.setRandomNumberSeed(integrator.getRandomNumberSeed())
+    elif any(hasattr(integrator, a) for a in ["getFriction", "getCollisionFrequency",
+                                              "getTemperature"]):
+        # Brownian, Nose-Hoover, variable step Langevin, ... a velocity
+        # Verlet MTSIntegrator would silently drop their thermostat
+        raise ValueError("bias_mts_steps is not supported with %s, use a "
+                         "LangevinIntegrator, a LangevinMiddleIntegrator or "
+                         "a VerletIntegrator"%name)
+    else:
+        try:
+            from simtk.openmm import MTSIntegrator
+        except ImportError:
+            # older openmm only ships the python implementation
+            from simtk.openmm.mtsintegrator import MTSIntegrator
+        print("Integrator %s has no thermostat, using the velocity Verlet "
+              "MTSIntegrator"%name)
+        mts_integrator = MTSIntegrator(outer_dt, groups)
+    mts_integrator.setConstraintTolerance(integrator.getConstraintTolerance())
+    return mts_integrator
+
+
+def _add_reporters(simulation, sim_save_rate, stager=None, traj_format="dcd",
+                   traj_atoms=None, async_reporters=False, traj_chunk_size=100):
+    # with a stager the outputs go to node local scratch and are copied to
+    # the (current) replica folder in bulk, see staging.py
+    traj_file, report_file = "trajectory.%s"%traj_format, "./speed_report.txt"
+    if stager is not None:
+        # xtc only ever grows, hdf5 rewrites its index and is copied whole
+        traj_file = stager.path(traj_file, append=traj_format != "h5")
+        report_file = stager.path("speed_report.txt")
+    f = open(report_file,'w')
+    if traj_format == "dcd":
+        backup("trajectory.dcd")
+        traj_reporter = app.DCDReporter(traj_file, sim_save_rate)
+    else:
+        # appended to across restarts, see reporters.py
+        from .reporters import SubsetTrajectoryReporter, get_atom_subset
+        import mdtraj as md
+        atom_indices = get_atom_subset(md.Topology.from_openmm(simulation.topology),
+                                       traj_atoms)
+        if stager is not None and os.path.isfile("trajectory.%s"%traj_format):
+            shutil.copyfile("trajectory.%s"%traj_format, traj_file)
+        traj_reporter = SubsetTrajectoryReporter(traj_file, sim_save_rate,
+                                                 simulation.topology, atom_indices,
+                                                 traj_chunk_size)
+    reporters = [traj_reporter,
+                 app.StateDataReporter(f, 1000, step=True,\
+                                potentialEnergy=True, temperature=True, progress=True, remainingTime=True,\
+                                speed=True, totalSteps=200*100, separator='\t')]
+    if async_reporters:
+        # written from a background thread, see reporters.py
+        from .reporters import AsyncReporter
+        n_atoms = simulation.system.getNumParticles()
+        reporters = [AsyncReporter(r, n_atoms) for r in reporters]
+    simulation.reporters.extend(reporters)
+    return
+
+
 def create_simulation(base_dir, starting_dir,
                       gpu_index,tic_index,
                       plumed_script,
                       sim_save_rate,
-                      platform):
+                      platform,
+                      bias_mts_steps=1,
+                      bias_backend="plumed",
+                      cpu_threads=None,
+                      stager=None,
+                      traj_format="dcd",
+                      traj_atoms=None,
+                      async_reporters=False,
+                      traj_chunk_size=100):
     print("Creating simulation for tic %d"%tic_index)
     os.chdir((os.path.join(base_dir,"tic_%d"%tic_index)))
 
     state, system, integrator, pdb = load_sim_files(starting_dir)
     with open("./plumed_script.dat",'w') as f:
         f.writelines(plumed_script)
-    new_f = PlumedForce(str(plumed_script))
+    if bias_backend == "openmm":
+        from .openmm_bias import TicaMetadBias
+        bias = TicaMetadBias(str(plumed_script))
+        new_f = bias.force
+    else:
+        from openmmplumed import PlumedForce
+        new_f = PlumedForce(str(plumed_script))
     force_group = 30
     new_f.setForceGroup(force_group)
     system.addForce(new_f)
+    if bias_mts_steps > 1:
+        integrator = get_mts_integrator(integrator, system, force_group, bias_mts_steps)
 
-    platform, properties = get_platform(platform,gpu_index)
+    platform, properties = get_platform(platform,gpu_index,cpu_threads)
     simulation = app.Simulation(pdb.topology, system, integrator, platform, properties)
 
     if os.path.isfile("./checkpt.chk"):
@@ -49,25 +162,34 @@ def create_simulation(base_dir, starting_dir,
             simulation.context.loadCheckpoint(f.read())
     else:
         simulation.context.setState(state)
+    if bias_backend == "openmm":
+        # push hills read back on restart and start depositing
+        bias.update_context(simulation.context)
+        simulation.reporters.append(bias.create_reporter())
     print("Done creating simulation for tic %d"%tic_index)
 
-    f = open("./speed_report.txt",'w')
-    backup("trajectory.dcd")
-    simulation.reporters.append(app.DCDReporter('trajectory.dcd', sim_save_rate))
-    simulation.reporters.append(app.StateDataReporter(f, 1000, step=True,\
-                                potentialEnergy=True, temperature=True, progress=True, remainingTime=True,\
-                                speed=True, totalSteps=200*100, separator='\t'))
-
+    _add_reporters(simulation, sim_save_rate, stager, traj_format, traj_atoms,
+                   async_reporters, traj_chunk_size)
     return simulation, force_group
 
 def create_neutral_simulation(base_dir, starting_dir,
                               gpu_index,
                               sim_save_rate,
-                              platform):
+                              platform,
+                              bias_mts_steps=1,
+                              cpu_threads=None,
+                              stager=None,
+                              traj_format="dcd",
+                              traj_atoms=None,
+                              async_reporters=False,
+                              traj_chunk_size=100):
     print("Creating simulation for neutral_replica")
     os.chdir((os.path.join(base_dir,"neutral_replica")))
     state, system, integrator, pdb = load_sim_files(starting_dir)
-    platform, properties = get_platform(platform,gpu_index)
+    if bias_mts_steps > 1:
+        # same outer step as the biased replicas, the bias group stays empty
+        integrator = get_mts_integrator(integrator, system, 30, bias_mts_steps)
+    platform, properties = get_platform(platform,gpu_index,cpu_threads)
     simulation = app.Simulation(pdb.topology, system, integrator,
                                 platform, properties)
 
@@ -78,11 +200,6 @@ def create_neutral_simulation(base_dir, starting_dir,
         simulation.context.setState(state)
     print("Done creating simulation neutral_replica")
 
-    f = open("./speed_report.txt",'w')
-    backup("trajectory.dcd")
-    simulation.reporters.append(app.DCDReporter('trajectory.dcd', sim_save_rate))
-    simulation.reporters.append(app.StateDataReporter(f, 1000, step=True,\
-                                potentialEnergy=True, temperature=True, progress=True, remainingTime=True,\
-                                speed=True, totalSteps=200*100, separator='\t'))
-
+    _add_reporters(simulation, sim_save_rate, stager, traj_format, traj_atoms,
+                   async_reporters, traj_chunk_size)
     return simulation
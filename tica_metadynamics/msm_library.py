@@ -0,0 +1,280 @@
+#!/bin/env python
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+import threading
+import numpy as np
+
+# written next to the state*.xml files of msm_swap_folder
+MSM_LIBRARY_FILE = "msm_states.lib"
+
+_MAGIC = b"TMSMLIB1"
+_ALIGN = 64
+
+# swap schemes that need the msm state of every library state
+_MODEL_SCHEMES = ['tabu_list', 'min_count', 'wt_msm']
+
+
+def _keynat(name):
+    # state2.xml before state10.xml
+    import re
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+
+def get_source_fingerprint(swap_folder):
+    # names, sizes and modification times of the state*.xml files, a state
+    # that was rewritten changes it as well as one that was added
+    digest = hashlib.sha1()
+    for fname in sorted(glob.glob(os.path.join(swap_folder, "state*.xml"))):
+        st = os.stat(fname)
+        digest.update(("%s %d %d\n"%(os.path.basename(fname), st.st_size,
+                                      st.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+def assign_states(positions, top, featurizer, tica_mdl, kmeans_mdl, nrm=None):
+    """
+    tica coordinates and msm states of some configurations, the way
+    setup_msm_swap always did it: one frame at a time through the
+    featurizer, the optional normalizer, tica and kmeans.
+
+    :param positions: (n_states, n_atoms, 3) in nm
+    :param top: mdtraj trajectory of the whole system, its xyz is overwritten
+    :return: (n_states, n_tics) tica coordinates and (n_states,) states
+    """
+    tica, assignments = [], []
+    for xyz in positions:
+        top.xyz = np.array(xyz, dtype=np.float32)[np.newaxis]
+        features = featurizer.transform([top])
+        if nrm is not None:
+            features = [nrm.transform(features[0])]
+        tica_coords = tica_mdl.transform(features)
+        tica.append(np.asarray(tica_coords[0][0], dtype=np.float32))
+        assignments.append(kmeans_mdl.transform(tica_coords)[0][0])
+    return np.array(tica, dtype=np.float32), np.array(assignments, dtype=np.int32)
+
+
+def write_msm_library(library_file, swap_folder, featurizer=None, tica_mdl=None,
+                      kmeans_mdl=None, nrm=None, top=None):
+    """
+    Packs the state*.xml files of swap_folder into one file that
+    MSMStateLibrary maps into memory. With the models (and top, the
+    mdtraj trajectory of the system) the tica coordinates and msm states
+    of every state are computed once and stored as well.
+
+    :return: number of states
+    """
+    from simtk.openmm import XmlSerializer
+    from simtk.unit import nanometer, picosecond
+    # taken first, a state written while packing makes the library stale
+    source = get_source_fingerprint(swap_folder)
+    flist = sorted(glob.glob(os.path.join(swap_folder, "state*.xml")),
+                   key=lambda f: _keynat(os.path.basename(f)))
+    if len(flist) == 0:
+        raise ValueError("No state*.xml files in %s"%swap_folder)
+    positions, velocities, box_vectors = [], [], []
+    has_velocities = True
+    for fname in flist:
+        with open(fname) as f:
+            state = XmlSerializer.deserialize(f.read())
+        positions.append(state.getPositions(asNumpy=True).value_in_unit(nanometer))
+        try:
+            velocities.append(state.getVelocities(asNumpy=True).
+                              value_in_unit(nanometer/picosecond))
+        except Exception:
+            # the state was serialized without them
+            has_velocities = False
+        box_vectors.append(state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(nanometer))
+    arrays = {"positions": np.array(positions, dtype=np.float32),
+              "box_vectors": np.array(box_vectors, dtype=np.float64)}
+    if has_velocities:
+        arrays["velocities"] = np.array(velocities, dtype=np.float32)
+    if kmeans_mdl is not None:
+        arrays["tica"], arrays["assignments"] = assign_states(arrays["positions"], top,
+                                                              featurizer, tica_mdl,
+                                                              kmeans_mdl, nrm)
+        # states of every cluster are order[offsets[c]:offsets[c+1]]
+        n_clusters = max(int(arrays["assignments"].max()) + 1,
+                         getattr(kmeans_mdl, "n_clusters", 0))
+        arrays["cluster_order"] = np.argsort(arrays["assignments"], kind="stable").\
+            astype(np.int32)
+        arrays["cluster_offsets"] = np.concatenate(
+            [[0], np.cumsum(np.bincount(arrays["assignments"], minlength=n_clusters))]).\
+            astype(np.int64)
+    header = {"n_states": len(flist), "names": [os.path.basename(f) for f in flist],
+              "source": source, "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": array.shape,
+                                  "offset": offset}
+        offset += -(-array.nbytes//_ALIGN)*_ALIGN
+    encoded = json.dumps(header).encode()
+    data_start = -(-(len(_MAGIC) + 8 + len(encoded))//_ALIGN)*_ALIGN
+    # walkers of a split job may pack the same folder at once
+    tmp_file = "%s.%d.%d.tmp"%(library_file, os.getpid(), threading.get_ident())
+    with open(tmp_file, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(np.uint64(len(encoded)).tobytes())
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_file, library_file)
+    return len(flist)
+
+
+class MSMStateLibrary(object):
+    """
+    The msm states to swap replicas with, packed by write_msm_library. The
+    arrays are memory mapped, nothing is read until a state is used and
+    the replicas on a node share the pages.
+
+    positions and velocities (float32, nm and nm/ps), box_vectors and, if
+    the library was written with the models, tica, assignments and the
+    per cluster index are attributes, names are the original file names.
+
+    :param library_file: file written by write_msm_library
+    """
+    def __init__(self, library_file):
+        self.library_file = library_file
+        with open(library_file, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError("%s is not an msm state library"%library_file)
+            header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_length).decode())
+        data_start = -(-(len(_MAGIC) + 8 + header_length)//_ALIGN)*_ALIGN
+        self.n_states = header["n_states"]
+        self.names = header["names"]
+        # fingerprint of the xmls it was packed from
+        self.source = header.get("source")
+        self.positions = self.velocities = self.tica = self.assignments = None
+        self.cluster_order = self.cluster_offsets = None
+        for name, info in header["arrays"].items():
+            setattr(self, name, np.memmap(library_file, dtype=np.dtype(info["dtype"]),
+                                          mode='r', offset=data_start + info["offset"],
+                                          shape=tuple(info["shape"])))
+
+    def __len__(self):
+        return self.n_states
+
+    def states_in_cluster(self, cluster):
+        # indices of the states assigned to an msm state
+        if self.cluster_offsets is None or cluster + 1 >= len(self.cluster_offsets):
+            return np.zeros(0, dtype=np.int32)
+        return self.cluster_order[self.cluster_offsets[cluster]:
+                                  self.cluster_offsets[cluster + 1]]
+
+    def get_state(self, index):
+        # in the form of exchange.get_replica_state, without time and step
+        state = {"positions": self.positions[index],
+                 "box_vectors": self.box_vectors[index]}
+        if self.velocities is not None:
+            state["velocities"] = self.velocities[index]
+        return state
+
+    def set_state(self, sim_obj, index):
+        """
+        Loads state index into the simulation, the time is left alone.
+        """
+        from simtk.unit import nanometer, picosecond
+        from .exchange import set_replica_positions
+        state = self.get_state(index)
+        set_replica_positions(sim_obj, state)
+        if "velocities" in state:
+            sim_obj.context.setVelocities(state["velocities"]*nanometer/picosecond)
+        return
+
+
+def get_msm_library_file(swap_folder):
+    # msm_swap_folder is either the library itself or the folder of xmls
+    if os.path.isfile(swap_folder):
+        return swap_folder
+    return os.path.join(swap_folder, MSM_LIBRARY_FILE)
+
+
+def is_library_current(library_file, swap_folder, need_assignments=False):
+    # written from the xmls as they are now, with the msm states if needed
+    if not os.path.isfile(library_file):
+        return False
+    if os.path.isfile(swap_folder):
+        return True
+    library = MSMStateLibrary(library_file)
+    return library.source == get_source_fingerprint(swap_folder) and \
+        (library.assignments is not None or not need_assignments)
+
+
+def _get_models(metad_sim):
+    import mdtraj as md
+    return {"featurizer": metad_sim.featurizer, "tica_mdl": metad_sim.tica_mdl,
+            "kmeans_mdl": metad_sim.kmeans_mdl, "nrm": metad_sim.nrm,
+            "top": md.load(os.path.join(metad_sim.starting_coordinates_folder, "0.pdb"))}
+
+
+def prepare_msm_library(metad_sim):
+    """
+    Packs metad_sim.msm_swap_folder unless its library is current, with the
+    msm states if the swap scheme needs them. The launchers call it once
+    before any replica is created.
+
+    :return: library file, None without msm swaps
+    """
+    swap_folder = getattr(metad_sim, "msm_swap_folder", None)
+    if swap_folder is None:
+        return None
+    library_file = get_msm_library_file(swap_folder)
+    uses_models = metad_sim.msm_swap_scheme in _MODEL_SCHEMES
+    if not is_library_current(library_file, swap_folder, uses_models):
+        print("Packing the states of %s into %s"%(swap_folder, library_file), flush=True)
+        write_msm_library(library_file, swap_folder,
+                          **(_get_models(metad_sim) if uses_models else {}))
+    return library_file
+
+
+def wait_for_msm_library(library_file, swap_folder, need_assignments=False):
+    # for replicas while another one packs the library, nothing collective
+    # since the replicas of a process are created one after the other
+    while not is_library_current(library_file, swap_folder, need_assignments):
+        time.sleep(1)
+    return
+
+
+_open_libraries = {}
+
+
+def load_msm_library(library_file):
+    # one mapping per process, however many replicas it hosts
+    if library_file not in _open_libraries:
+        _open_libraries[library_file] = MSMStateLibrary(library_file)
+    return _open_libraries[library_file]
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i','--input', dest='i', required=True,
+              help='folder with the state*.xml files')
+    parser.add_argument('-o','--output', dest='o', default=None,
+              help='library file, defaults to %s in the input folder'%MSM_LIBRARY_FILE)
+    parser.add_argument('-f','--file', dest='f', default=None,
+              help='metad_sim.pkl whose featurizer, tica and kmeans models assign '
+                   'the states (needed by the tabu_list, min_count and wt_msm schemes)')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_commandline()
+    output = args.o or os.path.join(args.i, MSM_LIBRARY_FILE)
+    models = {}
+    if args.f is not None:
+        from msmbuilder.utils import load
+        models = _get_models(load(args.f))
+    n_states = write_msm_library(output, args.i, **models)
+    print("Wrote %d states to %s"%(n_states, output), flush=True)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#!/bin/env python
+import os
+import re
+import numpy as np
+
+# openmm is imported where the forces are built so that setup_sim can read
+# _BIAS_BACKENDS without loading it
+_BIAS_BACKENDS = ["plumed", "openmm"]
+
+# kJ/mol/K, the same units plumed uses
+_KB = 0.0083144626
+
+
+def parse_plumed_script(plumed_script):
+    """
+    Splits a script rendered by plumed_writer into (action, keywords) tuples.
+    Flags without a value (like RESTART) end up with an empty dictionary.
+    """
+    actions = []
+    for line in plumed_script.splitlines():
+        tokens = line.split()
+        if len(tokens) == 0 or tokens[0].startswith("#"):
+            continue
+        keywords = dict(t.split("=", 1) for t in tokens[1:] if "=" in t)
+        actions.append((tokens[0], keywords))
+    return actions
+
+
+def get_variable_name(label):
+    # plumed labels can contain dots and start with digits, lepton names can't
+    return "cv_" + re.sub(r"\W", "_", label)
+
+
+def _get_atoms(keywords, key="ATOMS"):
+    # plumed is 1 indexed, openmm 0 indexed
+    return [int(i)-1 for i in keywords[key].split(",")]
+
+
+def create_cv_force(action, keywords):
+    """
+    Builds the openmm force whose energy is the value of a single raw plumed
+    feature. Returns None for actions that are not raw features.
+    """
+    from simtk.openmm import CustomBondForce, CustomAngleForce, CustomTorsionForce
+    if action == "DISTANCE":
+        force = CustomBondForce("r")
+        force.addBond(*_get_atoms(keywords))
+    elif action == "ANGLE":
+        force = CustomAngleForce("theta")
+        force.addAngle(*_get_atoms(keywords))
+    elif action == "TORSION":
+        force = CustomTorsionForce("theta")
+        force.addTorsion(*_get_atoms(keywords))
+    elif action == "DISTANCES":
+        # MIN={BETA=b} is the smooth minimum b/log(sum(exp(b/r))), the force
+        # only holds the sum so that the log is taken once in the expression
+        beta = float(re.search(r"BETA=([^}]+)", keywords["MIN"]).group(1))
+        force = CustomBondForce("exp(%s/r)"%beta)
+        for i in _get_atoms(keywords, "GROUPA"):
+            for j in _get_atoms(keywords, "GROUPB"):
+                force.addBond(i, j)
+    elif action == "RMSD":
+        raise ValueError("RMSD (landmark) features are only supported by "
+                         "the plumed backend")
+    else:
+        return None
+    force.setUsesPeriodicBoundaryConditions(True)
+    return force
+
+
+class TicaMetadBias(object):
+    """
+    Well tempered metadynamics on the tICA coordinates computed entirely
+    inside the openmm context.
+
+    The plumed script rendered by plumed_writer is compiled into a nested
+    CustomCVForce. Raw features become collective variables of one
+    CustomCVForce per tic whose energy is the tic value, the mean free
+    transforms and the COMBINE coefficients become its expression. The outer
+    force adds the walls and a tabulated grid bias on the tics. Hills are
+    deposited on that grid by a reporter every PACE steps, so the simulation
+    loop keeps calling simulation.step as usual.
+
+    Hills are written to the same HILLS file plumed would write (and read
+    back on restart), so the plumed based post processing still works.
+
+    :param plumed_script: script rendered by plumed_writer
+    :param restart: replay an existing hills file into the grid
+    """
+    def __init__(self, plumed_script, restart=True):
+        self.actions = parse_plumed_script(plumed_script)
+        self.bias_file = None
+        self.bias_stride = None
+        self._factories = {}
+        self._expressions = {}
+        metad = None
+        walls = []
+        for action, keywords in self.actions:
+            label = keywords.get("LABEL")
+            if action in ["DISTANCE", "ANGLE", "TORSION", "DISTANCES", "RMSD"]:
+                # test build so that unsupported features fail early
+                create_cv_force(action, keywords)
+                name = get_variable_name(label)
+                self._factories[name] = (action, keywords)
+                if action == "DISTANCES":
+                    beta = re.search(r"BETA=([^}]+)", keywords["MIN"]).group(1)
+                    self._expressions[label + ".min"] = "(%s/log(%s))"%(beta, name)
+                else:
+                    self._expressions[label] = name
+            elif action == "MATHEVAL":
+                arg = "(%s)"%self._expressions[keywords["ARG"]]
+                self._expressions[label] = "(%s)"%re.sub(r"\bx\b", arg, keywords["FUNC"])
+            elif action == "COMBINE":
+                args = keywords["ARG"].split(",")
+                coefficients = keywords["COEFFICIENTS"].split(",")
+                self._expressions[label] = "+".join(["(%s)*%s"%(c, self._expressions[a])
+                                                     for a, c in zip(args, coefficients)])
+            elif action in ["LOWER_WALLS", "UPPER_WALLS"]:
+                walls.append((action, keywords))
+            elif action == "METAD":
+                metad = keywords
+            elif action == "PRINT":
+                self.bias_file = os.path.abspath(keywords.get("FILE", "COLVAR"))
+                self.bias_stride = int(keywords.get("STRIDE", 0)) or None
+                self.print_args = keywords["ARG"].split(",")
+            elif action not in ["RESTART", "DEBUG"]:
+                raise ValueError("Plumed action %s is not supported by the "
+                                 "openmm backend"%action)
+        if metad is None:
+            raise ValueError("No METAD action found in the plumed script")
+        if "WALKERS_N" in metad:
+            raise ValueError("Multiple walkers are only supported by the plumed backend")
+        if "GRID_MIN" not in metad:
+            raise ValueError("The openmm backend needs a grid, set grid=True")
+
+        self.label = metad["LABEL"]
+        self.args = metad["ARG"].split(",")
+        n_dims = len(self.args)
+        if n_dims > 3:
+            raise ValueError("The openmm backend supports up to 3 biased tics")
+        self.sigma = np.array(metad["SIGMA"].split(","), dtype=float)
+        self.height = float(metad["HEIGHT"])
+        self.temp = float(metad["TEMP"])
+        self.pace = int(metad["PACE"])
+        # resolved now, replicas sharing a process also share the cwd
+        self.hills_file = os.path.abspath(metad.get("FILE", "HILLS"))
+        self.biasfactor = float(metad["BIASFACTOR"]) if "BIASFACTOR" in metad else None
+        self.interval = None
+        if "INTERVAL" in metad and "," in metad["INTERVAL"]:
+            self.interval = np.array(metad["INTERVAL"].split(","), dtype=float)
+
+        # same default bin width as plumed, a fifth of sigma
+        self.grid_min = np.array(metad["GRID_MIN"].split(","), dtype=float)
+        self.grid_max = np.array(metad["GRID_MAX"].split(","), dtype=float)
+        n_bins = np.ceil((self.grid_max-self.grid_min)/(self.sigma/5.)).astype(int)
+        self.grid_points = [np.linspace(lo, hi, n+1) for lo, hi, n in
+                            zip(self.grid_min, self.grid_max, n_bins)]
+        self.grid = np.zeros([len(p) for p in self.grid_points])
+        self.hills = np.zeros((0, n_dims))
+        self.hill_heights = np.zeros(0)
+
+        self.force = self.create_force(walls)
+        if restart and os.path.isfile(self.hills_file):
+            self.load_hills(self.hills_file)
+        self._hills_out = None
+        self._bias_out = None
+
+    def create_tic_force(self, tic_label):
+        from simtk.openmm import CustomCVForce
+        expression = self._expressions[tic_label]
+        force = CustomCVForce(expression)
+        for name in sorted(set(re.findall(r"cv_\w+", expression))):
+            force.addCollectiveVariable(name, create_cv_force(*self._factories[name]))
+        return force
+
+    def create_force(self, walls):
+        from simtk.openmm import CustomCVForce
+        terms = []
+        definitions = []
+        for d, arg in enumerate(self.args):
+            lo, hi = self.grid_min[d], self.grid_max[d]
+            if self.interval is not None:
+                lo, hi = max(lo, self.interval[0]), min(hi, self.interval[1])
+            definitions.append("s%d=min(max(%s,%s),%s)"%(d, get_variable_name(arg), lo, hi))
+        terms.append("metad_bias(%s)"%",".join(["s%d"%d for d in range(len(self.args))]))
+        for action, keywords in walls:
+            arg = get_variable_name(keywords["ARG"])
+            at, offset = float(keywords["AT"]), float(keywords.get("OFFSET", 0))
+            if action == "LOWER_WALLS":
+                scaled = "(%s-%s)/%s"%(at+offset, arg, keywords.get("EPS", 1))
+            else:
+                scaled = "(%s-%s)/%s"%(arg, at-offset, keywords.get("EPS", 1))
+            terms.append("step(%s)*%s*(%s)^%s"%(scaled, keywords["KAPPA"], scaled,
+                                                keywords.get("EXP", 2)))
+        force = CustomCVForce(";".join(["+".join(terms)] + definitions))
+        tics = set(self.args + [keywords["ARG"] for _, keywords in walls])
+        for arg in self.args + sorted(tics - set(self.args)):
+            force.addCollectiveVariable(get_variable_name(arg), self.create_tic_force(arg))
+        self.table = self._create_table()
+        force.addTabulatedFunction("metad_bias", self.table)
+        return force
+
+    def _table_parameters(self):
+        # openmm wants x to vary fastest
+        values = self.grid.ravel(order='F')
+        sizes = list(self.grid.shape)
+        limits = [v for lo_hi in zip(self.grid_min, self.grid_max) for v in lo_hi]
+        if self.grid.ndim == 1:
+            return [values] + limits
+        return sizes + [values] + limits
+
+    def _create_table(self):
+        from simtk.openmm import Continuous1DFunction, Continuous2DFunction, \
+            Continuous3DFunction
+        table_class = [Continuous1DFunction, Continuous2DFunction,
+                       Continuous3DFunction][self.grid.ndim-1]
+        return table_class(*self._table_parameters())
+
+    def get_cv(self, context):
+        return np.array(self.force.getCollectiveVariableValues(context))[:len(self.args)]
+
+    def get_bias(self, cv):
+        # exact sum of the hills rather than the interpolated grid
+        if len(self.hill_heights) == 0:
+            return 0.0
+        if self.interval is not None:
+            cv = np.clip(cv, self.interval[0], self.interval[1])
+        exponent = (((self.hills - cv)/self.sigma)**2).sum(axis=1)/2.
+        return float((self.hill_heights*np.exp(-exponent)).sum())
+
+    def add_hill(self, cv, height):
+        if self.interval is not None:
+            cv = np.clip(cv, self.interval[0], self.interval[1])
+        self.hills = np.vstack([self.hills, cv])
+        self.hill_heights = np.append(self.hill_heights, height)
+        mesh = np.meshgrid(*self.grid_points, indexing='ij')
+        exponent = sum(((m-c)/s)**2 for m, c, s in zip(mesh, cv, self.sigma))/2.
+        self.grid += height*np.exp(-exponent)
+        return
+
+    def deposit(self, context):
+        """
+        Adds a (well tempered) hill at the current tic values and pushes the
+        new grid to the context.
+        """
+        from simtk.unit import picosecond
+        cv = self.get_cv(context)
+        height = self.height
+        if self.biasfactor is not None:
+            height *= np.exp(-self.get_bias(cv)/(_KB*self.temp*(self.biasfactor-1)))
+        self.add_hill(cv, height)
+        self.update_context(context)
+        time = context.getState().getTime().value_in_unit(picosecond)
+        self.write_hill(time, cv, height)
+        return cv, height
+
+    def update_context(self, context):
+        self.table.setFunctionParameters(*self._table_parameters())
+        self.force.updateParametersInContext(context)
+        return
+
+    def write_hill(self, time, cv, height):
+        if self._hills_out is None:
+            new_file = not os.path.isfile(self.hills_file)
+            self._hills_out = open(self.hills_file, 'a')
+            if new_file:
+                fields = ["time"] + self.args + ["sigma_%s"%a for a in self.args] + ["height"]
+                if self.biasfactor is not None:
+                    fields.append("biasf")
+                self._hills_out.writelines("#! FIELDS %s\n"%" ".join(fields))
+                self._hills_out.writelines("#! SET multivariate false\n")
+        # plumed stores well tempered heights rescaled by biasf/(biasf-1)
+        row = [time] + list(cv) + list(self.sigma)
+        if self.biasfactor is not None:
+            row += [height*self.biasfactor/(self.biasfactor-1), self.biasfactor]
+        else:
+            row += [height]
+        self._hills_out.writelines(" ".join(["%.6f"%v for v in row]) + "\n")
+        self._hills_out.flush()
+        return
+
+    def load_hills(self, hills_file):
+        hills = np.loadtxt(hills_file, comments="#", ndmin=2)
+        n_dims = len(self.args)
+        for row in hills:
+            height = row[1+2*n_dims]
+            if self.biasfactor is not None:
+                height *= (self.biasfactor-1)/self.biasfactor
+            self.add_hill(row[1:1+n_dims], height)
+        print("Read %d hills from %s"%(len(hills), hills_file), flush=True)
+        return
+
+    def write_bias(self, context):
+        from simtk.unit import picosecond
+        if self._bias_out is None:
+            self._bias_out = open(self.bias_file, 'a')
+            self._bias_out.writelines("#! FIELDS time %s\n"%" ".join(self.print_args))
+        cv = self.get_cv(context)
+        values = {a: c for a, c in zip(self.args, cv)}
+        values["%s.bias"%self.label] = self.get_bias(cv)
+        time = context.getState().getTime().value_in_unit(picosecond)
+        self._bias_out.writelines(" ".join(["%.6f"%time] + ["%.6f"%values.get(a, 0.0)
+                                                            for a in self.print_args]) + "\n")
+        self._bias_out.flush()
+        return
+
+    def create_reporter(self):
+        return MetadReporter(self)
+
+
+class MetadReporter(object):
+    """
+    Deposits hills every PACE steps and writes the bias file every STRIDE
+    steps for a TicaMetadBias.
+    """
+    def __init__(self, bias):
+        self.bias = bias
+
+    def _intervals(self):
+        intervals = [self.bias.pace]
+        if self.bias.bias_file is not None and self.bias.bias_stride is not None:
+            intervals.append(self.bias.bias_stride)
+        return intervals
+
+    def describeNextReport(self, simulation):
+        steps = min([i - simulation.currentStep % i for i in self._intervals()])
+        return (steps, False, False, False, False)
+
+    def report(self, simulation, state):
+        step = simulation.currentStep
+        if step % self.bias.pace == 0:
+            self.bias.deposit(simulation.context)
+        if self.bias.bias_stride is not None and self.bias.bias_file is not None \
+                and step % self.bias.bias_stride == 0:
+            self.bias.write_bias(simulation.context)
+        return
@@ -0,0 +1,170 @@
+#!/bin/env python
+import os
+import re
+import argparse
+from subprocess import call
+from multiprocessing import Pool
+import pandas as pd
+
+# per action lines of DEBUG DETAILED_TIMERS, 4A is the forward (calculate)
+# loop and 5A the backward (apply) loop, e.g.
+# PLUMED: 4A  1 Dihedral_12_13                     1001   0.003450   0.000003 ...
+_TIMER_LINE = re.compile(r"^(?:PLUMED:)?\s*(4A|5A)\s+(\d+)\s+(\S+)\s+(\d+)\s+"
+                         r"(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s*$")
+
+
+def parse_plumed_timings(log_file):
+    """
+    Reads the per action timers that DEBUG DETAILED_TIMERS writes to a
+    plumed log. Only the plumed driver replay writes them, the live
+    simulations don't collect per action timings.
+
+    :param log_file: path to the log
+    :return: data frame with one row per action label, summing the forward
+    and backward loops
+    """
+    rows = []
+    with open(log_file) as f:
+        for line in f:
+            match = _TIMER_LINE.match(line.strip())
+            if match is None:
+                continue
+            loop, index, label, cycles, total, average, minimum, maximum = match.groups()
+            rows.append({"loop": "forward" if loop == "4A" else "backward",
+                         "action_index": int(index), "label": label,
+                         "cycles": int(cycles), "total": float(total),
+                         "average": float(average), "min": float(minimum),
+                         "max": float(maximum)})
+    if len(rows) == 0:
+        raise ValueError("No DETAILED_TIMERS output found in %s. Only the "
+                         "plumed driver replay of profile_all_replicas "
+                         "writes them"%log_file)
+    timings = pd.DataFrame(rows)
+    res = timings.groupby("label").agg({"action_index": "min", "cycles": "max",
+                                        "total": "sum", "average": "sum"})
+    return res.sort_values("total", ascending=False).reset_index()
+
+
+def map_labels_to_features(plumed_script, df):
+    """
+    Maps every action label in a rendered plumed script to the rows of the
+    feature descriptor it computes. Raw features map through their label,
+    mean free transforms through their argument. Actions that don't belong
+    to a single feature (COMBINE, METAD, walls, PRINT) map to an empty list.
+
+    :param plumed_script: rendered script
+    :param df: feature descriptor data frame
+    :return: dictionary keyed on action label
+    """
+    from .plumed_writer import get_raw_feature_label, match_mean_free_function
+    raw_labels = {}
+    for feature_index in df.index:
+        raw_labels.setdefault(get_raw_feature_label(df, feature_index),
+                              []).append(feature_index)
+    label_map = {}
+    for line in plumed_script.splitlines():
+        tokens = dict(t.split("=", 1) for t in line.split() if "=" in t)
+        if "LABEL" not in tokens:
+            continue
+        label = tokens["LABEL"]
+        arg = tokens.get("ARG", "")
+        if label in raw_labels:
+            label_map[label] = raw_labels[label]
+        elif line.startswith("MATHEVAL") and arg.rsplit(".min", 1)[0] in raw_labels:
+            # sin and cos of the same torsion share the raw feature
+            rows = raw_labels[arg.rsplit(".min", 1)[0]]
+            label_map[label] = [r for r in rows if label.startswith(
+                "meanfree_%s_"%match_mean_free_function(df, r))] or rows
+        else:
+            label_map[label] = []
+    return label_map
+
+
+def get_action_costs(log_file, plumed_script, df):
+    """
+    Per action cost table with the feature descriptor rows every action
+    belongs to, most expensive first.
+    """
+    timings = parse_plumed_timings(log_file)
+    label_map = map_labels_to_features(plumed_script, df)
+    timings["feature_rows"] = [label_map.get(l, []) for l in timings.label]
+    timings["fraction"] = timings.total/timings.total.sum()
+    return timings
+
+
+def profile_folder(job_tuple):
+    tic_index, script, traj_file = job_tuple
+    base_dir = os.getcwd()
+    os.chdir(os.path.join(base_dir, "tic_%d"%tic_index))
+    with open("plumed_profile.dat", 'w') as f:
+        f.writelines(script)
+    # --mf_dcd or --mf_xtc
+    traj_flag = "--mf_%s"%os.path.splitext(traj_file)[1].lstrip(".")
+    cmd = ["plumed", "--no-mpi", "driver", traj_flag, traj_file,
+           "--plumed", "plumed_profile.dat", "--log", "plumed_profile.log"]
+    ret_code = call(cmd)
+    print(tic_index, ret_code)
+    os.chdir(base_dir)
+    return ret_code
+
+
+def profile_all_replicas(file_loc, traj_file="trajectory.dcd"):
+    """
+    Replays every replica's trajectory through plumed driver with detailed
+    timers switched on and writes tic_i/plumed_action_costs.csv. This replay
+    is the only source of per action timings. The metad
+    action is neutralised the same way process_all_replicas does it so that
+    no hills are deposited.
+
+    :param file_loc: metad_sim.pkl location
+    :param traj_file: trajectory name inside every tic_i folder
+    :return: dictionary of cost tables keyed on tic index
+    """
+    from msmbuilder.utils import load
+    from .plumed_writer import get_plumed_dict
+    sim_mdl = load(file_loc)
+    os.chdir(sim_mdl.base_dir)
+    sim_mdl.pace = 1000000000
+    sim_mdl.height = 0
+    sim_mdl.stride = 1000000000
+    sim_mdl.bias_file = "PROFILE_BIAS"
+    plumed_scripts_dict = get_plumed_dict(sim_mdl, profile_plumed=True)
+    jobs = [(i, plumed_scripts_dict[i], traj_file) for i in plumed_scripts_dict.keys()]
+    p = Pool(len(jobs))
+    ret_codes = p.map(profile_folder, jobs)
+    p.close()
+    failed = [job[0] for job, ret_code in zip(jobs, ret_codes) if ret_code != 0]
+    if len(failed) > 0:
+        raise RuntimeError("plumed driver failed for tics %s, see "
+                           "tic_i/plumed_profile.log"%failed)
+
+    costs = {}
+    for i, script, _ in jobs:
+        costs[i] = get_action_costs("tic_%d/plumed_profile.log"%i, script,
+                                    sim_mdl.data_frame)
+        costs[i].to_csv("tic_%d/plumed_action_costs.csv"%i, index=False)
+        print("tic %d most expensive actions"%i)
+        print(costs[i].head(10))
+    return costs
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f','--file', dest='f',
+                            default='./metad_sim.pkl',
+              help='TICA METAD location file')
+    parser.add_argument('-t','--traj', dest='t',
+                            default='trajectory.dcd',
+              help='Trajectory to replay inside every tic folder')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_commandline()
+    profile_all_replicas(args.f, args.t)
+    return
+
+
+if __name__ == "__main__":
+    main()
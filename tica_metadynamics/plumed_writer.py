@@ -149,6 +149,12 @@ def get_feature_function(df, feature_index):
         func = possibles.get("create_torsion_label")
     return func
 
+def get_raw_feature_label(df, feature_index):
+    # label of the raw plumed feature for a row of the feature descriptor
+    if  df.featurizer[feature_index] == "LandMarkFeaturizer":
+        return df.featuregroup[feature_index]+"_%s"%feature_index
+    return df.featuregroup[feature_index]+"_%s"%'_'.join(map(str,df.resids[feature_index]))
+
 def render_raw_features(df,inds):
     output = []
     if not set(df.featurizer).issubset(set(_SUPPORTED_FEATS)):
@@ -165,10 +171,7 @@ def render_raw_features(df,inds):
         resids = j[1]["resids"]
         feat = j[1]["featuregroup"]
         func = get_feature_function(df, feature_index)
-        if  df.featurizer[feature_index] == "LandMarkFeaturizer":
-            feat_label =  feat+"_%s"%feature_index
-        else:
-            feat_label = feat+"_%s"%'_'.join(map(str,resids))
+        feat_label = get_raw_feature_label(df, feature_index)
         if feat_label not in already_done_list:
             #mdtraj is 0 indexed and plumed is 1 indexed
             if  df.featurizer[feature_index] == "LandMarkFeaturizer":
@@ -403,9 +406,15 @@ def render_tica_plumed_file(tica_mdl, df, n_tics, grid_list=None,interval_list=N
     if interval_list is None:
         interval_list = np.repeat(None, n_tics)
     multiple_tics = kwargs.pop('multiple_tics')
+    # per action timings for the offline replay in plumed_profile.py, the
+    # live scripts never get them
+    profile_plumed = kwargs.pop('profile_plumed', False)
+    header = "RESTART\n"
+    if profile_plumed:
+        header += "DEBUG DETAILED_TIMERS\n"
     if type(multiple_tics) == int:
         output = []
-        output.append("RESTART\n")
+        output.append(header)
         print("Running Multiple tics per simulation. Going up to tic index %d"%n_tics)
         inds = np.unique(np.nonzero(tica_mdl.components_[:multiple_tics,:])[1])
         raw_feats = render_raw_features(df, inds)
@@ -445,7 +454,7 @@ def render_tica_plumed_file(tica_mdl, df, n_tics, grid_list=None,interval_list=N
 
     for i in range(n_tics):
         output=[]
-        output.append("RESTART\n")
+        output.append(header)
         inds = np.nonzero(tica_mdl.components_[i,:])[0]
         raw_feats = render_raw_features(df, inds)
         mean_feats = render_mean_free_features(df, inds, tica_mdl, nrm)
@@ -484,7 +493,7 @@ def render_tica_plumed_file(tica_mdl, df, n_tics, grid_list=None,interval_list=N
     return return_dict
 
 
-def get_plumed_dict(metad_sim):
+def get_plumed_dict(metad_sim, profile_plumed=False):
     if  type(metad_sim)==str:
         metad_sim = load(metad_sim)
     if not hasattr(metad_sim,"nrm"):
@@ -509,4 +518,5 @@ def get_plumed_dict(metad_sim):
                                    bias_file=metad_sim.bias_file, label=metad_sim.label,
                                    nrm = metad_sim.nrm, walker_id = metad_sim.walker_id,
                                    walker_n=metad_sim.walker_n,
-                                   multiple_tics=metad_sim.multiple_tics)
+                                   multiple_tics=metad_sim.multiple_tics,
+                                   profile_plumed=profile_plumed)
@@ -1,12 +1,9 @@
 #!/bin/env python
-from msmbuilder.utils import load,dump
 import os,glob
 import argparse
 from subprocess import call
 from multiprocessing import Pool
-from .utils import concatenate_folder
-from .plumed_writer import get_plumed_dict
-from jinja2 import Template
+from .utils import concatenate_folder, link_trajectory
 
 def process_folder(job_tuple):
     r1, r2, script = job_tuple
@@ -31,11 +28,16 @@ def process_folder(job_tuple):
     return
 
 def process_all_replicas(file_loc,redo=True,stride=1):
+    from msmbuilder.utils import load
+    from jinja2 import Template
+    from .plumed_writer import get_plumed_dict
     sim_mdl = load(file_loc)
     os.chdir(sim_mdl.base_dir)
     top_loc = glob.glob(os.path.join(sim_mdl.starting_coordinates_folder,"0.pdb"))[0]
     for i in range(sim_mdl.n_tics):
-        if redo:
+        if getattr(sim_mdl, "traj_format", "dcd") == "xtc":
+            link_trajectory("tic_%d"%i)
+        elif redo:
             concatenate_folder("tic_%d"%i, top_loc,stride)
 
     sim_mdl.pace = 1000000000
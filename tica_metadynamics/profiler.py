@@ -0,0 +1,126 @@
+#!/bin/env python
+import os
+import resource
+from contextlib import contextmanager
+from time import perf_counter
+import numpy as np
+
+_PHASES = ["md", "exchange", "energy", "load_state", "checkpoint", "msm_swap"]
+
+
+def get_rss_mb():
+    # current resident set size, falls back to the peak where /proc is missing
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/1024.**2
+    except (IOError, OSError, ValueError):
+        return get_peak_rss_mb()
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kB on linux, shared by all threads of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+class PhaseTimer(object):
+    """
+    Per iteration wall clock breakdown of the replica exchange loop.
+
+    Phases can nest; time spent in an inner phase is not counted for the
+    outer one, so the exchange phase ends up holding only communication and
+    bookkeeping. Rows are buffered and appended to a csv file every
+    flush_every iterations, the header is only written to a new file.
+
+    :param file_name: csv file for the per iteration rows, None to only
+    keep the totals
+    :param phases: list of phase names
+    :param enabled: if False every call is a no-op
+    :param flush_every: number of rows to buffer before writing
+    """
+    def __init__(self, file_name=None, phases=_PHASES, enabled=True, flush_every=100):
+        self.file_name = file_name
+        self.phases = list(phases)
+        self.enabled = enabled
+        self.flush_every = flush_every
+        self.current = dict.fromkeys(self.phases, 0.0)
+        self.totals = dict.fromkeys(self.phases, 0.0)
+        self.n_iterations = 0
+        self.peak_rss = 0.0
+        self._stack = []
+        self._rows = []
+        if self.enabled and self.file_name is not None:
+            # a resumed run appends its rows after those of earlier segments
+            with open(self.file_name, 'a') as f:
+                if f.tell() == 0:
+                    f.writelines(",".join(["iteration"] + self.phases + ["rss_mb"]) + "\n")
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        now = perf_counter()
+        if len(self._stack) > 0:
+            parent = self._stack[-1]
+            self.current[parent[0]] += now - parent[1]
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = perf_counter()
+            name, start = self._stack.pop()
+            self.current[name] += now - start
+            if len(self._stack) > 0:
+                self._stack[-1][1] = now
+
+    def end_iteration(self, iteration):
+        if not self.enabled:
+            return
+        rss = get_rss_mb()
+        self.peak_rss = max(self.peak_rss, rss)
+        self._rows.append([iteration] + [self.current[p] for p in self.phases] + [rss])
+        for p in self.phases:
+            self.totals[p] += self.current[p]
+            self.current[p] = 0.0
+        self.n_iterations += 1
+        if len(self._rows) >= self.flush_every:
+            self.flush()
+        return
+
+    def flush(self):
+        if self.enabled and self.file_name is not None and len(self._rows) > 0:
+            with open(self.file_name, 'a') as f:
+                f.writelines(["%d,"%row[0] + ",".join(["%.6f"%v for v in row[1:]]) + "\n"
+                              for row in self._rows])
+        self._rows = []
+        return
+
+    def summary(self):
+        res = dict(self.totals)
+        res["n_iterations"] = self.n_iterations
+        res["peak_rss_mb"] = self.peak_rss
+        return res
+
+
+def summarize_timings(rank_summaries):
+    """
+    Renders the end of run report from the PhaseTimer.summary of every rank.
+
+    :param rank_summaries: dictionary keyed on rank
+    :return: report string
+    """
+    ranks = sorted(rank_summaries.keys())
+    phases = [p for p in _PHASES if p in rank_summaries[ranks[0]]]
+    table = np.array([[rank_summaries[r][p] for p in phases] for r in ranks])
+    md = table[:, phases.index("md")]
+    overhead = table.sum(axis=1) - md
+    output = []
+    output.append("#rank\t" + "\t".join(phases) + "\tpeak_rss_mb\toverhead_%\n")
+    for k, r in enumerate(ranks):
+        output.append("%d\t"%r + "\t".join(["%.2f"%v for v in table[k]]) +
+                      "\t%.1f\t%.2f\n"%(rank_summaries[r]["peak_rss_mb"],
+                                        100*overhead[k]/max(md[k], 1e-9)))
+    output.append("Total md time imbalance (max/mean): %.3f\n"%(md.max()/max(md.mean(), 1e-9)))
+    output.append("Exchange overhead as percent of md time: %.2f\n"
+                  %(100*overhead.sum()/max(md.sum(), 1e-9)))
+    return ''.join(output)
@@ -0,0 +1,293 @@
+#!/bin/env python
+import os
+import numpy as np
+
+# dcd is openmm's DCDReporter with the whole system, xtc and h5 are written
+# by SubsetTrajectoryReporter and can hold just some of the atoms
+_TRAJ_FORMATS = ["dcd", "xtc", "h5"]
+
+
+def get_atom_subset(topology, traj_atoms):
+    """
+    :param topology: mdtraj topology of the whole system
+    :param traj_atoms: None for every atom, "solute" for everything but
+    water and ions (what remove_solvent keeps), any other string is an
+    mdtraj selection, or a list of atom indices
+    :return: sorted atom indices, None for every atom
+    """
+    if traj_atoms is None:
+        return None
+    if isinstance(traj_atoms, str) and traj_atoms == "solute":
+        from mdtraj.core.residue_names import _SOLVENT_TYPES
+        indices = [a.index for a in topology.atoms
+                   if a.residue.name not in _SOLVENT_TYPES]
+    elif isinstance(traj_atoms, str):
+        indices = topology.select(traj_atoms)
+    else:
+        indices = traj_atoms
+    indices = np.unique(np.asarray(indices, dtype=int))
+    if len(indices) == 0:
+        raise ValueError("traj_atoms=%r selects no atoms"%(traj_atoms,))
+    if indices[-1] >= topology.n_atoms:
+        raise ValueError("traj_atoms has index %d but the system only has %d atoms"
+                         %(indices[-1], topology.n_atoms))
+    return indices
+
+
+class SubsetTrajectoryReporter(object):
+    """
+    Writes the positions of some of the atoms every report_interval steps
+    to an xtc or hdf5 file. An existing file is appended to, so a restarted
+    replica keeps writing the same trajectory. The solvent usually is most
+    of the system, leaving it out shrinks the files and post_process no
+    longer has to load and strip the dcds.
+
+    xtc frames are self contained, mdtraj can't append to an xtc but a
+    chunk of frames written to a file of its own can simply be added to
+    the end of the trajectory.
+
+    Plumed's driver addresses atoms by their index in the whole system, so
+    the reweighting in post_process needs a subset that starts at the first
+    atom (like "solute").
+
+    :param file_name: .xtc or .h5 file
+    :param report_interval: steps between frames
+    :param topology: openmm topology of the whole system
+    :param atom_indices: atoms to write, None for every atom
+    :param chunk_size: xtc frames held in memory before they are written
+    """
+    def __init__(self, file_name, report_interval, topology, atom_indices=None,
+                 chunk_size=1):
+        import mdtraj as md
+        self._file_name = file_name
+        self._report_interval = report_interval
+        self._format = os.path.splitext(file_name)[1].lstrip(".")
+        if self._format not in ["xtc", "h5"]:
+            raise ValueError("SubsetTrajectoryReporter writes xtc or h5, got %s"%file_name)
+        self._topology = md.Topology.from_openmm(topology)
+        self._atom_indices = atom_indices
+        if atom_indices is not None:
+            self._topology = self._topology.subset(atom_indices)
+        self._chunk_size = chunk_size
+        self._chunk = []
+        self._h5 = None
+
+    def describeNextReport(self, simulation):
+        steps = self._report_interval - simulation.currentStep % self._report_interval
+        return (steps, True, False, False, False)
+
+    def report(self, simulation, state):
+        from simtk.unit import nanometer, picosecond
+        xyz = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+        if self._atom_indices is not None:
+            xyz = xyz[self._atom_indices]
+        box = state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(nanometer)
+        self._chunk.append((np.asarray(xyz, dtype=np.float32),
+                            state.getTime().value_in_unit(picosecond),
+                            simulation.currentStep,
+                            np.asarray(box, dtype=np.float32)))
+        if len(self._chunk) >= self._chunk_size:
+            self._write_chunk()
+        return
+
+    def _write_chunk(self):
+        if len(self._chunk) == 0:
+            return
+        xyz, time, step, box = [np.array(v) for v in zip(*self._chunk)]
+        if self._format == "xtc":
+            from mdtraj.formats import XTCTrajectoryFile
+            chunk_file = self._file_name + ".chunk"
+            with XTCTrajectoryFile(chunk_file, 'w') as f:
+                f.write(xyz, time=time, step=step, box=box)
+            with open(chunk_file, 'rb') as fin:
+                with open(self._file_name, 'ab') as fout:
+                    fout.write(fin.read())
+            os.remove(chunk_file)
+        else:
+            from mdtraj.utils import box_vectors_to_lengths_and_angles
+            if self._h5 is None:
+                self._open_h5()
+            lengths_angles = np.array([box_vectors_to_lengths_and_angles(*b) for b in box])
+            self._h5.write(xyz, time=time, cell_lengths=lengths_angles[:, :3],
+                           cell_angles=lengths_angles[:, 3:])
+            self._h5.flush()
+        self._chunk = []
+        return
+
+    def _open_h5(self):
+        from mdtraj.formats import HDF5TrajectoryFile
+        exists = os.path.isfile(self._file_name) and os.path.getsize(self._file_name) > 0
+        self._h5 = HDF5TrajectoryFile(self._file_name, 'a' if exists else 'w')
+        if not exists:
+            self._h5.topology = self._topology
+        return
+
+    def flush(self):
+        self._write_chunk()
+        return
+
+    def close(self):
+        self._write_chunk()
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+        return
+
+    def __del__(self):
+        self.close()
+
+
+class _StateCopy(object):
+    # what the reporters read from an openmm State, positions in a buffer
+    # owned by the AsyncReporter
+    def __init__(self, positions, box, time, potential_energy, kinetic_energy):
+        self._positions = positions
+        self._box = box
+        self._time = time
+        self._potential_energy = potential_energy
+        self._kinetic_energy = kinetic_energy
+
+    def getPositions(self, asNumpy=False):
+        from simtk.unit import nanometer
+        return self._positions*nanometer
+
+    def getPeriodicBoxVectors(self, asNumpy=False):
+        from simtk.unit import nanometer
+        return self._box*nanometer
+
+    def getTime(self):
+        from simtk.unit import picosecond
+        return self._time*picosecond
+
+    def getPotentialEnergy(self):
+        from simtk.unit import kilojoule_per_mole
+        return self._potential_energy*kilojoule_per_mole
+
+    def getKineticEnergy(self):
+        from simtk.unit import kilojoule_per_mole
+        return self._kinetic_energy*kilojoule_per_mole
+
+
+class _SimulationView(object):
+    # the simulation as it was at the report. The context isn't handed out,
+    # the writer thread must not touch it while the md thread steps, so the
+    # temperature comes from the kinetic energy instead of the integrator.
+    def __init__(self, simulation, current_step):
+        self.currentStep = current_step
+        self.topology = getattr(simulation, "topology", None)
+        self.system = getattr(simulation, "system", None)
+        self.integrator = getattr(simulation, "integrator", None)
+        self.context = self
+
+    def getIntegrator(self):
+        return None
+
+
+def _requested(description):
+    # openmm < 8 describes a report as (steps, positions, velocities,
+    # forces, energies[, wrap]), newer versions as a dictionary
+    if isinstance(description, dict):
+        include = description.get("include", [])
+        return "positions" in include, "energy" in include
+    return description[1], description[4]
+
+
+class AsyncReporter(object):
+    """
+    Runs an openmm reporter on a background thread, so that the md thread
+    doesn't wait on the filesystem. At every report the positions are
+    copied into one of max_pending preallocated buffers and the copy is
+    queued for the writer thread. Once all buffers are in use the md
+    thread waits for the writer to free one, so a slow filesystem slows
+    the simulation down instead of filling the memory.
+
+    Only positions, box, time and energies are copied, enough for the
+    DCDReporter, StateDataReporter and SubsetTrajectoryReporter. Call
+    flush() before anything that needs the files to be complete, e.g. a
+    checkpoint; TicaSimulator does so through flush_reporters.
+
+    :param reporter: reporter to run in the background
+    :param n_atoms: atoms in the system, to size the buffers
+    :param max_pending: reports that may wait for the writer
+    """
+    def __init__(self, reporter, n_atoms, max_pending=4):
+        import queue
+        import threading
+        self.reporter = reporter
+        self._free = queue.Queue()
+        for _ in range(max_pending):
+            self._free.put(np.empty((n_atoms, 3)))
+        self._pending = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def describeNextReport(self, simulation):
+        return self.reporter.describeNextReport(simulation)
+
+    def report(self, simulation, state):
+        from simtk.unit import nanometer, picosecond, kilojoule_per_mole
+        self._raise_error()
+        positions, energies = _requested(self.reporter.describeNextReport(simulation))
+        buffer = None
+        if positions:
+            # blocks while the writer is behind
+            buffer = self._free.get()
+            np.copyto(buffer, state.getPositions(asNumpy=True).value_in_unit(nanometer))
+        potential_energy = kinetic_energy = None
+        if energies:
+            potential_energy = state.getPotentialEnergy().value_in_unit(kilojoule_per_mole)
+            kinetic_energy = state.getKineticEnergy().value_in_unit(kilojoule_per_mole)
+        state_copy = _StateCopy(buffer,
+                                np.array(state.getPeriodicBoxVectors(asNumpy=True).
+                                         value_in_unit(nanometer)),
+                                state.getTime().value_in_unit(picosecond),
+                                potential_energy, kinetic_energy)
+        self._pending.put((_SimulationView(simulation, simulation.currentStep), state_copy))
+        return
+
+    def _write_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                self._pending.task_done()
+                return
+            simulation, state_copy = item
+            try:
+                if self._error is None:
+                    self.reporter.report(simulation, state_copy)
+            except Exception as e:
+                # raised on the md thread at the next report or flush
+                self._error = e
+            finally:
+                if state_copy._positions is not None:
+                    self._free.put(state_copy._positions)
+                self._pending.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Background writer of %s failed: %s"
+                               %(self.reporter.__class__.__name__, self._error))
+
+    def flush(self):
+        """
+        Waits for the writer to finish every queued report and flushes the
+        reporter's file.
+        """
+        self._pending.join()
+        self._raise_error()
+        if hasattr(self.reporter, "flush"):
+            self.reporter.flush()
+        else:
+            out = getattr(self.reporter, "_out", None)
+            if out is not None and not out.closed:
+                out.flush()
+        return
+
+    def close(self):
+        if self._thread.is_alive():
+            self._pending.put(None)
+            self._thread.join()
+        self.flush()
+        return
@@ -2,9 +2,11 @@
 
 import os,shutil
 from .utils import load_yaml_file
-from msmbuilder.utils import load,dump
-from .render_sub_file import slurm_temp
-from .plumed_writer import get_interval, get_plumed_dict
+from .exchange import _EXCHANGE_MODES, _EXCHANGE_SCHEMES
+from .openmm_bias import _BIAS_BACKENDS
+from .communicator import _COMM_BACKENDS, _WALKER_COMMS
+from .reporters import _TRAJ_FORMATS
+from .swap_log import _SWAP_LOG_FORMATS
 
 class TicaMetadSim(object):
     def __init__(self, base_dir="./", starting_coordinates_folder="./starting_coordinates",
@@ -21,16 +23,52 @@ class TicaMetadSim(object):
                             sigma=0.2, delete_existing=False, hills_file="HILLS",
                             bias_file="BIAS", label="metad",
                             sim_save_rate=50000,
+                            traj_format='dcd',
+                            traj_atoms=None,
+                            traj_chunk_size=100,
+                            async_reporters=False,
                             swap_rate=25000, n_iterations=1000,
+                            swap_log_format='text',
+                            swap_log_buffer=100,
                             platform='CUDA',
                             grid_mlpt_factor=.3,
                             render_scripts=False,
                             msm_swap_folder=None,
                             msm_swap_scheme='random',
                             n_walkers = 1,
+                            walker_comm='separate',
                             neutral_replica=False,
                             multiple_tics=False,
-                            plumed_dict=None):
+                            plumed_dict=None,
+                            exchange_mode='checkpoint',
+                            exchange_scheme='single',
+                            checkpoint_interval=10,
+                            exchange_overlap=False,
+                            overlap_chunk=1000,
+                            max_lag=10,
+                            adaptive_swap_rate=False,
+                            min_swap_rate=None,
+                            max_swap_rate=None,
+                            target_acceptance=[0.2, 0.5],
+                            adapt_interval=10,
+                            exchange_timeout=None,
+                            heartbeat_timeout=None,
+                            profile_timings=False,
+                            bias_mts_steps=1,
+                            bias_backend='plumed',
+                            replicas_per_rank=1,
+                            comm_backend='mpi',
+                            checkpoint_ring=0,
+                            scratch_dir=None,
+                            scratch_sync_interval=300,
+                            convergence_tol=None,
+                            convergence_interval=100,
+                            convergence_patience=3,
+                            min_acceptance=0.):
+        # msmbuilder and the writers are only needed once a simulation is
+        # actually set up, setup_file reads the signature without them
+        from msmbuilder.utils import load
+        from .plumed_writer import get_interval
         self.base_dir = os.path.abspath(base_dir)
         self.starting_coordinates_folder = starting_coordinates_folder
         self.n_tics = n_tics
@@ -130,11 +168,100 @@ class TicaMetadSim(object):
         self.bias_file = bias_file
         self.label = label
         self.sim_save_rate = sim_save_rate
+        if traj_format not in _TRAJ_FORMATS:
+            raise ValueError("traj_format must be one of %s"%_TRAJ_FORMATS)
+        if traj_atoms is not None and traj_format == "dcd":
+            raise ValueError("traj_atoms needs traj_format='xtc' or 'h5', the dcd "
+                             "always holds the whole system")
+        if int(traj_chunk_size) < 1:
+            raise ValueError("traj_chunk_size must be a positive integer")
+        self.traj_format = traj_format
+        self.traj_atoms = traj_atoms
+        # xtc and h5 frames held in memory, written at least on every checkpoint
+        self.traj_chunk_size = int(traj_chunk_size)
+        self.async_reporters = async_reporters
         self.swap_rate = swap_rate
+        if swap_log_format not in _SWAP_LOG_FORMATS:
+            raise ValueError("swap_log_format must be one of %s"%_SWAP_LOG_FORMATS)
+        if int(swap_log_buffer) < 1:
+            raise ValueError("swap_log_buffer must be a positive number of records")
+        self.swap_log_format = swap_log_format
+        self.swap_log_buffer = int(swap_log_buffer)
         self.plumed_scripts_dict = None
         self.msm_swap_folder = msm_swap_folder
         self.msm_swap_scheme = msm_swap_scheme
         self.neutral_replica = neutral_replica
+        if exchange_mode not in _EXCHANGE_MODES:
+            raise ValueError("exchange_mode must be one of %s"%_EXCHANGE_MODES)
+        self.exchange_mode = exchange_mode
+        if exchange_scheme not in _EXCHANGE_SCHEMES:
+            raise ValueError("exchange_scheme must be one of %s"%_EXCHANGE_SCHEMES)
+        self.exchange_scheme = exchange_scheme
+        if exchange_overlap and exchange_mode != "pairwise":
+            raise ValueError("exchange_overlap needs exchange_mode='pairwise'")
+        self.exchange_overlap = exchange_overlap
+        self.overlap_chunk = overlap_chunk
+        self.max_lag = max_lag
+        self.adaptive_swap_rate = adaptive_swap_rate
+        self.min_swap_rate = min_swap_rate
+        self.max_swap_rate = max_swap_rate
+        self.target_acceptance = target_acceptance
+        self.adapt_interval = adapt_interval
+        if heartbeat_timeout is not None and exchange_mode != "pairwise":
+            raise ValueError("Dropping replicas needs exchange_mode='pairwise', "
+                             "the other modes can only abort on exchange_timeout")
+        if heartbeat_timeout is not None and exchange_timeout is None:
+            # a replica waiting forever on a dead partner can't be dropped,
+            # and if it is rank 0 nobody watches the heartbeats anymore
+            raise ValueError("heartbeat_timeout needs an exchange_timeout")
+        self.exchange_timeout = exchange_timeout
+        self.heartbeat_timeout = heartbeat_timeout
+        self.profile_timings = profile_timings
+        if int(bias_mts_steps) < 1:
+            raise ValueError("bias_mts_steps must be a positive integer")
+        self.bias_mts_steps = int(bias_mts_steps)
+        if bias_backend not in _BIAS_BACKENDS:
+            raise ValueError("bias_backend must be one of %s"%_BIAS_BACKENDS)
+        if bias_backend == "openmm" and n_walkers > 1:
+            raise ValueError("Multiple walkers need bias_backend='plumed'")
+        self.bias_backend = bias_backend
+        if walker_comm not in _WALKER_COMMS:
+            raise ValueError("walker_comm must be one of %s"%_WALKER_COMMS)
+        if walker_comm != "separate" and (comm_backend != "mpi" or int(replicas_per_rank) > 1):
+            raise ValueError("walker_comm='%s' runs one replica per mpi rank, it needs "
+                             "comm_backend='mpi' and replicas_per_rank=1"%walker_comm)
+        self.walker_comm = walker_comm
+        if int(replicas_per_rank) < 1:
+            raise ValueError("replicas_per_rank must be a positive integer")
+        self.replicas_per_rank = int(replicas_per_rank)
+        if comm_backend not in _COMM_BACKENDS:
+            raise ValueError("comm_backend must be one of %s"%_COMM_BACKENDS)
+        self.comm_backend = comm_backend
+        self.checkpoint_interval = checkpoint_interval
+        if int(checkpoint_ring) < 0:
+            raise ValueError("checkpoint_ring must be 0 (off) or the number of "
+                             "snapshots to keep")
+        self.checkpoint_ring = int(checkpoint_ring)
+        if scratch_sync_interval <= 0:
+            raise ValueError("scratch_sync_interval must be positive (seconds)")
+        self.scratch_dir = scratch_dir
+        self.scratch_sync_interval = scratch_sync_interval
+        if convergence_tol is not None:
+            if convergence_tol <= 0:
+                raise ValueError("convergence_tol must be positive (kJ/mol) or None (off)")
+            if int(convergence_interval) < 1 or int(convergence_patience) < 1:
+                raise ValueError("convergence_interval and convergence_patience must "
+                                 "be positive integers")
+            # a plumed_dict has to write one dimensional hills to hills_file too
+            if multiple_tics:
+                raise ValueError("The convergence monitor reads one dimensional hills, "
+                                 "it can't be used with multiple_tics")
+        if not 0 <= min_acceptance <= 1:
+            raise ValueError("min_acceptance must be between 0 and 1")
+        self.convergence_tol = convergence_tol
+        self.convergence_interval = int(convergence_interval)
+        self.convergence_patience = int(convergence_patience)
+        self.min_acceptance = min_acceptance
         self.tica_data = None
 
         if self.walker_n > 1:
@@ -151,23 +278,37 @@ class TicaMetadSim(object):
                 self._setup()
                 self._write_scripts_and_dump()
                 # make
+            if self.walker_comm != "separate":
+                # plus one job for all of them started from the top folder,
+                # see simulate.run_walkers
+                os.chdir(c_base_dir)
+                self.base_dir = c_base_dir
+                del self.walker_id
+                self._write_scripts_and_dump(n_walkers=self.walker_n)
 
         else:
             self._setup()
             self._write_scripts_and_dump()
 
 
-    def _write_scripts_and_dump(self):
+    def _write_scripts_and_dump(self, n_walkers=1):
+        from msmbuilder.utils import dump
+        from .render_sub_file import slurm_temp
+        from .plumed_writer import get_plumed_dict
         n_gpus = self.n_tics
         if self.neutral_replica:
             n_gpus += 1
+        n_gpus *= n_walkers
+        # several replicas can share a rank (and its gpu)
+        n_gpus = -(-n_gpus//self.replicas_per_rank)
         with open(os.path.join(self.base_dir,"sub.sh"),'w') as f:
             f.writelines(slurm_temp.render(job_name="tica_metad",
                               base_dir=self.base_dir,
                               partition="pande,normal,gpu,hns_gpu",
                               n_tics=n_gpus))
 
-        if self.render_scripts:
+        # the walker folders already have their scripts
+        if self.render_scripts and n_walkers == 1:
             if self.plumed_dict is not None:
                 self.plumed_scripts_dict = self.plumed_dict
             else:
@@ -1,28 +1,51 @@
 #!/bin/env python
-from mpi4py import MPI
 import argparse
-from msmbuilder.utils import load
+import copy
 from .utils import get_gpu_index
 import socket
+import sys
+import time
+import threading
+import traceback
 import numpy as np
-import glob
-from simtk.unit import *
-from .plumed_writer import get_plumed_dict
+from .profiler import PhaseTimer, summarize_timings, get_peak_rss_mb
+from .communicator import MPIComm, QueueTransport, Status, ANY_SOURCE, \
+    create_thread_comms, _COMM_BACKENDS
+from .exchange import get_replica_state, set_replica_state, set_replica_positions, \
+    get_swap_probability, sample_permutation, ExchangeScheduler, \
+    AdaptiveSwapRate, load_acceptance, \
+    STATE_TAG, ENERGY_TAG, SWAP_LOG_TAG, RATE_TAG, SEGMENT_TAG, \
+    HEARTBEAT_TAG, POOL_TAG, DONE_TAG, TIMING_TAG, STARTUP_TAG, SNAPSHOT_TAG, \
+    CONVERGENCE_TAG
+from .staging import OutputStager, flush_all_stagers
+from .checkpoint import get_snapshot_dir, write_replica_snapshot, load_replica_snapshot, \
+    write_manifest, find_latest_snapshot, prune_snapshots, truncate_file
+from .swap_log import SwapLog, get_swap_log_file
+from .convergence import ConvergenceMonitor, CONVERGED_FILE
+from .msm_library import prepare_msm_library
 import os
-import mdtraj as md 
-from simtk.openmm.app import *
-from simtk.openmm import *
+# openmm, mdtraj, msmbuilder and the plumed writer are imported where they
+# are used, so that the entry point starts (and --help answers) quickly
 boltzmann_constant = 0.0083144621
 
-comm = MPI.COMM_WORLD
-size = comm.Get_size()
-rank = comm.Get_rank()
+# large objects of the setup that the replicas don't need, the msm swap
+# schemes that featurize on the fly keep the first five
+_MSM_SWAP_MODELS = ["featurizer", "tica_mdl", "kmeans_mdl", "nrm", "wt_msm_mdl"]
+_SETUP_MODELS = _MSM_SWAP_MODELS + ["tica_data", "data_frame", "plumed_dict",
+                                    "plumed_scripts_dict"]
 
 
 def swap_with_msm_state(sim_obj, swap_folder,force_group,beta):
-    flist = glob.glob(os.path.join(swap_folder,"state*.xml"))
-    print("Found %d states"%len(flist), flush=True)
-    random_chck = np.random.choice(flist)
+    from simtk.unit import kilojoule_per_mole
+    from .msm_library import get_msm_library_file, is_library_current, \
+        write_msm_library, load_msm_library
+    library_file = get_msm_library_file(swap_folder)
+    if not is_library_current(library_file, swap_folder):
+        write_msm_library(library_file, swap_folder)
+    library = load_msm_library(library_file)
+    print("Found %d states"%len(library), flush=True)
+    swap_index = np.random.choice(len(library))
+    random_chck = library.names[swap_index]
     print("Attempting swap with %s"%random_chck, flush=True)
     old_state=sim_obj.context.getState(getPositions=True, getVelocities=True,\
         getForces=True,getEnergy=True,getParameters=True,enforcePeriodicBox=True)
@@ -30,8 +53,7 @@ def swap_with_msm_state(sim_obj, swap_folder,force_group,beta):
     old_energy = sim_obj.context.getState(getEnergy=True,groups={force_group}).\
             getPotentialEnergy().value_in_unit(kilojoule_per_mole)
 
-    new_state = XmlSerializer.deserialize(open(random_chck).read())
-    sim_obj.context.setState(new_state)
+    library.set_state(sim_obj, swap_index)
     new_energy = sim_obj.context.getState(getEnergy=True,groups={force_group}).\
             getPotentialEnergy().value_in_unit(kilojoule_per_mole)
     #if new_e < old_e , delta e is >0 and p ==1
@@ -47,209 +69,1055 @@ def swap_with_msm_state(sim_obj, swap_folder,force_group,beta):
 
 
 class TicaSimulator(object):
-    def __init__(self, file_loc="metad_sim.pkl"):
+    """
+    Runs one replica. comm addresses replicas rather than processes, so the
+    same code drives one replica per mpi rank (the default) and several
+    replicas per process (see run_local_replicas).
+
+    :param file_loc: metad_sim.pkl location
+    :param comm: replica communicator, defaults to one replica per mpi rank
+    :param gpu_index: device to run on, defaults to one gpu per rank and host
+    :param cpu_threads: Threads property for the CPU platform
+    :param metad_sim: already loaded metad_sim.pkl, only used on rank 0
+    """
+    def __init__(self, file_loc="metad_sim.pkl", comm=None, gpu_index=None,
+                 cpu_threads=None, metad_sim=None):
         from tica_metadynamics.load_sim import create_simulation
+        start_time = time.time()
         self.file_loc = file_loc
-        self.metad_sim = load(self.file_loc)
+        self.comm = comm if comm is not None else MPIComm()
+        self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+        self.metad_sim, self.plumed_script = self.load_metad_sim(metad_sim)
         self.beta = 1/(boltzmann_constant * self.metad_sim.temp)
+        # older pickles predate the in-memory exchange
+        self.exchange_mode = getattr(self.metad_sim, "exchange_mode", "checkpoint")
+        self.checkpoint_interval = getattr(self.metad_sim, "checkpoint_interval", 1)
+        self.exchange_scheme = getattr(self.metad_sim, "exchange_scheme", "single")
+        self.exchange_overlap = getattr(self.metad_sim, "exchange_overlap", False)
+        self.overlap_chunk = getattr(self.metad_sim, "overlap_chunk", 1000)
+        self.max_lag = getattr(self.metad_sim, "max_lag", 0)
+        self._lag = 0
+        self.swap_rate = self.metad_sim.swap_rate
+        self.adaptive_swap_rate = getattr(self.metad_sim, "adaptive_swap_rate", False)
+        self.adapt_interval = getattr(self.metad_sim, "adapt_interval", 10)
+        self._steps_per_second = None
+        self._n_accepted_window = 0
+        self._n_logged_window = 0
+        self.exchange_timeout = getattr(self.metad_sim, "exchange_timeout", None)
+        self.heartbeat_timeout = getattr(self.metad_sim, "heartbeat_timeout", None)
+        self.checkpoint_ring = getattr(self.metad_sim, "checkpoint_ring", 0)
 
         #get
-        self.rank = rank
-        self.size = size
         self.host_name = socket.gethostname()
-        self.gpu_index = get_gpu_index()
+        self.gpu_index = gpu_index if gpu_index is not None else get_gpu_index(self.comm)
+
+        # the replicas of a walker are the tics and then the neutral replica,
+        # with all walkers in one pool (walker_comm='shared') rank r runs
+        # replica r%n of walker r//n
+        n_walker_replicas = self.metad_sim.n_tics + int(bool(self.metad_sim.neutral_replica))
+        self.tic_index = self.rank % n_walker_replicas
+        self.is_neutral = bool(self.metad_sim.neutral_replica) and \
+            self.tic_index == n_walker_replicas - 1
+        print("Hello from rank %d running tic %d on "
+          "host %s with gpu %d"%(self.rank, self.tic_index,
+                                 self.host_name, self.gpu_index))
+        self.walker_id = getattr(self.metad_sim, "walker_id", None)
+        if self.walker_id is not None:
+            print("I am walker %d running tic%d"%(self.walker_id, self.tic_index))
 
         #setup MSM swap stuff
         if self.metad_sim.msm_swap_folder is not None:
             self.setup_msm_swap()
 
-        print("Hello from rank %d running tic %d on "
-          "host %s with gpu %d"%(self.rank, self.rank,
-                                 self.host_name, self.gpu_index))
-        # if multi walkers
-        if hasattr(self.metad_sim,"n_walkers") and self.metad_sim.n_walkers > 1:
-            cbd = self.metad_sim.base_dir
-            walker_index = int(os.path.split(cbd)[1].strip("walker_"))
-            print("I am walker %d running tic%d"%(walker_index,self.rank))
-            self.metad_sim.walker_index = walker_index
-
-        if self.metad_sim.plumed_dict is not None:
-            self.plumed_force_dict = self.metad_sim.plumed_dict
+        # last replica is the neutral replica. All files are addressed
+        # through the folder since replicas sharing a process share the cwd
+        if self.is_neutral:
+            self.folder = os.path.join(self.metad_sim.base_dir, "neutral_replica")
         else:
-            self.plumed_force_dict = get_plumed_dict(self.metad_sim)
-
-        # last replica is the neutral replica
-        if self.metad_sim.neutral_replica and self.rank==self.size-1:
+            self.folder = os.path.join(self.metad_sim.base_dir, "tic_%d"%self.tic_index)
+        # index of the starting configuration this replica currently holds,
+        # it travels with the state on every accepted swap
+        self.configuration = self.rank
+        replica_snapshot = self.find_snapshot()
+        # trajectory, speed report and checkpoint on node local scratch
+        self.stager = None
+        if getattr(self.metad_sim, "scratch_dir", None) is not None:
+            self.stager = OutputStager(self.folder, self.metad_sim.scratch_dir,
+                                       self.metad_sim.scratch_sync_interval)
+        if self.is_neutral:
             from tica_metadynamics.load_sim import create_neutral_simulation
             self.sim_obj = create_neutral_simulation(self.metad_sim.base_dir,
                                                      self.metad_sim.starting_coordinates_folder,
                                                      self.gpu_index,
                                                      self.metad_sim.sim_save_rate,
-                                                     self.metad_sim.platform)
+                                                     self.metad_sim.platform,
+                                                     getattr(self.metad_sim, "bias_mts_steps", 1),
+                                                     cpu_threads,
+                                                     self.stager,
+                                                     **self.get_reporter_options())
         else:
             self.sim_obj, self.force_group = create_simulation(self.metad_sim.base_dir,
                                                            self.metad_sim.starting_coordinates_folder,
                                                            self.gpu_index,
-                                                           self.rank,
-                                                           self.plumed_force_dict[self.rank],
+                                                           self.tic_index,
+                                                           self.plumed_script,
                                                            self.metad_sim.sim_save_rate,
-                                                           self.metad_sim.platform)
+                                                           self.metad_sim.platform,
+                                                           getattr(self.metad_sim, "bias_mts_steps", 1),
+                                                           getattr(self.metad_sim, "bias_backend", "plumed"),
+                                                           cpu_threads,
+                                                           self.stager,
+                                                           **self.get_reporter_options())
+        if self.stager is not None:
+            self.stager.add_flush_callback(self.flush_reporters)
+        # wall clock breakdown of every iteration, see profiler.py
+        self.timer = PhaseTimer(os.path.join(self.folder, "timings.csv"),
+                                enabled=getattr(self.metad_sim, "profile_timings", False))
+        # every rank draws the same pairs and random numbers from this
+        # so the pairwise exchange needs no coordination through rank 0
+        seed = np.random.randint(2**31-1) if self.rank==0 else None
+        self.scheduler = ExchangeScheduler(self.size, self.exchange_scheme,
+                                           self.comm.bcast(seed, root=0))
+        self._pending_sends = []
+        # exchange messages that arrived before they were waited for, by
+        # (source, tag, iteration)
+        self._early_messages = {}
+        self._n_logged = 0
+        self._n_attempted = 0
+        # replicas still taking part in exchanges
+        self.alive = list(range(self.size))
+        self._pool_updates = []
+        self._dropped = []
+        self._last_heartbeat = [time.time()]*self.size
+        self._rates = [None]*self.size
         if self.rank ==0 and self.size > 1:
-            self.log_file = open("../swap_log.txt","a")
-            header = ["Iteration","S_i","S_j","Eii","Ejj","Eij","Eji",
-                      "DeltaE","Temp","Beta","Probability","Accepted"]
-            self.log_file.writelines("#{}\t{}\t{}\t{}\t{}\t{}"
-                                "\t{}\t{}\t{}\t{}\t{}\t{}\n".format(*header))
+            # buffered, with the acceptance and round trips in swap_summary.txt
+            self.swap_log = SwapLog(self.run_dir, self.size,
+                                    getattr(self.metad_sim, "swap_log_format", "text"),
+                                    self.start_iteration,
+                                    permutation_moves=self.exchange_mode == "gibbs",
+                                    buffer_size=getattr(self.metad_sim, "swap_log_buffer", 1),
+                                    ordered=self.exchange_mode == "pairwise")
+        if self.adaptive_swap_rate:
+            self.setup_adaptive_swap_rate()
+        self.convergence_tol = getattr(self.metad_sim, "convergence_tol", None)
+        if self.convergence_tol is not None:
+            self.setup_convergence_monitor()
+        self._snapshot_reports = {}
+        # rank 0's scheduler and pool at every snapshot, for the manifest
+        self._snapshot_exchange = {}
+        if replica_snapshot is not None:
+            self.restore_snapshot(*replica_snapshot)
+        if self._snapshot_manifest is not None:
+            self.restore_exchange_state(self._snapshot_manifest)
+        self.report_startup(time.time() - start_time)
+
+    def load_metad_sim(self, metad_sim=None):
+        # only rank 0 reads the pickle and renders the plumed scripts. Every
+        # replica gets its own script and a copy of the model without the
+        # large objects it doesn't use, so startup doesn't have every rank
+        # hitting the shared filesystem and holding the tica data at once.
+        # Job level files (swap log, snapshots, timings) go to the folder of
+        # the pickle, which is the top folder when walkers share a pool.
+        payloads = run_dir = None
+        if self.rank == 0:
+            from msmbuilder.utils import load
+            if metad_sim is None:
+                metad_sim = load(self.file_loc)
+            run_dir = metad_sim.base_dir
+            if get_launch_options(metad_sim)["walker_comm"] == "shared":
+                payloads = []
+                for w in range(metad_sim.walker_n):
+                    payloads.extend(get_walker_payloads(
+                        load(os.path.join(run_dir, "walker_%d"%w, "metad_sim.pkl"))))
+            else:
+                payloads = get_walker_payloads(metad_sim)
+            if len(payloads) != self.size:
+                raise ValueError("%d replicas need as many ranks, got %d"
+                                 %(len(payloads), self.size))
+        self.run_dir = self.comm.bcast(run_dir, root=0)
+        return self.comm.scatter(payloads, root=0)
+
+    def find_snapshot(self):
+        # newest complete snapshot of all replicas, see checkpoint.py. Sets
+        # the iteration to resume at and drops the hills deposited after the
+        # snapshot, which the bias would otherwise read back in.
+        self.start_iteration = self.step = self._last_snapshot = 0
+        self._snapshot_manifest = None
+        if not self.checkpoint_ring:
+            return None
+        snapshot = None
+        if self.rank == 0:
+            snapshot = find_latest_snapshot(self.run_dir)
+        snapshot_dir, manifest = self.comm.bcast(snapshot, root=0)
+        if snapshot_dir is None:
+            return None
+        self.start_iteration = self.step = self._last_snapshot = manifest["iteration"]
+        self._snapshot_manifest = manifest
+        replica_snapshot = load_replica_snapshot(snapshot_dir, self.rank)
+        if replica_snapshot is None:
+            print("Replica %d is missing from %s, starting it from its last "
+                  "checkpt.chk"%(self.rank, snapshot_dir), flush=True)
+            return None
+        hills_file = self.get_hills_file()
+        if hills_file is not None:
+            truncate_file(hills_file, replica_snapshot[1]["hills_size"])
+        return replica_snapshot
+
+    def restore_snapshot(self, checkpoint, metadata):
+        self.sim_obj.context.loadCheckpoint(checkpoint)
+        # reporters count from here
+        self.sim_obj.currentStep = metadata["current_step"]
+        self.configuration = metadata["configuration"]
+        self.swap_rate = metadata["swap_rate"]
+        self.scheduler.rng.set_state(metadata["scheduler_rng"])
+        np.random.set_state(metadata["numpy_rng"])
+        if self.adaptive_swap_rate and "swap_rate_scheduler" in metadata:
+            self.swap_rate_scheduler = metadata["swap_rate_scheduler"]
+        print("Replica %d resuming at iteration %d with configuration %d"
+              %(self.rank, self.start_iteration, self.configuration), flush=True)
+        return
+
+    def restore_exchange_state(self, manifest):
+        # every replica continues rank 0's pair stream and pool, also one
+        # that is missing from the snapshot and kept its fresh scheduler
+        if "scheduler_rng" in manifest:
+            self.scheduler.rng.set_state(manifest["scheduler_rng"])
+        if "alive" in manifest:
+            self.alive = list(manifest["alive"])
+            self._dropped = [r for r in range(self.size) if r not in self.alive]
+        return
+
+    def get_hills_file(self):
+        # walkers share their hills through WALKERS_DIR, those are left alone
+        if self.is_neutral or self.walker_id is not None:
+            return None
+        return os.path.join(self.folder, self.metad_sim.hills_file)
+
+    def write_snapshot(self, iteration):
+        # this replica's part of the snapshot taken after iteration-1, rank
+        # 0 completes it once every replica in the pool wrote theirs
+        hills_file = self.get_hills_file()
+        hills_size = None
+        if hills_file is not None:
+            hills_size = os.path.getsize(hills_file) if os.path.isfile(hills_file) else 0
+        metadata = {"iteration": iteration, "configuration": self.configuration,
+                    "current_step": self.sim_obj.currentStep, "swap_rate": self.swap_rate,
+                    "scheduler_rng": self.scheduler.rng.get_state(),
+                    "numpy_rng": np.random.get_state(), "hills_size": hills_size}
+        if self.rank == 0 and self.adaptive_swap_rate:
+            metadata["swap_rate_scheduler"] = self.swap_rate_scheduler
+        with self.timer.phase("checkpoint"):
+            write_replica_snapshot(get_snapshot_dir(self.run_dir, iteration),
+                                   self.rank, self.sim_obj.context.createCheckpoint(),
+                                   metadata)
+        self._last_snapshot = iteration
+        if self.rank == 0:
+            self._snapshot_exchange[iteration] = {"scheduler_rng": self.scheduler.rng.get_state(),
+                                                  "alive": list(self.alive)}
+            self.record_snapshot(0, (iteration, self.configuration))
+        else:
+            self._pending_sends.append(self.comm.isend((iteration, self.configuration),
+                                                       dest=0, tag=SNAPSHOT_TAG))
+        return
+
+    def record_snapshot(self, source, report):
+        iteration, configuration = report
+        reports = self._snapshot_reports.setdefault(iteration, {})
+        reports[source] = configuration
+        if not set(self.alive).issubset(reports.keys()):
+            return
+        manifest = {"iteration": iteration, "n_replicas": self.size,
+                    "replicas": sorted(reports.keys()),
+                    "permutation": [reports.get(r) for r in range(self.size)]}
+        manifest.update(self._snapshot_exchange.pop(iteration, {}))
+        # a resumed run truncates the log to the snapshot, the records
+        # before it have to be on disk
+        if self.size > 1:
+            self.swap_log.flush()
+        write_manifest(get_snapshot_dir(self.run_dir, iteration), manifest)
+        prune_snapshots(self.run_dir, self.checkpoint_ring)
+        del self._snapshot_reports[iteration]
+        return
+
+    def flush_snapshots(self):
+        # rank 0 completes the outstanding snapshots before the job ends
+        if self.rank != 0:
+            self._wait_for_sends()
+            return
+        start = time.time()
+        while len(self._snapshot_reports) > 0:
+            status = Status()
+            if self.comm.iprobe(source=ANY_SOURCE, tag=SNAPSHOT_TAG, status=status):
+                self.record_snapshot(status.Get_source(),
+                                     self.comm.recv(source=status.Get_source(),
+                                                    tag=SNAPSHOT_TAG))
+            elif self.exchange_timeout is not None and \
+                    time.time() - start > self.exchange_timeout:
+                print("Snapshots %s were left incomplete"
+                      %sorted(self._snapshot_reports.keys()), flush=True)
+                break
+            else:
+                time.sleep(0.01)
+        return
+
+    def report_startup(self, elapsed):
+        # rank 0 prints the table once every report came in, see poll_messages
+        report = (self.host_name, elapsed, get_peak_rss_mb())
+        print("Rank %d started in %.1f s, peak memory %.1f MB"%(self.rank, elapsed,
+                                                              report[2]), flush=True)
+        self._startup_reports = {}
+        if self.rank == 0:
+            self.collect_startup_report(0, report)
+        else:
+            self._pending_sends.append(self.comm.isend(report, dest=0, tag=STARTUP_TAG))
+        return
+
+    def collect_startup_report(self, source, report):
+        self._startup_reports[source] = report
+        if len(self._startup_reports) < self.size:
+            return
+        output = ["#rank\thost\tstartup_s\tpeak_rss_mb\n"]
+        for r in sorted(self._startup_reports.keys()):
+            output.append("%d\t%s\t%.1f\t%.1f\n"%((r,) + tuple(self._startup_reports[r])))
+        print(''.join(output), flush=True)
+        return
+
+    def setup_adaptive_swap_rate(self):
+        self.swap_rate_scheduler = AdaptiveSwapRate(self.metad_sim.swap_rate,
+                                                    self.metad_sim.min_swap_rate,
+                                                    self.metad_sim.max_swap_rate,
+                                                    self.metad_sim.target_acceptance)
+        # carry on from the acceptance of the previous job
+        acceptance = None
+        if self.rank == 0:
+            acceptance = load_acceptance(get_swap_log_file(
+                self.run_dir, getattr(self.metad_sim, "swap_log_format", "text")))
+        acceptance = self.comm.bcast(acceptance, root=0)
+        if acceptance is not None:
+            print("Starting with a running acceptance of %.3f"%acceptance)
+            self.swap_rate_scheduler.update(np.ones(self.size), acceptance)
+        self.swap_rate = int(round(self.swap_rate_scheduler.swap_rate))
+        return
+
+    def setup_convergence_monitor(self):
+        self.convergence_interval = self.metad_sim.convergence_interval
+        if self.rank != 0:
+            return
+        # with walkers the hills of every walker are in the shared
+        # WALKERS_DIR, named after the walker
+        hills_globs = []
+        for i in range(self.metad_sim.n_tics):
+            if self.walker_id is not None:
+                hills_globs.append(os.path.join(os.path.dirname(self.metad_sim.base_dir),
+                                                "data_tic%d"%i,
+                                                self.metad_sim.hills_file + ".*"))
+            else:
+                hills_globs.append(os.path.join(self.metad_sim.base_dir, "tic_%d"%i,
+                                                self.metad_sim.hills_file))
+        self.convergence_monitor = ConvergenceMonitor(hills_globs, self.convergence_tol,
+                                                      self.metad_sim.convergence_patience,
+                                                      self.metad_sim.min_acceptance,
+                                                      os.path.join(self.run_dir,
+                                                                   "convergence.txt"))
+        return
+
+    def check_convergence(self, iteration):
+        # rank 0 compares the free energy profiles to the previous check
+        # and tells every replica whether to stop after this iteration.
+        # Every replica waits for the answer, so all of them stop together.
+        if self.rank == 0:
+            n_attempted = n_accepted = 0
+            if self.size > 1:
+                self.flush_swap_log()
+                self.swap_log.flush()
+                n_attempted = self.swap_log.stats.attempted.sum()
+                n_accepted = self.swap_log.stats.accepted.sum()
+            converged = self.convergence_monitor.check(iteration, n_attempted, n_accepted)
+            for r in self.alive:
+                if r != 0:
+                    self._pending_sends.append(self.comm.isend(converged, dest=r,
+                                                               tag=CONVERGENCE_TAG))
+            if converged:
+                print("Converged after %d iterations, stopping"%iteration, flush=True)
+                with open(os.path.join(self.run_dir, CONVERGED_FILE), 'w') as f:
+                    f.write("%d\n"%iteration)
+            return converged
+        start = time.time()
+        while self.exchange_timeout is not None and \
+                not self.comm.iprobe(source=0, tag=CONVERGENCE_TAG):
+            if time.time() - start > self.exchange_timeout:
+                print("Rank %d timed out after %d s waiting for the convergence check "
+                      "at iteration %d. Aborting"%(self.rank, self.exchange_timeout,
+                                                   iteration), flush=True)
+                flush_all_stagers()
+                self.comm.Abort(1)
+            time.sleep(0.01)
+        return self.comm.recv(source=0, tag=CONVERGENCE_TAG)
 
     def setup_msm_swap(self):
-        self.full_list =  glob.glob(os.path.join(self.metad_sim.msm_swap_folder,"state*.xml"))
-        if self.metad_sim.msm_swap_scheme == 'random':
-            pass
-        elif self.metad_sim.msm_swap_scheme == 'swap_once':
-            self._tabu_list=[]
-        elif self.metad_sim.msm_swap_scheme in ['tabu_list','min_count','wt_msm']:
+        # the states are read from one memory mapped file, see
+        # msm_library.py. The launchers pack the state*.xml files of the
+        # folder into it before the replicas start, the first time and
+        # whenever the states changed.
+        import mdtraj as md
+        from .msm_library import get_msm_library_file, is_library_current, \
+            prepare_msm_library, wait_for_msm_library, load_msm_library
+        scheme = self.metad_sim.msm_swap_scheme
+        if scheme not in ['random','swap_once','tabu_list','min_count','wt_msm']:
+            raise ValueError("MSM swap scheme is invalid")
+        uses_models = scheme in ['tabu_list','min_count','wt_msm']
+        if uses_models and not self.is_neutral:
             self.featurizer = self.metad_sim.featurizer
             self.tica_mdl = self.metad_sim.tica_mdl
             self.kmeans_mdl  = self.metad_sim.kmeans_mdl
             self.nrm = self.metad_sim.nrm
             self.top = md.load(os.path.join(self.metad_sim.starting_coordinates_folder,"0.pdb"))
-            self.known_msm_states = {}
-            for i in self.full_list:
-                state = XmlSerializer.deserialize(open(i).read())
-                self.top.xyz=np.array(state.getPositions()/nanometer)
-                if self.nrm is not None:
-                    self.known_msm_states[i] = self.kmeans_mdl.transform(
-                                                            self.tica_mdl.transform(
-                                                                [self.nrm.transform(
-                                                                    self.featurizer.transform([self.top])[0])]
-                                                            ))[0][0]
-                else:
-                    self.known_msm_states[i] = self.kmeans_mdl.transform(
-                                                            self.tica_mdl.transform(
-                                                                self.featurizer.transform([self.top])
-                                                            ))[0][0]
-                print(i, self.known_msm_states[i])
-            if self.metad_sim.msm_swap_scheme=='wt_msm':
-                self.wt_msm_mdl = self.metad_sim.wt_msm_mdl
-
-        else:
-            raise ValueError("MSM swap scheme is invalid")
-
+        swap_folder = self.metad_sim.msm_swap_folder
+        library_file = get_msm_library_file(swap_folder)
+        if not is_library_current(library_file, swap_folder, uses_models):
+            # replicas created without a launcher: rank 0 packs it, the
+            # others wait for the file rather than for rank 0
+            if self.rank == 0:
+                prepare_msm_library(self.metad_sim)
+            else:
+                wait_for_msm_library(library_file, swap_folder, uses_models)
+        self.msm_library = load_msm_library(library_file)
+        if uses_models and self.msm_library.assignments is None:
+            raise ValueError("%s was packed without the msm states the %s scheme needs, "
+                             "pack it again with the models"%(library_file, scheme))
+        self.full_list = np.arange(len(self.msm_library))
+        if scheme == 'swap_once':
+            self._tabu_list=[]
+        elif scheme == 'wt_msm' and not self.is_neutral:
+            self.wt_msm_mdl = self.metad_sim.wt_msm_mdl
+            # msm state of every library state, looked up on every swap
+            self._wt_msm_states = [self.wt_msm_mdl.transform([k])[0]
+                                   for k in self.msm_library.assignments]
         return
 
     def run(self):
-        for step in range(self.metad_sim.n_iterations):
+        # iteration the run stops at, earlier if it converges
+        end_iteration = self.metad_sim.n_iterations
+        if os.path.isfile(os.path.join(self.run_dir, CONVERGED_FILE)):
+            print("The run converged already, see %s"%CONVERGED_FILE, flush=True)
+            end_iteration = self.start_iteration
+        elif self.start_iteration >= self.metad_sim.n_iterations:
+            print("All %d iterations are done already"%self.metad_sim.n_iterations,
+                  flush=True)
+        for step in range(self.start_iteration, end_iteration):
             # for eg 2fs *3000 = 6ps
             self.step = step
-            self.sim_obj.step(self.metad_sim.swap_rate)
+            self._lag = 0
+            start_time = time.time()
+            with self.timer.phase("md"):
+                self.sim_obj.step(self.swap_rate)
+            self.record_speed(self.swap_rate, time.time()-start_time)
             current_sim_time = self.sim_obj.context.getState().getTime()
             if self.metad_sim.msm_swap_folder is not None:
-                self.mix_with_msm()
-            self.mix_all_replicas()
-            comm.barrier()
-            self.sim_obj.context.setTime(current_sim_time)
+                with self.timer.phase("msm_swap"):
+                    self.mix_with_msm()
+            with self.timer.phase("exchange"):
+                self.poll_messages()
+                if self.rank not in self.alive:
+                    print("Replica %d was dropped from the exchange pool, stopping at "
+                          "iteration %d"%(self.rank, step), flush=True)
+                    end_iteration = step
+                    break
+                if self.exchange_mode == "gibbs":
+                    # permutation is drawn from the full energy matrix
+                    self.rendezvous()
+                    self.gibbs_exchange()
+                else:
+                    pairs, rnds = self.scheduler.get_pairs(step, self.alive)
+                    self._n_attempted += len(pairs)
+                    if self.exchange_mode == "pairwise" and self.rank == 0 and self.size > 1:
+                        self.swap_log.expect(step, pairs)
+                    if self.exchange_mode == "pairwise":
+                        # only the selected pairs talk, no barrier needed
+                        self.pair_exchange(pairs, rnds)
+                    else:
+                        self.rendezvous()
+                        self.mix_all_replicas(pairs, rnds)
+                        self.rendezvous()
+            # plus whatever speculative md survived the exchange
+            self.sim_obj.context.setTime(current_sim_time +
+                                         self._lag*self.overlap_chunk*
+                                         self.sim_obj.integrator.getStepSize())
+            # in checkpoint mode the exchange already wrote it
+            if self.exchange_mode != "checkpoint" and \
+                    (step+1) % self.checkpoint_interval == 0:
+                self.write_checkpoint()
+            if self.adaptive_swap_rate and (step+1) % self.adapt_interval == 0:
+                self.update_swap_rate()
+            if self.checkpoint_ring and (step+1) % self.checkpoint_interval == 0:
+                self.write_snapshot(step+1)
+            self.timer.end_iteration(step)
+            if self.convergence_tol is not None and \
+                    (step+1) % self.convergence_interval == 0 and \
+                    self.check_convergence(step+1):
+                end_iteration = step+1
+                break
+        if self.exchange_mode != "checkpoint":
+            self.write_checkpoint()
+        if self.checkpoint_ring:
+            if self._last_snapshot < end_iteration:
+                self.write_snapshot(end_iteration)
+            self.flush_snapshots()
+        if self.exchange_mode == "pairwise":
+            self.flush_swap_log(n_expected=self._n_attempted)
         if self.rank==0 and self.size >1:
-            self.log_file.close()
+            self.swap_log.close()
+        self.report_timings()
+        if self.stager is not None:
+            self.stager.close()
+        self.wait_for_survivors()
+
+    def report_timings(self):
+        # every rank sends its totals to rank 0 which writes the summary
+        if not self.timer.enabled:
+            return
+        self.timer.flush()
+        if self.rank != 0:
+            self.comm.isend(self.timer.summary(), dest=0, tag=TIMING_TAG).wait()
+            return
+        summaries = {0: self.timer.summary()}
+        start = time.time()
+        while not set(self.alive).issubset(summaries.keys()):
+            status = Status()
+            if self.comm.iprobe(source=ANY_SOURCE, tag=TIMING_TAG, status=status):
+                summaries[status.Get_source()] = self.comm.recv(source=status.Get_source(),
+                                                           tag=TIMING_TAG)
+            elif self.exchange_timeout is not None and \
+                    time.time() - start > self.exchange_timeout:
+                break
+            else:
+                time.sleep(0.01)
+        report = summarize_timings(summaries)
+        print(report, flush=True)
+        with open(os.path.join(self.run_dir, "timing_summary.txt"), 'w') as f:
+            f.writelines(report)
+        return
+
+    def rendezvous(self):
+        # a barrier that gives up after exchange_timeout. The collective
+        # exchanges can't continue without every rank, so rather than burn
+        # the rest of the allocation in a deadlock the job is aborted.
+        if self.exchange_timeout is None:
+            self.comm.barrier()
+            return
+        req = self.comm.Ibarrier()
+        start = time.time()
+        while not req.Test():
+            if time.time() - start > self.exchange_timeout:
+                print("Rank %d timed out after %d s waiting for the other replicas "
+                      "at iteration %d. Aborting"%(self.rank, self.exchange_timeout,
+                                                   self.step), flush=True)
+                flush_all_stagers()
+                self.comm.Abort(1)
+            time.sleep(0.01)
+        return
 
+    def poll_messages(self):
+        # everything the coordinator (rank 0) and the other ranks tell each
+        # other outside of the exchange itself: heartbeats, changes to the
+        # exchange pool and new segment lengths
+        if self.size < 2:
+            return
+        status = Status()
+        if self.rank == 0:
+            now = time.time()
+            while self.comm.iprobe(source=ANY_SOURCE, tag=STARTUP_TAG, status=status):
+                source = status.Get_source()
+                self.collect_startup_report(source, self.comm.recv(source=source,
+                                                                   tag=STARTUP_TAG))
+            while self.comm.iprobe(source=ANY_SOURCE, tag=HEARTBEAT_TAG, status=status):
+                source = status.Get_source()
+                self.comm.recv(source=source, tag=HEARTBEAT_TAG)
+                self._last_heartbeat[source] = now
+            while self.comm.iprobe(source=ANY_SOURCE, tag=RATE_TAG, status=status):
+                source = status.Get_source()
+                self._rates[source] = self.comm.recv(source=source, tag=RATE_TAG)
+            while self.comm.iprobe(source=ANY_SOURCE, tag=SNAPSHOT_TAG, status=status):
+                source = status.Get_source()
+                self.record_snapshot(source, self.comm.recv(source=source,
+                                                            tag=SNAPSHOT_TAG))
+            if self.heartbeat_timeout is not None:
+                dead = [r for r in self.alive if r != 0 and r not in self._dropped
+                        and now - self._last_heartbeat[r] > self.heartbeat_timeout]
+                if len(dead) > 0:
+                    self.drop_replicas(dead)
+        else:
+            if self.heartbeat_timeout is not None:
+                self._pending_sends.append(self.comm.isend(self.step, dest=0, tag=HEARTBEAT_TAG))
+            while self.comm.iprobe(source=0, tag=POOL_TAG):
+                self._pool_updates.append(self.comm.recv(source=0, tag=POOL_TAG))
+            while self.comm.iprobe(source=0, tag=SEGMENT_TAG):
+                self.swap_rate = self.comm.recv(source=0, tag=SEGMENT_TAG)
+        # pool changes only take effect at an agreed iteration so that all
+        # ranks keep drawing the same pairs
+        for effective_step, alive in list(self._pool_updates):
+            if effective_step <= self.step:
+                self.alive = alive
+                self._pool_updates.remove((effective_step, alive))
+        self._pending_sends = [req for req in self._pending_sends if not req.test()[0]]
+        return
+
+    def drop_replicas(self, dead):
+        alive = [r for r in self.alive if r not in dead and r not in self._dropped]
+        update = (self.step + 2, alive)
+        print("No heartbeat from replicas %s for %d s. Continuing with replicas %s "
+              "from iteration %d"%(dead, self.heartbeat_timeout, alive, update[0]),
+              flush=True)
+        # the dropped replicas are told as well in case they are only slow,
+        # they stop once the update takes effect
+        for r in self.alive:
+            if r != 0 and r not in self._dropped:
+                self._pending_sends.append(self.comm.isend(update, dest=r, tag=POOL_TAG))
+        self._pool_updates.append(update)
+        self._dropped.extend(dead)
+        self.swap_log.abandon(dead)
+        return
+
+    def wait_for_survivors(self):
+        # replicas that were dropped never reach MPI finalize, so once all
+        # survivors are done rank 0 takes the job down itself
+        if self.heartbeat_timeout is None or self.size < 2:
+            return
+        if self.rank != 0:
+            self.comm.isend(self.step, dest=0, tag=DONE_TAG).wait()
+            return
+        done = set([0])
+        start = time.time()
+        while not set(self.alive).issubset(done) and \
+                time.time() - start < self.heartbeat_timeout:
+            status = Status()
+            if self.comm.iprobe(source=ANY_SOURCE, tag=DONE_TAG, status=status):
+                self.comm.recv(source=status.Get_source(), tag=DONE_TAG)
+                done.add(status.Get_source())
+            else:
+                time.sleep(0.01)
+        if len(self._dropped) > 0:
+            print("Replicas %s were dropped during the run. Aborting the job now "
+                  "that the others are done"%self._dropped, flush=True)
+            self.comm.Abort(0)
+        return
+
+    def record_speed(self, n_steps, elapsed):
+        # exponential moving average of steps per second
+        speed = n_steps/max(elapsed, 1e-9)
+        if self._steps_per_second is None:
+            self._steps_per_second = speed
+        else:
+            self._steps_per_second = 0.7*self._steps_per_second + 0.3*speed
+        return
+
+    def update_swap_rate(self):
+        # ranks report their speed to rank 0, which answers with new
+        # segment lengths. Nobody waits, rank 0 uses the latest speeds
+        # it has heard of and the ranks pick up the answer in poll_messages.
+        from simtk.unit import nanosecond
+        if self.rank != 0:
+            self._pending_sends.append(self.comm.isend(self._steps_per_second,
+                                                  dest=0, tag=RATE_TAG))
+            return
+        self._rates[0] = self._steps_per_second
+        acceptance = None
+        if self._n_logged_window > 0:
+            acceptance = self._n_accepted_window/self._n_logged_window
+            self._n_accepted_window = self._n_logged_window = 0
+        known = [self._rates[r] for r in self.alive if self._rates[r] is not None]
+        rates = [self._rates[r] if self._rates[r] is not None else np.median(known)
+                 for r in self.alive]
+        segment_steps = self.swap_rate_scheduler.update(rates, acceptance)
+        for r, n_steps in zip(self.alive, segment_steps):
+            if r == 0:
+                self.swap_rate = int(n_steps)
+            else:
+                self._pending_sends.append(self.comm.isend(int(n_steps), dest=r,
+                                                      tag=SEGMENT_TAG))
+        dt = self.sim_obj.integrator.getStepSize().value_in_unit(nanosecond)
+        print("Acceptance %s, ns/day per rank %s, new segment lengths %s"
+              %(acceptance, np.round(np.array(rates)*dt*86400, 2),
+                segment_steps), flush=True)
+        return
+
+    def _send_swap_log(self, header):
+        if self.rank == 0:
+            self.write_swap_log(header)
+        else:
+            self._pending_sends.append(self.comm.isend(header, dest=0, tag=SWAP_LOG_TAG))
+        return
+
+    def write_swap_log(self, header):
+        if len(header) == 3:
+            # (iteration, S_i, S_j) of an exchange that timed out
+            self.swap_log.skip(*header)
+            self._n_logged += 1
+            return
+        self.swap_log.record(header)
+        self._n_logged += 1
+        self._n_logged_window += 1
+        self._n_accepted_window += header[-1]
+        return
+
+    def flush_swap_log(self, n_expected=None):
+        # rank 0 drains the records sent by the pairs. If n_expected is
+        # given it blocks until that many records have been written, or
+        # until the exchange timeout if records from dropped replicas
+        # will never come.
+        if self.rank == 0 and self.size > 1:
+            while self.comm.iprobe(source=ANY_SOURCE, tag=SWAP_LOG_TAG):
+                self.write_swap_log(self.comm.recv(source=ANY_SOURCE, tag=SWAP_LOG_TAG))
+            if n_expected is not None:
+                start = time.time()
+                while self._n_logged < n_expected:
+                    if self.exchange_timeout is None:
+                        self.write_swap_log(self.comm.recv(source=ANY_SOURCE,
+                                                      tag=SWAP_LOG_TAG))
+                    elif self.comm.iprobe(source=ANY_SOURCE, tag=SWAP_LOG_TAG):
+                        self.write_swap_log(self.comm.recv(source=ANY_SOURCE,
+                                                      tag=SWAP_LOG_TAG))
+                    elif time.time() - start > self.exchange_timeout:
+                        print("Missing %d swap log records"%(n_expected-self._n_logged))
+                        break
+                    else:
+                        time.sleep(0.01)
+        if n_expected is not None:
+            self._wait_for_sends()
+        return
+
+    def _wait_for_sends(self):
+        # sends to a dropped replica never complete, don't wait on those forever
+        start = time.time()
+        while len(self._pending_sends) > 0:
+            self._pending_sends = [req for req in self._pending_sends
+                                   if not req.test()[0]]
+            if self.exchange_timeout is not None and \
+                    time.time() - start > self.exchange_timeout:
+                break
+            time.sleep(0.01)
+        return
+
+    def pair_exchange(self, pairs, rnds):
+        # pairs are disjoint so each rank is in at most one of them. i is
+        # always the lower rank (and rank 0 if present)
+        my_pair = [(k, pair) for k, pair in enumerate(pairs) if self.rank in pair]
+        if len(my_pair) == 0:
+            self.flush_swap_log()
+            return
+        k, (i, j) = my_pair[0]
+        rnd = rnds[k]
+        partner = j if self.rank == i else i
+        old_energy = self.get_energy()
+        old_state = get_replica_state(self.sim_obj)
+        old_state["configuration"] = self.configuration
+        trade = self._trade(partner, old_state, old_energy)
+        if trade is None:
+            # partner never answered, nothing changes for us
+            print("Replica %d did not answer the exchange at iteration %d"
+                  %(partner, self.step), flush=True)
+            # rank 0 is told so that it doesn't hold the log back for it
+            if self.rank == i:
+                self._send_swap_log([self.step, i, j])
+            self.flush_swap_log()
+            return
+        partner_state, partner_energy, cross_energy, partner_cross_energy = trade
+        # both sides use the same ordering so they reach the same decision
+        if self.rank == i:
+            e_i_i, e_j_j, e_i_j, e_j_i = old_energy, partner_energy, \
+                                         cross_energy, partner_cross_energy
+        else:
+            e_i_i, e_j_j, e_i_j, e_j_i = partner_energy, old_energy, \
+                                         partner_cross_energy, cross_energy
+        delta_e, probability = get_swap_probability(self.beta, e_i_i, e_j_j, e_i_j, e_j_i)
+        if probability >= rnd:
+            accepted = 1
+            print("Swapping out %d with %d"%(i,j), flush=True)
+            # any speculative md is thrown away
+            self.set_state(partner_state)
+            self.configuration = partner_state["configuration"]
+            self._lag = 0
+        else:
+            accepted = 0
+            print("Failed Swap of %d with %d"%(i,j), flush=True)
+
+        if self.rank == i:
+            header = [self.step, i, j, e_i_i,e_j_j,e_i_j,e_j_i,delta_e,
+                      self.metad_sim.temp,self.beta,probability,accepted]
+            self._send_swap_log(header)
+        self.flush_swap_log()
+        return
+
+    def _wait_for_partner(self, source, tag):
+        # with exchange_overlap we keep running md in small chunks while the
+        # partner catches up, at most max_lag chunks per exchange. After
+        # that we block, or give up after exchange_timeout and return None.
+        # Messages carry their iteration: the late answer to an exchange
+        # that timed out is dropped, and one for a later exchange is kept
+        # until then. It also means the partner gave up on this exchange,
+        # so we stop waiting for it right away.
+        start = time.time()
+        for key in list(self._early_messages):
+            if key[2] < self.step:
+                del self._early_messages[key]
+        while True:
+            key = (source, tag, self.step)
+            if key in self._early_messages:
+                return self._early_messages.pop(key)
+            if any(s == source and iteration > self.step
+                   for s, _, iteration in self._early_messages):
+                return None
+            overlapping = self.exchange_overlap and self._lag < self.max_lag
+            arrived = [t for t in (STATE_TAG, ENERGY_TAG)
+                       if self.comm.iprobe(source=source, tag=t)]
+            if len(arrived) == 0 and self.exchange_timeout is None and not overlapping:
+                arrived = [tag]
+            if len(arrived) > 0:
+                for t in arrived:
+                    iteration, message = self.comm.recv(source=source, tag=t)
+                    if iteration >= self.step:
+                        self._early_messages[(source, t, iteration)] = message
+            elif overlapping:
+                with self.timer.phase("md"):
+                    self.sim_obj.step(self.overlap_chunk)
+                self._lag += 1
+            elif time.time() - start > self.exchange_timeout:
+                return None
+            else:
+                time.sleep(0.01)
+
+    def _trade(self, partner, old_state, old_energy):
+        # the exchange is decided on the states at the segment boundary.
+        # Speculative md done while waiting is kept if the swap is rejected
+        # and dropped if it is accepted.
+        self._pending_sends.append(self.comm.isend((self.step, (old_state, old_energy)),
+                                              dest=partner, tag=STATE_TAG))
+        message = self._wait_for_partner(partner, STATE_TAG)
+        if message is None:
+            return None
+        partner_state, partner_energy = message
+        if self._lag > 0:
+            current_state = get_replica_state(self.sim_obj)
+        else:
+            current_state = old_state
+        self.set_positions(partner_state)
+        cross_energy = self.get_energy()
+        self.set_positions(current_state)
+        self._pending_sends.append(self.comm.isend((self.step, cross_energy), dest=partner,
+                                                   tag=ENERGY_TAG))
+        partner_cross_energy = self._wait_for_partner(partner, ENERGY_TAG)
+        if partner_cross_energy is None:
+            return None
+        return partner_state, partner_energy, cross_energy, partner_cross_energy
+
+    def load_trajectory(self):
+        import mdtraj as md
+        from .reporters import get_atom_subset
+        traj_options = self.get_reporter_options()
+        top = self.top
+        if traj_options["traj_atoms"] is not None:
+            top = self.top.atom_slice(get_atom_subset(self.top.topology,
+                                                      traj_options["traj_atoms"]))
+        # frames may still sit in the reporters' buffers or queues
+        self.flush_reporters()
+        traj_file = os.path.join(self.folder, "trajectory.%s"%traj_options["traj_format"])
+        if self.stager is not None:
+            # the copy in self.folder lags the scratch file by up to a sync
+            # interval, read the one the reporter is writing
+            traj_file = self.stager.path("trajectory.%s"%traj_options["traj_format"])
+        return md.load(traj_file, top=top)
+
+    def get_reporter_options(self):
+        # older pickles write the whole system to a dcd, synchronously
+        return {"traj_format": getattr(self.metad_sim, "traj_format", "dcd"),
+                "traj_atoms": getattr(self.metad_sim, "traj_atoms", None),
+                "traj_chunk_size": getattr(self.metad_sim, "traj_chunk_size", 100),
+                "async_reporters": getattr(self.metad_sim, "async_reporters", False)}
+
+    def flush_reporters(self):
+        # python buffers what the reporters write and the async reporters
+        # may still have frames queued, push it all to the files before a
+        # checkpoint and the stager's final sync
+        for reporter in self.sim_obj.reporters:
+            if hasattr(reporter, "flush"):
+                reporter.flush()
+                continue
+            out = getattr(reporter, "_out", None)
+            if out is not None and not out.closed:
+                out.flush()
+        return
+
+    def write_checkpoint(self):
+        checkpoint_file = os.path.join(self.folder, "checkpt.chk")
+        # in checkpoint mode the file is how states are exchanged, so it
+        # has to stay on the shared filesystem
+        if self.stager is not None and self.exchange_mode != "checkpoint":
+            checkpoint_file = self.stager.path("checkpt.chk", append=False)
+        with self.timer.phase("checkpoint"):
+            # the trajectory on disk has to be as long as the checkpoint,
+            # including frames still queued or held back in a chunk
+            self.flush_reporters()
+            with open(checkpoint_file,'wb') as f:
+                f.write(self.sim_obj.context.createCheckpoint())
+        return checkpoint_file
+
+    def get_state(self):
+        # checkpoint mode sends the path of the file, memory mode sends
+        # the numpy buffers themselves
+        if self.exchange_mode == "checkpoint":
+            return self.write_checkpoint()
+        return get_replica_state(self.sim_obj)
+
+    def set_state(self, new_state):
+        with self.timer.phase("load_state"):
+            if isinstance(new_state, str):
+                with open(new_state, 'rb') as f:
+                    self.sim_obj.context.loadCheckpoint(f.read())
+            else:
+                set_replica_state(self.sim_obj, new_state)
+        return
+
+    def set_positions(self, new_state):
+        with self.timer.phase("load_state"):
+            set_replica_positions(self.sim_obj, new_state)
+        return
 
     def get_energy(self):
-        if self.metad_sim.neutral_replica and self.rank==self.size-1:
+        from simtk.unit import kilojoule_per_mole
+        if self.is_neutral:
             return 0
         else:
-            return self.sim_obj.context.getState(getEnergy=True,groups={self.force_group}).\
-                getPotentialEnergy().value_in_unit(kilojoule_per_mole)
+            with self.timer.phase("energy"):
+                return self.sim_obj.context.getState(getEnergy=True,groups={self.force_group}).\
+                    getPotentialEnergy().value_in_unit(kilojoule_per_mole)
 
-    def mix_all_replicas(self):
+    def mix_all_replicas(self, pairs, rnds):
         old_energy = self.get_energy()
-        #write the chckpt
-        with open("checkpt.chk",'wb') as f:
-            f.write(self.sim_obj.context.createCheckpoint())
-        old_state = os.path.abspath("checkpt.chk")
+        old_state = self.get_state()
         #send state and energy
-        data = comm.gather((old_state,old_energy), root=0)
+        data = self.comm.gather((old_state,old_energy,self.configuration), root=0)
         if self.size >1:
             if self.rank==0:
-                #rnd pick 2 states
-                i,j =  np.random.choice(np.arange(self.size), 2, replace=False)
-                s_i_i, e_i_i = data[i]
-                s_j_j,e_j_j = data[j]
+                old_energies = [e for _, e, _ in data]
                 #swap out states
-                data[j], data[i] = data[i],data[j]
+                for i, j in pairs:
+                    data[j], data[i] = data[i],data[j]
             else:
                 data = None
 
             #get possible new state
             new_state = None
-            new_state, energy = comm.scatter(data,root=0)
+            new_state, energy, _ = self.comm.scatter(data,root=0)
             #set state
-            with open(new_state, 'rb') as f:
-                self.sim_obj.context.loadCheckpoint(f.read())
+            self.set_state(new_state)
 
-            # return new state and new energies
+            # return new energies, rank 0 still holds the swapped state list
             new_energy = self.get_energy()
-            data = comm.gather((new_state,new_energy), root=0)
+            energies = self.comm.gather(new_energy, root=0)
 
-            if rank==0:
-                s_i_j, e_i_j = data[i]
-                s_j_i, e_j_i = data[j]
-                delta_e = e_i_i+e_j_j - e_i_j - e_j_i
-
-                #delta e is old_energy minus new energy
-                #if new energy is higher than old energy,
-                # delta_e is small-large < 0
-                #if new energy is lower than older energy,
-                # delta_e is large-small > 0, i.e. accept
-
-                #if delta e >0, exp > 0 and prob = 1
-                # else its a finite number
-                probability = np.min((1, np.exp(self.beta*delta_e)))
-
-                print(e_i_i,e_j_j,e_i_j,e_j_i,probability)
-                # check if we are greater than random .
-                # if probabilty is 0.05, this should fail about 95% of the time.
-                #
-                if probability >= np.random.random():
-                    accepted= 1
-                    print("Swapping out %d with %d"%(i,j),
-                          flush=True)
-                else:
-                    accepted= 0
-                    print("Failed Swap of %d with %d"%(i,j),
-                          flush=True)
-                    #go back to original state list
-                    data[i], data[j] = data[j] , data[i]
-                header = [self.step, i, j, e_i_i,e_j_j,e_i_j,e_j_i,delta_e,
-                          self.metad_sim.temp,self.beta,probability,accepted]
-                self.log_file.writelines("{}\t{}\t{}\t{}\t{}\t{}\t"
-                                         "{}\t{}\t{}\t{}\t{}\t{}\n".format(*header))
-                self.log_file.flush()
+            if self.rank==0:
+                for (i, j), rnd in zip(pairs, rnds):
+                    e_i_i, e_j_j = old_energies[i], old_energies[j]
+                    e_i_j, e_j_i = energies[i], energies[j]
+                    delta_e, probability = get_swap_probability(self.beta, e_i_i, e_j_j,
+                                                                e_i_j, e_j_i)
+
+                    print(e_i_i,e_j_j,e_i_j,e_j_i,probability)
+                    # check if we are greater than random .
+                    # if probabilty is 0.05, this should fail about 95% of the time.
+                    #
+                    if probability >= rnd:
+                        accepted= 1
+                        print("Swapping out %d with %d"%(i,j),
+                              flush=True)
+                    else:
+                        accepted= 0
+                        print("Failed Swap of %d with %d"%(i,j),
+                              flush=True)
+                        #go back to original state list
+                        data[i], data[j] = data[j] , data[i]
+                    header = [self.step, i, j, e_i_i,e_j_j,e_i_j,e_j_i,delta_e,
+                              self.metad_sim.temp,self.beta,probability,accepted]
+                    self.write_swap_log(header)
             else:
                 data = None
 
             #get final state for iteration
-            new_state,energy = comm.scatter(data,root=0)
+            new_state, energy, self.configuration = self.comm.scatter(data,root=0)
             #print(rank,new_state)
-            with open(new_state, 'rb') as f:
-                self.sim_obj.context.loadCheckpoint(f.read())
+            self.set_state(new_state)
+        return
+
+    def get_bias_energies(self, states):
+        # bias energy of this replica on every configuration, reusing the
+        # already known energy of our own one
+        own_energy = self.get_energy()
+        energies = []
+        for k, state in enumerate(states):
+            if k == self.rank:
+                energies.append(own_energy)
+            else:
+                self.set_positions(state)
+                energies.append(self.get_energy())
+        self.set_positions(states[self.rank])
+        return energies
+
+    def gibbs_exchange(self):
+        if self.size < 2:
+            return
+        old_state = get_replica_state(self.sim_obj)
+        # only positions and box are needed for the energies
+        states = self.comm.allgather({"positions": old_state["positions"],
+                                 "box_vectors": old_state["box_vectors"]})
+        energy_matrix = self.comm.gather(self.get_bias_energies(states), root=0)
+        if self.rank == 0:
+            energy_matrix = np.array(energy_matrix)
+            permutation = sample_permutation(self.beta*energy_matrix)
+            for i in range(self.size):
+                j = permutation[i]
+                e_i_i, e_j_j = energy_matrix[i, i], energy_matrix[j, j]
+                e_i_j, e_j_i = energy_matrix[i, j], energy_matrix[j, i]
+                delta_e, probability = get_swap_probability(self.beta, e_i_i, e_j_j,
+                                                            e_i_j, e_j_i)
+                header = [self.step, i, j, e_i_i, e_j_j, e_i_j, e_j_i, delta_e,
+                          self.metad_sim.temp, self.beta, probability, int(i != j)]
+                self.write_swap_log(header)
+            print("New permutation %s"%permutation, flush=True)
+        else:
+            permutation = None
+        permutation = self.comm.bcast(permutation, root=0)
+        # full states (with velocities) only move between replicas whose
+        # configuration changed. permutation[m] is the configuration m gets.
+        source = permutation[self.rank]
+        dest = int(np.where(permutation == self.rank)[0][0])
+        if source != self.rank:
+            old_state["configuration"] = self.configuration
+            new_state = self.comm.sendrecv(old_state, dest=dest, sendtag=STATE_TAG,
+                                      source=source, recvtag=STATE_TAG)
+            self.set_state(new_state)
+            self.configuration = new_state["configuration"]
         return
 
     def mix_with_msm(self):
-        if self.metad_sim.neutral_replica and self.rank==self.size-1:
+        import mdtraj as md
+        from simtk.unit import nanometer, kilojoule_per_mole
+        if self.is_neutral:
             return
+        library = self.msm_library
         if self.metad_sim.msm_swap_scheme=='random':
             flist = self.full_list
         elif self.metad_sim.msm_swap_scheme == 'swap_once':
-            flist = list(set(self.full_list).difference(set(self._tabu_list)))
+            flist = np.setdiff1d(self.full_list, self._tabu_list)
         elif self.metad_sim.msm_swap_scheme in ['tabu_list',"min_count"]:
-            current_traj = md.load("./trajectory.dcd", top=self.top)
+            current_traj = self.load_trajectory()
             current_states = self.kmeans_mdl.transform(self.tica_mdl.transform(
                                                 self.featurizer.transform([current_traj])))[0]
 
             if self.metad_sim.msm_swap_scheme == 'tabu_list':
                 current_states =  np.unique(current_states)
-                flist = [fname for fname in self.known_msm_states.keys()
-                         if self.known_msm_states[fname]
-                                   not in current_states]
+                flist = np.flatnonzero(~np.isin(library.assignments, current_states))
             else:
                 #count accessible states
                 flist = []
@@ -257,8 +1125,7 @@ class TicaSimulator(object):
                                          minlength=self.kmeans_mdl.n_clusters)
                 bin_priority = np.argsort(bin_counts)
                 for bin_index in bin_priority:
-                    flist = [fname for fname in self.known_msm_states.keys()
-                         if self.known_msm_states[fname]==bin_index]
+                    flist = library.states_in_cluster(bin_index)
                     if len(flist)>0:
                         break
         elif self.metad_sim.msm_swap_scheme == 'wt_msm':
@@ -280,9 +1147,9 @@ class TicaSimulator(object):
             next_likely_state = np.random.choice(range(self.wt_msm_mdl.n_states_),
                                                   size=1,
                                                   p=self.wt_msm_mdl.transmat_[self.msm_state,:])[0]
-            flist = [fname for fname in self.known_msm_states.keys()
-                     if self.wt_msm_mdl.transform([self.known_msm_states[fname]])[0] == next_likely_state]
-            print(self.msm_state, next_likely_state, flist)
+            flist = [k for k in self.full_list
+                     if self._wt_msm_states[k] == next_likely_state]
+            print(self.msm_state, next_likely_state, [library.names[k] for k in flist])
 
         else:
             raise ValueError("Sorry that MSM sampler is not implemented")
@@ -290,7 +1157,8 @@ class TicaSimulator(object):
             print("Already done all possible MSM swaps or state not found. Returning")
             return
         print("Found %d states"%len(flist), flush=True)
-        random_chck = np.random.choice(flist)
+        swap_index = np.random.choice(flist)
+        random_chck = library.names[swap_index]
         print("Attempting swap with %s"%random_chck, flush=True)
         old_state=self.sim_obj.context.getState(getPositions=True, getVelocities=True,\
         getForces=True,getEnergy=True,getParameters=True,enforcePeriodicBox=True)
@@ -298,8 +1166,8 @@ class TicaSimulator(object):
         old_energy = self.sim_obj.context.getState(getEnergy=True,groups={self.force_group}).\
             getPotentialEnergy().value_in_unit(kilojoule_per_mole)
 
-        new_state = XmlSerializer.deserialize(open(random_chck).read())
-        self.sim_obj.context.setState(new_state)
+        # straight from the memory mapped library, no xml to parse
+        library.set_state(self.sim_obj, swap_index)
         new_energy = self.sim_obj.context.getState(getEnergy=True,groups={self.force_group}).\
                 getPotentialEnergy().value_in_unit(kilojoule_per_mole)
         #if new_e < old_e , delta e is >0 and p ==1
@@ -309,15 +1177,279 @@ class TicaSimulator(object):
         if accept:
             print("Swap accepted with %s"%random_chck)
             if self.metad_sim.msm_swap_scheme == 'swap_once':
-                self._tabu_list.append(random_chck)
+                self._tabu_list.append(swap_index)
         else:
             #reset back to old_state
             self.sim_obj.context.setState(old_state)
         return
 
+def get_replica_payloads(metad_sim, plumed_dict, n_replicas):
+    """
+    What rank 0 scatters at startup: for every replica a shallow copy of
+    metad_sim without the setup models and the replica's plumed script.
+    Only biased replicas of an msm swap scheme that featurizes on the fly
+    keep the models that scheme needs.
+
+    :param metad_sim: TicaMetadSim
+    :param plumed_dict: rendered scripts keyed on tic index
+    :param n_replicas: number of replicas
+    :return: list of (metad_sim, plumed script) tuples
+    """
+    uses_models = getattr(metad_sim, "msm_swap_folder", None) is not None and \
+        metad_sim.msm_swap_scheme in ['tabu_list', 'min_count', 'wt_msm']
+    bare = copy.copy(metad_sim)
+    for attr in _SETUP_MODELS:
+        if hasattr(bare, attr):
+            setattr(bare, attr, None)
+    with_models = bare
+    if uses_models:
+        with_models = copy.copy(bare)
+        for attr in _MSM_SWAP_MODELS:
+            setattr(with_models, attr, getattr(metad_sim, attr, None))
+    payloads = []
+    for r in range(n_replicas):
+        if metad_sim.neutral_replica and r == n_replicas-1:
+            payloads.append((bare, None))
+        else:
+            payloads.append((with_models, plumed_dict.get(r)))
+    return payloads
+
+
+def get_walker_payloads(metad_sim):
+    # renders the plumed scripts of one walker (or of the only one)
+    from .plumed_writer import get_plumed_dict
+    if metad_sim.plumed_dict is not None:
+        plumed_dict = metad_sim.plumed_dict
+    else:
+        plumed_dict = get_plumed_dict(metad_sim)
+    n_replicas = metad_sim.n_tics + int(bool(metad_sim.neutral_replica))
+    return get_replica_payloads(metad_sim, plumed_dict, n_replicas)
+
+
+def get_cpu_slices(n_slices):
+    # disjoint sets of the cores this process may run on, one per replica
+    if not hasattr(os, "sched_getaffinity"):
+        return [None]*n_slices
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < n_slices:
+        return [None]*n_slices
+    return [set(int(c) for c in s) for s in np.array_split(cores, n_slices)]
+
+
+def _run_replica(sim, cpu_slice):
+    if cpu_slice is not None:
+        os.sched_setaffinity(0, cpu_slice)
+    try:
+        sim.run()
+    except Exception:
+        # the other replicas would wait on this one forever
+        traceback.print_exc()
+        sys.stdout.flush()
+        flush_all_stagers()
+        sim.comm.Abort(1)
+    return
+
+
+def get_launch_options(metad_sim):
+    # the little every process needs to know before any replica exists.
+    # Only the top level pickle of a walker run starts every walker, the
+    # ones in walker_k start that walker on its own.
+    walker_comm = getattr(metad_sim, "walker_comm", "separate")
+    n_walkers = getattr(metad_sim, "walker_n", 1) or 1
+    if walker_comm == "separate" or getattr(metad_sim, "walker_id", None) is not None:
+        walker_comm, n_walkers = "separate", 1
+    return {"n_replicas": metad_sim.n_tics + int(bool(metad_sim.neutral_replica)),
+            "replicas_per_rank": getattr(metad_sim, "replicas_per_rank", 1),
+            "comm_backend": getattr(metad_sim, "comm_backend", "mpi"),
+            "n_walkers": n_walkers,
+            "walker_comm": walker_comm,
+            "base_dir": metad_sim.base_dir}
+
+
+def host_replicas(file_loc, n_replicas, replicas_per_rank, transport=None, gpu_index=0,
+                  metad_sim=None):
+    """
+    Creates and runs the replicas that live in this process, each stepped
+    by its own thread. Replica r lives on process r//replicas_per_rank.
+    Every replica gets a disjoint slice of the cores of the process: the
+    CPU platform's Threads property is set to the slice size and the worker
+    threads are pinned to it by creating the context while the creating
+    thread is pinned.
+
+    :param file_loc: absolute metad_sim.pkl location
+    :param n_replicas: total number of replicas
+    :param replicas_per_rank: replicas per process
+    :param transport: mpi4py communicator or QueueTransport connecting the
+    processes, None if this process hosts every replica
+    :param gpu_index: device shared by the replicas of this process
+    :param metad_sim: already loaded metad_sim.pkl for replica 0
+    :return: list of TicaSimulator
+    """
+    replica_comms = create_thread_comms(n_replicas, replicas_per_rank, transport)
+    cpu_slices = get_cpu_slices(len(replica_comms))
+    all_cores = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+    sims = []
+    for replica_comm, cpu_slice in zip(replica_comms, cpu_slices):
+        cpu_threads = None
+        if cpu_slice is not None:
+            os.sched_setaffinity(0, cpu_slice)
+            cpu_threads = len(cpu_slice)
+        sims.append(TicaSimulator(file_loc, comm=replica_comm, gpu_index=gpu_index,
+                                  cpu_threads=cpu_threads, metad_sim=metad_sim))
+    if all_cores is not None:
+        os.sched_setaffinity(0, all_cores)
+    # openmm releases the GIL while stepping
+    threads = [threading.Thread(target=_run_replica, args=(sim, cpu_slice))
+               for sim, cpu_slice in zip(sims, cpu_slices)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sims
+
+
+def run_local_replicas(file_loc="metad_sim.pkl", replicas_per_rank=None,
+                       metad_sim=None):
+    """
+    mpi launch with several replicas per rank. Only rank 0 reads the pickle
+    (or uses metad_sim if given).
+    """
+    from mpi4py import MPI
+    from msmbuilder.utils import load
+    mpi_comm = MPI.COMM_WORLD
+    # creating a simulation changes the cwd
+    file_loc = os.path.abspath(file_loc)
+    options = None
+    if mpi_comm.Get_rank() == 0:
+        if metad_sim is None:
+            metad_sim = load(file_loc)
+        options = get_launch_options(metad_sim)
+        prepare_msm_library(metad_sim)
+    options = mpi_comm.bcast(options, root=0)
+    if replicas_per_rank is None:
+        replicas_per_rank = options["replicas_per_rank"]
+    n_ranks = int(np.ceil(options["n_replicas"]/replicas_per_rank))
+    if mpi_comm.Get_size() != n_ranks:
+        raise ValueError("%d replicas per rank need %d ranks, got %d"
+                         %(replicas_per_rank, n_ranks, mpi_comm.Get_size()))
+    return host_replicas(file_loc, options["n_replicas"], replicas_per_rank,
+                         mpi_comm if n_ranks > 1 else None,
+                         get_gpu_index(mpi_comm), metad_sim)
+
+
+def _run_process(file_loc, n_replicas, replicas_per_rank, process_rank, queues,
+                 abort_event, cpu_slice, metad_sim):
+    if cpu_slice is not None:
+        os.sched_setaffinity(0, cpu_slice)
+    transport = None
+    if len(queues) > 1:
+        transport = QueueTransport(process_rank, queues, abort_event)
+    host_replicas(file_loc, n_replicas, replicas_per_rank, transport,
+                  gpu_index=process_rank, metad_sim=metad_sim)
+    return
+
+
+def run_multiprocessing(file_loc="metad_sim.pkl", replicas_per_rank=None,
+                        metad_sim=None):
+    """
+    Launch on a single machine without mpi. The replicas are spread over
+    processes started with multiprocessing (replicas_per_rank per process)
+    that exchange through queues. Process k runs on gpu k and on its own
+    slice of the cores. The pickle is read once here and handed to the
+    process hosting replica 0.
+    """
+    import multiprocessing
+    from msmbuilder.utils import load
+    file_loc = os.path.abspath(file_loc)
+    if metad_sim is None:
+        metad_sim = load(file_loc)
+    options = get_launch_options(metad_sim)
+    prepare_msm_library(metad_sim)
+    if replicas_per_rank is None:
+        replicas_per_rank = options["replicas_per_rank"]
+    n_processes = int(np.ceil(options["n_replicas"]/replicas_per_rank))
+    queues = [multiprocessing.Queue() for _ in range(n_processes)]
+    abort_event = multiprocessing.Event()
+    cpu_slices = get_cpu_slices(n_processes)
+    processes = [multiprocessing.Process(target=_run_process,
+                                         args=(file_loc, options["n_replicas"],
+                                               replicas_per_rank, k, queues,
+                                               abort_event, cpu_slices[k],
+                                               metad_sim if k == 0 else None))
+                 for k in range(n_processes)]
+    for process in processes:
+        process.start()
+    # like mpirun, take everybody down once one of them aborts or dies
+    while any(process.is_alive() for process in processes):
+        if abort_event.is_set() or \
+                any(process.exitcode not in [None, 0] for process in processes):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            break
+        time.sleep(0.1)
+    for process in processes:
+        process.join()
+    exit_codes = [process.exitcode for process in processes]
+    if any(c > 0 for c in exit_codes) or \
+            (any(c < 0 for c in exit_codes) and not abort_event.is_set()):
+        raise RuntimeError("Replica processes exited with %s"%exit_codes)
+    return exit_codes
+
+
+def run_walkers(file_loc="metad_sim.pkl", metad_sim=None):
+    """
+    Runs every walker of a walker_comm='split' or 'shared' setup as one mpi
+    job from the top level pickle, with n_walkers*(n_tics+neutral) ranks.
+    With 'split' COMM_WORLD is split into one exchange communicator per
+    walker (rank r runs replica r%n of walker r//n), with 'shared' all of
+    them exchange in a single pool. Either way the walkers share their
+    hills through WALKERS_DIR as before.
+    """
+    from mpi4py import MPI
+    from msmbuilder.utils import load
+    world = MPI.COMM_WORLD
+    file_loc = os.path.abspath(file_loc)
+    options = None
+    if world.Get_rank() == 0:
+        if metad_sim is None:
+            metad_sim = load(file_loc)
+        options = get_launch_options(metad_sim)
+        prepare_msm_library(metad_sim)
+        if options["walker_comm"] != "shared" and \
+                getattr(metad_sim, "msm_swap_folder", None) is not None:
+            for w in range(options["n_walkers"]):
+                prepare_msm_library(load(os.path.join(options["base_dir"],
+                                                      "walker_%d"%w, "metad_sim.pkl")))
+    options = world.bcast(options, root=0)
+    n_replicas = options["n_replicas"]
+    n_ranks = options["n_walkers"]*n_replicas
+    if world.Get_size() != n_ranks:
+        raise ValueError("%d walkers of %d replicas need %d ranks, got %d"
+                         %(options["n_walkers"], n_replicas, n_ranks, world.Get_size()))
+    # one gpu per rank and host across the whole job
+    gpu_index = get_gpu_index(world)
+    if options["walker_comm"] == "shared":
+        sim_obj = TicaSimulator(file_loc, comm=MPIComm(world), gpu_index=gpu_index,
+                                metad_sim=metad_sim)
+    else:
+        walker = world.Get_rank()//n_replicas
+        comm = MPIComm(world.Split(walker, world.Get_rank() % n_replicas))
+        sim_obj = TicaSimulator(os.path.join(options["base_dir"], "walker_%d"%walker,
+                                             "metad_sim.pkl"),
+                                comm=comm, gpu_index=gpu_index)
+    sim_obj.run()
+    return sim_obj
+
 
 def run_meta_sim(file_loc="metad_sim.pkl"):
+    from msmbuilder.utils import load
+    from simtk.unit import kilojoule_per_mole
     from tica_metadynamics.load_sim import create_simulation
+    from .plumed_writer import get_plumed_dict
+    comm = MPIComm()
+    size = comm.Get_size()
+    rank = comm.Get_rank()
 
     metad_sim = load(file_loc)
     if metad_sim.msm_swap_folder is not None:
@@ -328,19 +1460,22 @@ def run_meta_sim(file_loc="metad_sim.pkl"):
 
     #get
     my_host_name = socket.gethostname()
-    my_gpu_index = get_gpu_index()
+    my_gpu_index = get_gpu_index(comm)
     print("Hello from rank %d running tic %d on "
           "host %s with gpu %d"%(rank, rank, my_host_name, my_gpu_index))
 
     plumed_force_dict = get_plumed_dict(metad_sim)
     sim_obj, force_group = create_simulation(metad_sim.base_dir, metad_sim.starting_coordinates_folder,
                                 my_gpu_index, rank, plumed_force_dict[rank],
-                                metad_sim.sim_save_rate, metad_sim.platform)
+                                metad_sim.sim_save_rate, metad_sim.platform,
+                                getattr(metad_sim, "bias_mts_steps", 1),
+                                getattr(metad_sim, "bias_backend", "plumed"))
     if rank ==0 and size>1:
         log_file = open("../swap_log.txt","a")
         header = ["Iteration","S_i","S_j","Eii","Ejj","Eij","Eji",
                   "DeltaE","Temp","Beta","Probability","Accepted"]
         log_file.writelines("#{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(*header))
+    scheduler = ExchangeScheduler(size, getattr(metad_sim, "exchange_scheme", "single"))
 
     for step in range(metad_sim.n_iterations):
         #2fs *3000 = 6ps
@@ -359,12 +1494,11 @@ def run_meta_sim(file_loc="metad_sim.pkl"):
         data = comm.gather((old_state,old_energy), root=0)
         if size >1:
             if rank==0:
-                #rnd pick 2 states
-                i,j =  np.random.choice(np.arange(size), 2, replace=False)
-                s_i_i,e_i_i = data[i]
-                s_j_j,e_j_j = data[j]
+                pairs, rnds = scheduler.get_pairs(step)
+                old_energies = [e for _, e in data]
                 #swap out states
-                data[j], data[i] = data[i],data[j]
+                for i, j in pairs:
+                    data[j], data[i] = data[i],data[j]
             else:
                 data = None
 
@@ -381,21 +1515,21 @@ def run_meta_sim(file_loc="metad_sim.pkl"):
             data = comm.gather((new_state,new_energy), root=0)
 
             if rank==0:
-                s_i_j, e_i_j = data[i]
-                s_j_i, e_j_i = data[j]
-                delta_e = e_i_i+e_j_j - e_i_j - e_j_i
-                probability = np.min((1,np.exp(beta*delta_e)))
-                print(e_i_i,e_j_j,e_i_j,e_j_i,probability)
-                if np.random.random() < probability :
-                    accepted= 1
-                    print("Swapping out %d with %d"%(i,j),flush=True)
-                else:
-                    accepted= 0
-                    print("Failed Swap of %d with %d"%(i,j),flush=True)
-                    #go back to original state list
-                    data[i], data[j] = data[j] , data[i]
-                header = [step, i, j, e_i_i,e_j_j,e_i_j,e_j_i,delta_e,metad_sim.temp,beta,probability,accepted]
-                log_file.writelines("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(*header))
+                for (i, j), rnd in zip(pairs, rnds):
+                    e_i_i, e_j_j = old_energies[i], old_energies[j]
+                    e_i_j, e_j_i = data[i][1], data[j][1]
+                    delta_e, probability = get_swap_probability(beta, e_i_i, e_j_j, e_i_j, e_j_i)
+                    print(e_i_i,e_j_j,e_i_j,e_j_i,probability)
+                    if rnd < probability :
+                        accepted= 1
+                        print("Swapping out %d with %d"%(i,j),flush=True)
+                    else:
+                        accepted= 0
+                        print("Failed Swap of %d with %d"%(i,j),flush=True)
+                        #go back to original state list
+                        data[i], data[j] = data[j] , data[i]
+                    header = [step, i, j, e_i_i,e_j_j,e_i_j,e_j_i,delta_e,metad_sim.temp,beta,probability,accepted]
+                    log_file.writelines("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(*header))
                 log_file.flush()
             else:
                 data = None
@@ -417,13 +1551,43 @@ def parse_commandline():
     parser.add_argument('-f','--file', dest='f',
                             default='./metad_sim.pkl',
               help='TICA METAD location file')
+    parser.add_argument('-b','--backend', dest='b', default=None,
+                        choices=_COMM_BACKENDS,
+              help='Overrides comm_backend. multiprocessing runs all replicas '
+                   'on this machine without mpirun')
     args = parser.parse_args()
     return args
 
 def main():
     args = parse_commandline()
     file_loc = args.f
-    sim_obj = TicaSimulator(file_loc)
+    if args.b == "multiprocessing":
+        run_multiprocessing(file_loc)
+        return
+    # only rank 0 reads the pickle, the others learn the launch options
+    # from it and get their part of the model once the replicas start
+    try:
+        comm = MPIComm()
+    except ImportError:
+        comm = None
+    metad_sim = options = None
+    if comm is None or comm.Get_rank() == 0:
+        from msmbuilder.utils import load
+        metad_sim = load(file_loc)
+        options = get_launch_options(metad_sim)
+        prepare_msm_library(metad_sim)
+    if comm is not None:
+        options = comm.bcast(options, root=0)
+    if (args.b or options["comm_backend"]) == "multiprocessing":
+        run_multiprocessing(file_loc, metad_sim=metad_sim)
+        return
+    if options["n_walkers"] > 1:
+        run_walkers(file_loc, metad_sim=metad_sim)
+        return
+    if options["replicas_per_rank"] > 1:
+        run_local_replicas(file_loc, metad_sim=metad_sim)
+        return
+    sim_obj = TicaSimulator(file_loc, comm=comm, metad_sim=metad_sim)
     sim_obj.run()
     return
 
@@ -0,0 +1,170 @@
+#!/bin/env python
+import os
+import sys
+import atexit
+import shutil
+import signal
+import tempfile
+import threading
+
+# stagers that still hold unsynced output, flushed on exit and on SIGTERM
+_stagers = []
+_handlers_installed = [False]
+
+
+class OutputStager(object):
+    """
+    Keeps a replica's outputs on node local scratch and copies them to
+    dest_dir in bulk from a background thread every sync_interval seconds,
+    and once more when closed, at interpreter exit and on SIGTERM (what
+    slurm sends at the walltime).
+
+    Append files only grow apart from a header at the start (a dcd
+    rewrites its frame count with every frame), so a sync copies the first
+    head_bytes and whatever was appended since the last one. Other files
+    are copied whole to a temporary name and renamed into place, so that a
+    restart never reads half a checkpoint.
+
+    :param dest_dir: folder on the shared filesystem, e.g. base_dir/tic_0
+    :param scratch_root: node local folder, environment variables are
+    expanded ($TMPDIR, /lscratch/$SLURM_JOB_ID)
+    :param sync_interval: seconds between syncs
+    :param head_bytes: bytes at the start of append files that may change
+    """
+    def __init__(self, dest_dir, scratch_root, sync_interval=300, head_bytes=4096):
+        self.dest_dir = dest_dir
+        # the replicas chdir into their folders, keep the path absolute
+        scratch_root = os.path.abspath(os.path.expandvars(scratch_root))
+        os.makedirs(scratch_root, exist_ok=True)
+        self.scratch_dir = tempfile.mkdtemp(prefix="tica_metad_%s_"%os.path.basename(dest_dir),
+                                            dir=scratch_root)
+        self.sync_interval = sync_interval
+        self.head_bytes = head_bytes
+        self._files = {}
+        self._flush_callbacks = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._sync_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        _stagers.append(self)
+        _install_handlers()
+
+    def path(self, name, append=True):
+        """
+        Registers an output and returns where to write it.
+        """
+        # asking again for a registered file keeps what was synced of it
+        if name not in self._files:
+            self._files[name] = {"append": append, "synced": None, "stamp": None}
+        return os.path.join(self.scratch_dir, name)
+
+    def add_flush_callback(self, callback):
+        # called before the final sync, e.g. to flush reporter buffers
+        self._flush_callbacks.append(callback)
+        return
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+            except (IOError, OSError) as e:
+                # a full or flaky filesystem shouldn't kill the run, the
+                # next sync tries again
+                print("Syncing %s failed: %s"%(self.scratch_dir, e), flush=True)
+        return
+
+    def _sync_append(self, src, dst, info):
+        # synced is None until the first sync, which also creates empty files
+        size = os.path.getsize(src)
+        if size == info["synced"]:
+            return
+        synced = info["synced"] or 0
+        with open(src, 'rb') as fin:
+            with open(dst, 'r+b' if synced > 0 and os.path.isfile(dst) else 'wb') as fout:
+                head = fin.read(min(self.head_bytes, size))
+                fout.write(head)
+                start = max(synced, len(head))
+                fin.seek(start)
+                fout.seek(start)
+                remaining = size - start
+                while remaining > 0:
+                    chunk = fin.read(min(remaining, 1 << 24))
+                    if len(chunk) == 0:
+                        break
+                    fout.write(chunk)
+                    remaining -= len(chunk)
+        info["synced"] = size - remaining
+        return
+
+    def _sync_replace(self, src, dst, info):
+        stat = os.stat(src)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == info["stamp"]:
+            return
+        shutil.copyfile(src, dst + ".tmp")
+        os.replace(dst + ".tmp", dst)
+        info["stamp"] = stamp
+        return
+
+    def sync(self):
+        """
+        Copies everything that changed since the last sync to dest_dir.
+        """
+        with self._lock:
+            for name, info in self._files.items():
+                src = os.path.join(self.scratch_dir, name)
+                if not os.path.isfile(src):
+                    continue
+                dst = os.path.join(self.dest_dir, name)
+                if info["append"]:
+                    self._sync_append(src, dst, info)
+                else:
+                    self._sync_replace(src, dst, info)
+        return
+
+    def close(self):
+        """
+        Final sync, then the scratch folder is removed. Safe to call more
+        than once.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        for callback in self._flush_callbacks:
+            callback()
+        self.sync()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        if self in _stagers:
+            _stagers.remove(self)
+        return
+
+
+def flush_all_stagers():
+    for stager in list(_stagers):
+        try:
+            stager.close()
+        except Exception as e:
+            print("Final sync of %s failed: %s"%(stager.scratch_dir, e), flush=True)
+    return
+
+
+def _handle_sigterm(signum, frame):
+    print("Caught signal %d, syncing staged output"%signum, flush=True)
+    flush_all_stagers()
+    sys.exit(128 + signum)
+
+
+def _install_handlers():
+    if _handlers_installed[0]:
+        return
+    _handlers_installed[0] = True
+    atexit.register(flush_all_stagers)
+    # signal handlers can only be set from the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+    return
@@ -0,0 +1,299 @@
+#!/bin/env python
+import os
+import atexit
+import numpy as np
+
+# text is the tab separated swap_log.txt, binary appends fixed size records
+# of SWAP_RECORD_DTYPE to swap_log.bin (read it with read_swap_log)
+_SWAP_LOG_FORMATS = ["text", "binary"]
+
+SWAP_LOG_HEADER = ["Iteration", "S_i", "S_j", "Eii", "Ejj", "Eij", "Eji",
+                   "DeltaE", "Temp", "Beta", "Probability", "Accepted"]
+
+SWAP_RECORD_DTYPE = np.dtype([("iteration", "<i8"), ("s_i", "<i4"), ("s_j", "<i4"),
+                              ("e_ii", "<f8"), ("e_jj", "<f8"), ("e_ij", "<f8"),
+                              ("e_ji", "<f8"), ("delta_e", "<f8"), ("temp", "<f8"),
+                              ("beta", "<f8"), ("probability", "<f8"),
+                              ("accepted", "<i1")])
+
+
+def get_swap_log_file(base_dir, swap_log_format="text"):
+    return os.path.join(base_dir, "swap_log.bin" if swap_log_format == "binary"
+                        else "swap_log.txt")
+
+
+def read_swap_log(log_file):
+    """
+    :return: structured array of SWAP_RECORD_DTYPE, from either format
+    """
+    if log_file.endswith(".bin"):
+        return np.fromfile(log_file, dtype=SWAP_RECORD_DTYPE)
+    records = np.loadtxt(log_file, ndmin=2)
+    out = np.zeros(len(records), dtype=SWAP_RECORD_DTYPE)
+    for k, name in enumerate(SWAP_RECORD_DTYPE.names):
+        out[name] = records[:, k]
+    return out
+
+
+def truncate_binary_swap_log(log_file, iteration):
+    # keeps the records of iterations before the snapshot
+    if not os.path.isfile(log_file):
+        return
+    records = read_swap_log(log_file)
+    kept = records[records["iteration"] < iteration]
+    if len(kept) < len(records):
+        kept.tofile(log_file + ".tmp")
+        os.replace(log_file + ".tmp", log_file)
+    return
+
+
+class SwapStatistics(object):
+    """
+    Acceptance of every pair of replicas, the configuration every replica
+    holds and the round trips of the configurations between the first and
+    the last replica, updated one iteration of swap records at a time.
+
+    :param n_replicas: replicas in the pool
+    :param permutation_moves: the records of an iteration are one
+    permutation (gibbs exchange, S_j is what S_i gets) rather than
+    independent pair swaps
+    :param start_iteration: iteration the round trip clocks start at
+    """
+    def __init__(self, n_replicas, permutation_moves=False, start_iteration=0):
+        self.n_replicas = n_replicas
+        self.permutation_moves = permutation_moves
+        self.attempted = np.zeros((n_replicas, n_replicas), dtype=int)
+        self.accepted = np.zeros((n_replicas, n_replicas), dtype=int)
+        # configuration held by every replica
+        self.permutation = np.arange(n_replicas)
+        # configurations that left replica 0 and when, and whether they
+        # have been to the last replica since
+        self._departure = {0: start_iteration}
+        self._reached_top = set()
+        self.round_trips = []
+        self.n_records = 0
+        self.last_iteration = None
+        # records of the newest iteration, more of them may still come
+        self._pending = np.zeros(0, dtype=SWAP_RECORD_DTYPE)
+
+    def update(self, records, complete=False):
+        """
+        :param records: structured array of SWAP_RECORD_DTYPE
+        :param complete: no more records of the newest iteration will come,
+        otherwise that iteration is held back until the next update
+        """
+        records = np.sort(np.concatenate([self._pending, records]), order="iteration",
+                          kind="stable")
+        self._pending = records[:0]
+        if not complete and len(records) > 0:
+            newest = records["iteration"] == records["iteration"][-1]
+            records, self._pending = records[~newest], records[newest]
+        if len(records) == 0:
+            return
+        np.add.at(self.attempted, (records["s_i"], records["s_j"]), 1)
+        np.add.at(self.accepted, (records["s_i"], records["s_j"]),
+                  records["accepted"].astype(int))
+        self.n_records += len(records)
+        iterations = records["iteration"]
+        boundaries = np.flatnonzero(np.diff(iterations)) + 1
+        for chunk in np.split(records, boundaries):
+            self._move(chunk)
+            self._track_round_trips(int(chunk["iteration"][0]))
+        self.last_iteration = int(iterations[-1])
+        return
+
+    def _move(self, chunk):
+        if self.permutation_moves:
+            old = self.permutation.copy()
+            for i, j in zip(chunk["s_i"], chunk["s_j"]):
+                self.permutation[i] = old[j]
+            return
+        for i, j, accepted in zip(chunk["s_i"], chunk["s_j"], chunk["accepted"]):
+            if accepted:
+                self.permutation[[i, j]] = self.permutation[[j, i]]
+        return
+
+    def _track_round_trips(self, iteration):
+        top = self.permutation[self.n_replicas - 1]
+        if top in self._departure:
+            self._reached_top.add(top)
+        bottom = self.permutation[0]
+        if bottom in self._reached_top:
+            self.round_trips.append(iteration + 1 - self._departure[bottom])
+            self._reached_top.discard(bottom)
+            self._departure[bottom] = iteration + 1
+        elif bottom not in self._departure:
+            self._departure[bottom] = iteration + 1
+        return
+
+    def get_acceptance(self):
+        # accepted/attempted for the pairs that were tried, nan otherwise
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.accepted/self.attempted.astype(float)
+
+    def write_summary(self, summary_file):
+        lines = ["# %d swap records up to iteration %s\n"%(self.n_records, self.last_iteration),
+                 "# configuration held by every replica\n",
+                 " ".join(str(c) for c in self.permutation) + "\n",
+                 "# round trips between the first and the last replica: count, "
+                 "mean and last length in iterations\n"]
+        if len(self.round_trips) > 0:
+            lines.append("%d %.2f %d\n"%(len(self.round_trips), np.mean(self.round_trips),
+                                         self.round_trips[-1]))
+        else:
+            lines.append("0 nan nan\n")
+        lines.append("# S_i S_j attempted accepted acceptance\n")
+        acceptance = self.get_acceptance()
+        for i, j in zip(*np.nonzero(self.attempted)):
+            lines.append("%d %d %d %d %.3f\n"%(i, j, self.attempted[i, j],
+                                              self.accepted[i, j], acceptance[i, j]))
+        with open(summary_file + ".tmp", 'w') as f:
+            f.writelines(lines)
+        os.replace(summary_file + ".tmp", summary_file)
+        return
+
+
+class SwapLog(object):
+    """
+    Rank 0's swap log. Records are kept in memory and written every
+    buffer_size records (and on flush and close) instead of one flushed
+    line per attempt. Every write also updates the statistics and
+    rewrites swap_summary.txt next to the log.
+
+    The pairwise exchange delivers records out of order. With ordered,
+    the pairs the scheduler drew for every iteration are registered with
+    expect and an iteration is only written, and counted in the
+    statistics, once each of its pairs sent a record or was skipped.
+
+    :param base_dir: folder of the log and the summary
+    :param n_replicas: replicas in the pool
+    :param swap_log_format: text or binary
+    :param start_iteration: records from this iteration on are dropped
+    from an existing log, a resumed run replays the rest into the
+    statistics
+    :param permutation_moves: see SwapStatistics
+    :param buffer_size: records held before they are written
+    :param ordered: hold records back until their iteration is complete
+    """
+    def __init__(self, base_dir, n_replicas, swap_log_format="text", start_iteration=0,
+                 permutation_moves=False, buffer_size=100, ordered=False):
+        from .checkpoint import truncate_swap_log
+        if swap_log_format not in _SWAP_LOG_FORMATS:
+            raise ValueError("swap_log_format must be one of %s"%_SWAP_LOG_FORMATS)
+        self.log_file = get_swap_log_file(base_dir, swap_log_format)
+        self.summary_file = os.path.join(base_dir, "swap_summary.txt")
+        self.swap_log_format = swap_log_format
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._closed = False
+        self.ordered = ordered
+        # pairs drawn and pairs heard of by iteration, iterations before
+        # _released are written, and pairs whose lower replica was dropped
+        # are not waited for
+        self._expected = {}
+        self._reported = {}
+        self._released = start_iteration
+        self._abandoned = set()
+        previous = None
+        if start_iteration > 0:
+            if swap_log_format == "binary":
+                truncate_binary_swap_log(self.log_file, start_iteration)
+            else:
+                truncate_swap_log(self.log_file, start_iteration)
+            if os.path.isfile(self.log_file) and os.path.getsize(self.log_file) > 0:
+                previous = read_swap_log(self.log_file)
+        if previous is not None:
+            # the replicas resume with the configurations they had then
+            self.stats = SwapStatistics(n_replicas, permutation_moves)
+            self.stats.update(previous, complete=True)
+        else:
+            self.stats = SwapStatistics(n_replicas, permutation_moves, start_iteration)
+        if swap_log_format == "text":
+            with open(self.log_file, "a") as f:
+                f.write("#" + "\t".join(SWAP_LOG_HEADER) + "\n")
+        # what is still buffered when the job is killed
+        atexit.register(self.close)
+
+    def record(self, header):
+        """
+        :param header: values in the order of SWAP_LOG_HEADER
+        """
+        if self.ordered and header[0] < self._released:
+            print("Dropping the late swap record of %d and %d at iteration %d"
+                  %(header[1], header[2], header[0]), flush=True)
+            return
+        self._buffer.append(tuple(header))
+        self._report(header[0], header[1], header[2])
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+        return
+
+    def expect(self, iteration, pairs):
+        """
+        :param pairs: (S_i, S_j) pairs the scheduler drew for iteration
+        """
+        self._expected[iteration] = set((int(i), int(j)) for i, j in pairs)
+        return
+
+    def skip(self, iteration, i, j):
+        # the pair never finished its exchange, there is no record
+        self._report(iteration, i, j)
+        return
+
+    def abandon(self, replicas):
+        # dropped replicas, pairs they lead aren't waited for anymore
+        self._abandoned.update(replicas)
+        return
+
+    def _report(self, iteration, i, j):
+        if self.ordered and iteration >= self._released:
+            self._reported.setdefault(iteration, set()).add((int(i), int(j)))
+        return
+
+    def _complete_until(self):
+        # first iteration that is still waiting on a pair or not drawn yet
+        iteration = self._released
+        while iteration in self._expected and \
+                all(p in self._reported.get(iteration, ()) or p[0] in self._abandoned
+                    for p in self._expected[iteration]):
+            iteration += 1
+        return iteration
+
+    def flush(self, complete=False):
+        if len(self._buffer) == 0 and not complete:
+            return
+        records = np.sort(np.array(self._buffer, dtype=SWAP_RECORD_DTYPE),
+                          order="iteration", kind="stable")
+        self._buffer = []
+        if self.ordered:
+            until = records["iteration"].max() + 1 if complete and len(records) > 0 \
+                else self._complete_until()
+            until = max(until, self._released)
+            held = records["iteration"] >= until
+            self._buffer = [tuple(r) for r in records[held].tolist()]
+            records = records[~held]
+            for iteration in [k for k in set(self._expected) | set(self._reported)
+                              if k < until]:
+                self._expected.pop(iteration, None)
+                self._reported.pop(iteration, None)
+            self._released = until
+            # only whole iterations get this far
+            complete = True
+            if len(records) == 0:
+                return
+        if self.swap_log_format == "binary":
+            with open(self.log_file, "ab") as f:
+                records.tofile(f)
+        else:
+            with open(self.log_file, "a") as f:
+                f.writelines("\t".join(str(v) for v in r) + "\n" for r in records.tolist())
+        self.stats.update(records, complete)
+        self.stats.write_summary(self.summary_file)
+        return
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.flush(complete=True)
+        return
@@ -1,15 +1,9 @@
 #!/bin/env python
+import os
 import socket
-from mpi4py import MPI
-import mdtraj as md
 import glob
-from msmbuilder.dataset import _keynat as keynat
 import yaml
 
-comm = MPI.COMM_WORLD
-size = comm.Get_size()
-rank = comm.Get_rank()
-
 
 def get_gpu_list(hst_list):
     gpu_list=[]
@@ -23,12 +17,15 @@ def get_gpu_list(hst_list):
     return gpu_list
 
 
-def get_gpu_index():
+def get_gpu_index(comm=None):
+    if comm is None:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
     my_host_name = socket.gethostname()
     host_name_list = comm.gather(my_host_name, root=0)
     print(my_host_name)
     data=None
-    if rank==0:
+    if comm.Get_rank()==0:
         print(host_name_list)
         gpu_list = get_gpu_list(host_name_list)
         data = [i for i in zip(host_name_list,gpu_list)]
@@ -38,25 +35,52 @@ def get_gpu_index():
 
 
 def concatenate_folder(fname, top_loc="./starting_coordinates/0.pdb",stride=1):
+    import mdtraj as md
+    from msmbuilder.dataset import _keynat as keynat
     flist = sorted(glob.glob("./%s/trajectory.dcd.bak.*"%fname), key=keynat)
     flist.extend(glob.glob("./%s/trajectory.dcd"%fname))
+    # written by SubsetTrajectoryReporter, already without the solvent
+    flist.extend(glob.glob("./%s/trajectory.h5"%fname))
     print(flist)
     top = md.load(top_loc)
     trj_list=[]
+    reference = None
     for i in flist:
         try:
-            trj_list.append(md.load_dcd(i,top=top,stride=stride))
+            # strip every piece on its own, which keeps the memory down and
+            # lets full dcds and solute only files be joined
+            trj = md.load(i,top=top,stride=stride).remove_solvent()
         except:
-            pass
+            continue
+        # an h5 written with another traj_atoms than "solute" can't be
+        # joined with the stripped dcds
+        atoms = [(a.residue.name, a.name) for a in trj.topology.atoms]
+        if reference is None:
+            reference = (i, atoms)
+        elif atoms != reference[1]:
+            raise ValueError("%s and %s hold different atoms after removing the "
+                             "solvent (%d and %d), was traj_atoms changed during the run?"
+                             %(reference[0], i, len(reference[1]), len(atoms)))
+        trj_list.append(trj)
 
 
     trj = trj_list[0] + trj_list[1:]
-    trj.remove_solvent().save_xtc("%s/%s.xtc"%(fname,fname))
+    trj.save_xtc("%s/%s.xtc"%(fname,fname))
     print("Found %d trajs"%len(trj_list))
 
     return
 
 
+def link_trajectory(fname):
+    # the replica wrote its solute xtc itself, point post processing at it
+    # instead of concatenating
+    link = "%s/%s.xtc"%(fname,fname)
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink("trajectory.xtc", link)
+    return
+
+
 def load_yaml_file(yaml_file):
     if isinstance(yaml_file, dict):
         return yaml_file